@@ -0,0 +1,359 @@
+import os
+import mmap
+import shutil
+import hashlib
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+
+def path_key(path):
+    return int.from_bytes(hashlib.blake2b(path.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+
+def split_path(path):
+    """Split after the last separator so dir + name gives the exact path back"""
+    i = max(path.rfind('/'), path.rfind('\\')) + 1
+    return path[:i], path[i:]
+
+
+def map_file(file):
+    if not os.path.getsize(file):  # mmap refuses empty files
+        return b''
+    with open(file, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def decode_slices(data, starts, ends):
+    """Decode data[start:end] for each pair, reading the covering range of data only once"""
+    if not len(starts):
+        return []
+    base = int(starts.min())
+    block = data[base:int(ends.max())]
+    return [block[start - base:end - base].decode('utf-8', 'surrogatepass') for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+class CorpusColumns:
+    """
+    One immutable generation of the corpus on disk.
+
+    Texts live in one contiguous utf-8 blob with an offsets array, paths are split into an
+    interned directory table plus a basename blob, and path lookups go through a sorted array
+    of 64 bit path hashes instead of a dict of path strings. The blobs are memory-mapped, only
+    the fixed width arrays (a few dozen bytes per document) are read into memory. dead lists the
+    (segment, row) pairs of older segments this one superseded.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.text_data = map_file(os.path.join(folder, 'text.bin'))
+        self.text_offsets = np.load(os.path.join(folder, 'text_offsets.npy'))
+        self.name_data = map_file(os.path.join(folder, 'names.bin'))
+        self.name_offsets = np.load(os.path.join(folder, 'name_offsets.npy'))
+        self.path_dirs = np.load(os.path.join(folder, 'path_dirs.npy'))
+        self.keys = np.load(os.path.join(folder, 'keys.npy'))
+        self.key_rows = np.load(os.path.join(folder, 'key_rows.npy'))
+        with open(os.path.join(folder, 'dirs.txt'), encoding='utf-8', errors='surrogatepass', newline='') as f:
+            self.dirs = f.read().split('\n')
+        dead_file = os.path.join(folder, 'dead.npy')  # missing from generations written before segments
+        self.dead = np.load(dead_file) if os.path.exists(dead_file) else np.zeros((0, 2), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.text_offsets) - 1
+
+    def text(self, row):
+        return self.text_data[self.text_offsets[row]:self.text_offsets[row + 1]].decode('utf-8', 'surrogatepass')
+
+    def path(self, row):
+        name = self.name_data[self.name_offsets[row]:self.name_offsets[row + 1]].decode('utf-8', 'surrogatepass')
+        return self.dirs[self.path_dirs[row]] + name
+
+    def texts(self, rows):
+        return decode_slices(self.text_data, self.text_offsets[rows], self.text_offsets[rows + 1])
+
+    def paths(self, rows):
+        names = decode_slices(self.name_data, self.name_offsets[rows], self.name_offsets[rows + 1])
+        return [self.dirs[directory] + name for directory, name in zip(self.path_dirs[rows].tolist(), names)]
+
+    def find(self, path):
+        key = np.uint64(path_key(path))
+        i = int(np.searchsorted(self.keys, key))
+        while i < len(self.keys) and self.keys[i] == key:
+            row = int(self.key_rows[i])
+            if self.path(row) == path:
+                return row
+            i += 1
+        return None
+
+    @staticmethod
+    def write(folder, items, dead=()):
+        """Write (path, text) pairs out as a new segment in folder, dead being the (segment, row) pairs it supersedes"""
+        os.makedirs(folder, exist_ok=True)
+        dirs = {}
+        path_dirs, keys = [], []
+        text_offsets, name_offsets = [0], [0]
+        with open(os.path.join(folder, 'text.bin'), 'wb') as texts, open(os.path.join(folder, 'names.bin'), 'wb') as names:
+            for path, text in items:
+                directory, name = split_path(path)
+                path_dirs.append(dirs.setdefault(directory, len(dirs)))
+                keys.append(path_key(path))
+
+                data = text.encode('utf-8', 'surrogatepass')
+                texts.write(data)
+                text_offsets.append(text_offsets[-1] + len(data))
+
+                data = name.encode('utf-8', 'surrogatepass')
+                names.write(data)
+                name_offsets.append(name_offsets[-1] + len(data))
+
+        keys = np.array(keys, dtype=np.uint64)
+        order = np.argsort(keys, kind='stable')
+        np.save(os.path.join(folder, 'text_offsets.npy'), np.array(text_offsets, dtype=np.int64))
+        np.save(os.path.join(folder, 'name_offsets.npy'), np.array(name_offsets, dtype=np.int64))
+        np.save(os.path.join(folder, 'path_dirs.npy'), np.array(path_dirs, dtype=np.uint32))
+        np.save(os.path.join(folder, 'keys.npy'), keys[order])
+        np.save(os.path.join(folder, 'key_rows.npy'), order.astype(np.int64))
+        np.save(os.path.join(folder, 'dead.npy'), np.array(dead, dtype=np.int64).reshape(-1, 2))
+        with open(os.path.join(folder, 'dirs.txt'), 'w', encoding='utf-8', errors='surrogatepass', newline='') as f:
+            f.write('\n'.join(dirs))
+
+
+# everything a reader needs, swapped as one reference so a lookup never mixes two versions.
+# segments are oldest first with an alive mask each, extra holds the texts changed since the last
+# save, killed the (segment, row) pairs retired since the last save and size the live count
+CorpusState = namedtuple('CorpusState', ['segments', 'ids', 'alive', 'extra', 'killed', 'size'])
+
+
+class Corpus:
+    """
+    Compact, memory-mapped (path, text) corpus replacing the in-memory dict and list copies.
+
+    The bulk lives in CorpusColumns segments on disk that every thread, or any process opening
+    the same folder, reads through the page cache without copying. Changes made since the last
+    save sit in a small in-memory overlay, save() appends them as a new delta segment (along with
+    the rows they retire in older segments) and once there are more than max_segments, or the
+    deltas outgrow compact_fraction of the base, all segments get compacted into one.
+
+    Readers take self.state once and see that version throughout, writers build a new CorpusState
+    and swap it in, and the disk writes happen outside the lock readers and updates go through.
+    stamp records what the saved segments reflect (the text store's write count).
+    """
+
+    def __init__(self, folder, max_segments=8, compact_fraction=0.25):
+        self.folder = folder
+        self.max_segments = max_segments
+        self.compact_fraction = compact_fraction
+        self.lock = threading.Lock()  # swaps of self.state
+        self.write_lock = threading.Lock()  # one save, compaction or rebuild at a time
+        os.makedirs(folder, exist_ok=True)
+
+        current = os.path.join(folder, 'current')
+        if os.path.exists(current):
+            with open(current) as f:
+                ids, self.stamp = f.read().split('\n')[:2]
+            ids = [int(segment_id) for segment_id in ids.split()]
+        else:
+            ids, self.stamp = [0], ''
+            CorpusColumns.write(os.path.join(folder, '0'), ())
+        self.next_id = max(ids) + 1
+        self.state = self.load(ids)
+
+        # segments left behind because they were still mapped when compacted away
+        for entry in os.listdir(folder):
+            if entry not in {*map(str, ids), 'current'} and os.path.isdir(os.path.join(folder, entry)):
+                shutil.rmtree(os.path.join(folder, entry), ignore_errors=True)
+
+    def load(self, ids):
+        segments = tuple(CorpusColumns(os.path.join(self.folder, str(segment_id))) for segment_id in ids)
+        alive = [np.ones(len(segment), dtype=bool) for segment in segments]
+        positions = {segment_id: i for i, segment_id in enumerate(ids)}
+        for segment in segments:
+            for segment_id, row in segment.dead.tolist():
+                if segment_id in positions:
+                    alive[positions[segment_id]][row] = False
+        return CorpusState(segments, tuple(ids), tuple(alive), {}, (), sum(int(mask.sum()) for mask in alive))
+
+    def __len__(self):
+        return self.state.size
+
+    def __getitem__(self, path):
+        text = self.get(path)
+        if text is None:
+            raise KeyError(path)
+        return text
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    @staticmethod
+    def find(segments, alive, path):
+        """(segment index, row) of the live row of path, newest segment first, or None"""
+        for i in range(len(segments) - 1, -1, -1):
+            row = segments[i].find(path)
+            if row is not None and alive[i][row]:
+                return i, row
+        return None
+
+    def get(self, path, default=None):
+        state = self.state
+        text = state.extra.get(path)
+        if text is not None:
+            return text
+        found = self.find(state.segments, state.alive, path)
+        if found is None:
+            return default
+        return state.segments[found[0]].text(found[1])
+
+    def change(self, updates=(), removals=()):
+        """Swap in a state with (path, text) updates and path removals applied, copying only what changes"""
+        with self.lock:
+            state = self.state
+            extra = dict(state.extra)
+            alive = list(state.alive)
+            copied = set()
+            killed = list(state.killed)
+            size = state.size
+
+            def remove(path):
+                nonlocal size
+                if extra.pop(path, None) is not None:
+                    size -= 1
+                    return
+                found = self.find(state.segments, alive, path)
+                if found is not None:
+                    i, row = found
+                    if i not in copied:
+                        alive[i] = alive[i].copy()
+                        copied.add(i)
+                    alive[i][row] = False
+                    killed.append((state.ids[i], row))
+                    size -= 1
+
+            for path in removals:
+                remove(path)
+            for path, text in updates:
+                remove(path)
+                extra[path] = text
+                size += 1
+            self.state = state._replace(alive=tuple(alive), extra=extra, killed=tuple(killed), size=size)
+
+    def update(self, items):
+        """Add or replace (path, text) pairs"""
+        self.change(updates=items)
+
+    def remove(self, paths):
+        self.change(removals=paths)
+
+    def snapshot(self):
+        return self.state
+
+    def items(self):
+        state = self.snapshot()
+        for segment, mask in zip(state.segments, state.alive):
+            for row in np.flatnonzero(mask):
+                yield segment.path(row), segment.text(row)
+        yield from state.extra.items()
+
+    def chunks(self, chunk_size=2**16):
+        """Yield the corpus as (paths, texts) list pairs of up to chunk_size entries, for batched scoring"""
+        state = self.snapshot()
+        for segment, mask in zip(state.segments, state.alive):
+            rows = np.flatnonzero(mask)
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                yield segment.paths(chunk), segment.texts(chunk)
+        extra = list(state.extra.items())
+        for i in range(0, len(extra), chunk_size):
+            chunk = extra[i:i + chunk_size]
+            yield [path for path, _ in chunk], [text for _, text in chunk]
+
+    def rebuild(self, items, stamp=''):
+        """Replace the whole corpus with (path, text) pairs"""
+        with self.write_lock:
+            segment_id = self.new_segment(items)
+            segment = CorpusColumns(os.path.join(self.folder, str(segment_id)))
+            with self.lock:
+                old = self.state
+                self.state = CorpusState((segment,), (segment_id,), (np.ones(len(segment), dtype=bool),), {}, (), len(segment))
+                self.write_manifest(self.state.ids, stamp)
+            self.drop_segments(old.ids)
+
+    def save(self, stamp=''):
+        """Append the overlay as a new delta segment, if anything changed, compacting when there are too many"""
+        with self.write_lock:
+            state = self.state
+            if not state.extra and not state.killed:
+                if stamp != self.stamp:
+                    self.write_manifest(state.ids, stamp)
+                return
+
+            written = list(state.extra.items())
+            segment_id = self.new_segment(written, state.killed)
+            segment = CorpusColumns(os.path.join(self.folder, str(segment_id)))
+            with self.lock:
+                # updates that landed while the segment was written stay in the overlay, the rows they superseded die
+                current = self.state
+                extra = dict(current.extra)
+                killed = list(current.killed[len(state.killed):])
+                mask = np.ones(len(written), dtype=bool)
+                for row, (path, text) in enumerate(written):
+                    if extra.get(path) is text:
+                        del extra[path]
+                    else:
+                        mask[row] = False
+                        killed.append((segment_id, row))
+                self.state = CorpusState(current.segments + (segment,), current.ids + (segment_id,), current.alive + (mask,), extra, tuple(killed), current.size)
+                self.write_manifest(self.state.ids, stamp)
+
+            state = self.state
+            deltas = sum(len(segment) for segment in state.segments[1:])
+            if len(state.segments) > self.max_segments or deltas > self.compact_fraction * len(state.segments[0]):
+                self.compact()
+
+    def compact(self):
+        """Merge the live rows of every segment into one, the overlay is left alone. Called with write_lock held."""
+        state = self.state
+        segment_id = self.new_segment(self.segment_items(state))
+        segment = CorpusColumns(os.path.join(self.folder, str(segment_id)))
+        with self.lock:
+            # rows retired while merging map onto the merged segment by their rank among the live rows
+            current = self.state
+            mask = np.ones(len(segment), dtype=bool)
+            killed = []
+            offset = 0
+            for before, now in zip(state.alive, current.alive):
+                ranks = np.cumsum(before) - 1
+                gone = ranks[np.flatnonzero(before & ~now)] + offset
+                mask[gone] = False
+                killed.extend((segment_id, int(row)) for row in gone)
+                offset += int(before.sum())
+            self.state = CorpusState((segment,), (segment_id,), (mask,), current.extra, tuple(killed), current.size)
+            self.write_manifest(self.state.ids, self.stamp)
+        self.drop_segments(state.ids)
+
+    @staticmethod
+    def segment_items(state, chunk_size=2**16):
+        for segment, mask in zip(state.segments, state.alive):
+            rows = np.flatnonzero(mask)
+            for i in range(0, len(rows), chunk_size):
+                chunk = rows[i:i + chunk_size]
+                yield from zip(segment.paths(chunk), segment.texts(chunk))
+
+    def new_segment(self, items, dead=()):
+        segment_id = self.next_id
+        self.next_id += 1
+        CorpusColumns.write(os.path.join(self.folder, str(segment_id)), items, dead)
+        return segment_id
+
+    def write_manifest(self, ids, stamp):
+        tmp_file = os.path.join(self.folder, 'current.tmp')
+        with open(tmp_file, 'w') as f:
+            f.write(f"{' '.join(map(str, ids))}\n{stamp}")
+        os.replace(tmp_file, os.path.join(self.folder, 'current'))
+        self.stamp = stamp
+
+    def drop_segments(self, ids):
+        # readers still holding an old state keep their mapping, on windows the files stay until the next start
+        for segment_id in ids:
+            shutil.rmtree(os.path.join(self.folder, str(segment_id)), ignore_errors=True)
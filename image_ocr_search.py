@@ -20,48 +20,31 @@ os.environ['RAY_DEDUP_LOGS'] = '0'
 import zhmiscellany
 import time
 from collections import defaultdict
+import queue
 import threading
 import random
-from PIL import Image
 import string
+import hashlib
 
-import zhmiscellanyocr, humanize
+import humanize
 
 splash.set_progress(20, 100, 'Initilizing packages...')
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from utils import image_formats, truncate_path, retry_preprocess_profiles, read_image_size
+from search_index import InvertedIndex, IncrementalSearch, QueryCache
+from ranking import RankingIndex
+from corpus import Corpus
+from query import parse_query, evaluate, is_structured, plan_words, extract_sort
+from store import TextStore
+from indexer import detect_changes, plan_tasks, FileWatcher, WatchEvent, WatchQueue
+from ocr_workers import OCRWorkerPool, OCRPipeline, ThumbnailRenderer
+from thumbnails import ThumbnailCache, LRUDict, fallback_key
+from word_boxes import unpack_words, matching_boxes, focus_region
 
-from utils import image_formats, load_image, analyze_text_probability
-
-from flask import Flask, render_template_string
-from io import BytesIO
-import base64
-
-from rapidfuzz import fuzz
-
-def path_to_text_pipeline(path, index=1, group_index=1):
-    def timeout(timeout):
-        def _timeout(timeout):
-            time.sleep(timeout)
-            zhmiscellany.misc.die()
-        threading.Thread(target=_timeout, args=(timeout,)).start()
-    
-    timeout(30)
-    
-    img = load_image(path)
-    if img is None:
-        return
-
-    #if not analyze_text_probability(img):
-    #    return (path, '')
-
-    text = zhmiscellanyocr.ocr(img, config="--psm 11 --oem 3 -c preserve_interword_spaces=1")
-    
-    if index or total:
-        sys.stdout.write(f'|{sig_string}i{index}|{sig_string}g{group_index}|')
-    return (path, text)
+from flask import Flask, render_template_string, request, Response, abort, jsonify
 
+from rapidfuzz import fuzz, process
+import numpy as np
 
 splash.set_progress(30, 100, 'Waiting on ray to finish initialization...')
 
@@ -96,236 +79,675 @@ file_name = 'chunk_file'
 zhmiscellany.fileio.create_folder(db_folder)
 os.chdir(db_folder)
 
-splash.set_progress(70, 100, 'Reading pickle cluster...')
+splash.set_progress(70, 100, 'Reading text store...')
+
+
+def import_pickle_cluster(store, folder, file_name):
+    """
+    One-time import of the old chunk_file_*.pkl cluster into the text store. The pickles are left
+    on disk untouched, a meta flag stops them from being read again.
+    """
+    if store.get_meta('pickle_cluster_imported'):
+        return 0
+    
+    imported = 0
+    for data_file in zhmiscellany.fileio.abs_listdir(folder):
+        if file_name in os.path.basename(data_file) and data_file.endswith('.pkl'):
+            chunk = zhmiscellany.fileio.load_object_from_file(data_file)
+            imported += store.put_many(chunk.items())
+    
+    store.set_meta('pickle_cluster_imported', 1)
+    return imported
+
 
 # read existing data
 print('Reading data')
-files_text = {}
-for data_file in zhmiscellany.fileio.abs_listdir('.'):
-    if file_name in data_file:
-        files_text.update(zhmiscellany.fileio.load_object_from_file(data_file))
+store = TextStore('text_store.db')
+imported = import_pickle_cluster(store, '.', file_name)
+if imported:
+    print(f'Imported {imported} entries from the pickle cluster')
+    store.compact()
+
+# lowercased texts in a compact memory-mapped corpus, only rebuilt from the store when it changed without the corpus being saved
+corpus = Corpus('corpus')
+if corpus.stamp != store.write_count():
+    print('Rebuilding corpus')
+    corpus.rebuild(((path, text.lower()) for path, text in store.iter_texts() if text), store.write_count())
+
+# result thumbnails, filled lazily at query time and at index time when thumbnails_at_index_time is set
+thumbnail_cache = ThumbnailCache('thumbnails', max_bytes=2**31)
+thumbnails_at_index_time = False
+max_image_size = 2**11  # longest side of the result thumbnails and crops
+# cache misses are decoded on a couple of workers of their own, never in the web server's threads
+thumbnail_renderer = ThumbnailRenderer(processes=2, timeout=15)
 
+# word boxes recorded at OCR time let results show a highlighted crop around the matched words instead of the whole image
+record_word_boxes = True
+result_crops = True
 
-# final gathering of files before assigning tasks
-total = 0
-task_files = []
-for key, value in list(format_paths.items()):
-    for i, file in enumerate(value):
-        if file not in files_text:
-            if os.path.exists(file):
-                if os.path.getsize(file) > 700:  # can filter out alot of files by assuming a file smaller than 700 bytes can't contain any OCRable text
-                    if '\\temp\\' not in file.lower():
-                        task_files.append(file)
-                        total += 1
+# word confidences come with the word boxes, words below min_word_confidence are left out of the indexed text
+min_word_confidence = 40
+# results below reocr_confidence get OCR'd again with retry_preprocess_profiles whenever the indexer is idle for reocr_idle_delay seconds
+reocr_confidence = 60
+reocr_max_retries = 1
+reocr_batch_size = 256
+reocr_idle_delay = 5
+# ranking scores are scaled from confidence_floor at confidence 0 up to 1 at confidence 100
+confidence_floor = 0.5
 
 
+def publish_results(results):
+    """Make freshly OCR'd (path, text) pairs searchable without a restart"""
+    results = [(file, text) for file, text in results if text is not None]  # failures never hide an older result
+    corpus.update((file, text.lower()) for file, text in results if text)
+    corpus.remove([file for file, text in results if not text])
+    search_index.add_documents(results)
+    search_index.set_metadata(store.metadata(file for file, text in results if text))
+    ranking_index.add_documents(results)
+    search_index.touch()  # cached rankings expire once everything above is in
 
 
+def publish_deletions(files):
+    corpus.remove(files)
+    search_index.remove_documents(files)
+    ranking_index.remove_documents(files)
+    search_index.touch()
 
-if task_files:
+
+# non-blocking startup serves the persisted index straight away and digests fresh files in the background,
+# --blocking-startup digests everything before the gui opens
+blocking_startup = '--blocking-startup' in sys.argv
+
+listed_files = [file for value in format_paths.values() for file in value if '\\temp\\' not in file.lower()]
+
+if blocking_startup:
+    # final gathering of files before assigning tasks, only new or changed files get queued
+    changes = detect_changes(store, listed_files, roots=drives)
+    print(f'Change detection: {len(changes.queued)} new or changed, {changes.unchanged} unchanged, {len(changes.touched)} touched, {len(changes.deleted)} deleted')
     
-    splash.set_progress(90, 100, 'Creating tasks...')
+    corpus.remove(changes.deleted)
     
-    print('Creating tasks')
+    # dedup by content hash, identical files share one OCR result
+    splash.set_progress(80, 100, 'Hashing fresh files...')
+    plan = plan_tasks(store, changes)
+    print(f'Deduplication: {len(plan.queued_files)} queued, {len(plan.reused)} reused from the store, {len(plan.task_files)} unique to OCR')
+
+splash.set_progress(85, 100, 'Updating search index...')
+
+print('Updating search index')
+search_index = InvertedIndex('search_index.db')
+added, removed = search_index.sync(corpus)
+search_index.set_metadata(store.metadata(search_index.paths_without_metadata()))
+instant_search = IncrementalSearch(search_index)
+query_cache = QueryCache(search_index)
+print(f'Search index: {added} added, {removed} removed, {len(search_index)} total')
+
+# a matrix saved before the last store writes can hold outdated texts under paths it still has, compare their digests then
+ranking_index = RankingIndex('ranking.npz')
+added, removed = ranking_index.sync(corpus, check_texts=ranking_index.stamp != store.write_count())
+if blocking_startup:
+    # queued files drop their old text until it is re-OCR'd, reused texts go in like the background loop's
+    search_index.remove_documents(plan.queued_files)
+    publish_results(plan.reused)
+    corpus.save(store.write_count())
+ranking_index.save(store.write_count())
+print(f'Ranking index: {added} added, {removed} removed, {len(ranking_index)} total')
+
+
+class IndexProgress:
+    def __init__(self, task_files, total_groups, on_progress=None):
+        self.task_files = task_files
+        self.total = len(task_files)
+        self.total_groups = total_groups
+        self.on_progress = on_progress
+        self.start_time = time.time()
     
-    from utils import truncate_path
+    def update(self, index, group_index):
+        total = self.total
+        start_time = self.start_time
+        eta = humanize.precisedelta((((time.time()-start_time)/index)*total)-(time.time()-start_time))
+        bsn='\n';print(f'{bsn*10}Completed:{bsn}{zhmiscellany.math.smart_percentage(index, total)}%{bsn}{index}/{total}{bsn}{group_index}/{self.total_groups}{bsn*2}Files\s:{bsn}{round(index/(time.time()-start_time), 2)}{bsn*2}ETA:{bsn}{eta}')
+        if self.on_progress is not None:
+            self.on_progress(index, total, f'{truncate_path(self.task_files[index-1], 40)}\nETA: {eta}. {index}/{total}')
+
+
+ocr_pool = None
+ocr_pipeline = None
+retry_pipeline = None
+
+# images the prefilter scores below the threshold skip tesseract and are stored as no_text,
+# check a threshold against a labelled sample with `python utils.py labels.csv <threshold>`
+prefilter_threshold = 0.5
+east_model = None  # path to frozen_east_text_detection.pb enables the EAST detector
+prefilter = {'threshold': prefilter_threshold, 'east_model': east_model}
+
+
+def start_ocr():
+    """
+    Spin up the OCR pool along with the indexing pipeline and the low confidence retry pipeline
+    sharing it. Decoding happens in the pool's workers too, per format family profiles live in
+    utils.preprocess_profiles.
+    """
+    global ocr_pool, ocr_pipeline, retry_pipeline
+    if ocr_pipeline is None:
+        ocr_pool = OCRWorkerPool(timeout=30, word_boxes=record_word_boxes, min_word_confidence=min_word_confidence)
+        thumbnail = (max_image_size, thumbnail_cache.format, thumbnail_cache.quality) if thumbnails_at_index_time else None
+        ocr_pipeline = OCRPipeline(ocr_pool, prefilter=prefilter, thumbnail=thumbnail)
+        retry_pipeline = OCRPipeline(ocr_pool, profiles=retry_preprocess_profiles)
+
+
+def run_tasks(plan, on_progress=None):
+    """OCR the unique files of a TaskPlan through the staged pipeline, persisting and publishing results in groups as they finish"""
+    start_ocr()
+    
+    task_files = list(plan.task_files)
+    random.shuffle(task_files)
     
-    class Capture_Console:
-        def __init__(self):
-            self.sig_string = zhmiscellany.string.get_universally_unique_string()
-            self.peak_index = 0
+    # grouping results for batched writes, the pool itself handles crashes and timeouts per file
+    tolerance_group_size = ocr_pipeline.batch_size
+    total_groups = -(-len(task_files) // tolerance_group_size)
+    progress = IndexProgress(task_files, total_groups, on_progress)
+    
+    def persist_atom(batch):
+        results = []
+        result_dimensions = {}
+        result_words = {}
+        result_confidences = {}
+        for file, text, status, words, confidence, size, thumbnail in batch:
+            if not isinstance(text, str):
+                text, status, words, confidence = None, 'failed', None, None
+            
+            digest = plan.file_hashes.get(file)
+            if thumbnail is not None and digest is not None:
+                thumbnail_cache.put_bytes(digest, max_image_size, thumbnail)
+            
+            # fan results out to every duplicate of the file that was OCR'd
+            for duplicate in plan.duplicates[digest if digest is not None else file]:
+                results.append((duplicate, text, status))
+                if size is not None:
+                    result_dimensions[duplicate] = size
+                if words is not None:
+                    result_words[duplicate] = words
+                if confidence is not None:
+                    result_confidences[duplicate] = confidence
         
-        def write(self, data):
-            if self.sig_string in data:
-                strings = data.split('|')
-                group_index = 1
-                index = 1
-                for st in strings:
-                    if self.sig_string in st:
-                        st = st.replace(self.sig_string, '')
-                        match st[0]:
-                            case 'i':
-                                index = int(st.split('i').pop())
-                            case 'g':
-                                group_index = int(st.split('g').pop())
-                index = max(1, index, self.peak_index)
-                self.peak_index = max(index, self.peak_index)
-                eta = humanize.precisedelta((((time.time()-start_time)/index)*total)-(time.time()-start_time))
-                bsn='\n';print(f'{bsn*10}Completed:{bsn}{zhmiscellany.math.smart_percentage(index, total)}%{bsn}{index}/{total}{bsn}{group_index}/{total_groups}{bsn*2}Files\s:{bsn}{round(index/(time.time()-start_time), 2)}{bsn*2}ETA:{bsn}{eta}')
-                index = min(index, total-1)
-                splash.set_progress(self.peak_index, total, f'{truncate_path(task_files[index], 40)}\nETA: {eta}. {index}/{total}')
-            else:
-                sys.__stdout__.write(data)  # Print normally
+        store.put_many(results, hashes=plan.file_hashes, dimensions=result_dimensions, words=result_words, confidences=result_confidences)
+        publish_results((file, text) for file, text, _ in results)
+    
+    ocr_pipeline.run(task_files, persist_atom, on_result=lambda index, file: progress.update(index, (index - 1) // tolerance_group_size + 1))
+
+
+def retry_low_confidence(on_progress=None):
+    """
+    OCR a batch of low confidence results again with retry_preprocess_profiles, keeping the new
+    result wherever it came out more confident. Stops handing out files as soon as a watcher
+    event is waiting, so retries never hold up fresh files. Returns how many files were retried.
+    """
+    paths = store.low_confidence(reocr_confidence, reocr_max_retries, reocr_batch_size)
+    if not paths:
+        return 0
+    start_ocr()
+    
+    previous = {row[0]: row[-1] for row in store.metadata(paths)}
+    hashes = store.hashes_for_paths(paths)
+    
+    def persist_atom(batch):
+        results = []
+        result_hashes = {}
+        result_words = {}
+        result_confidences = {}
+        retried = []
+        for file, text, status, words, confidence, _, _ in batch:
+            # the retry covers every copy of the content
+            copies = store.paths_for_hash(hashes[file]) if file in hashes else [file]
+            retried.extend(copies)
+            if not isinstance(text, str) or confidence is None or confidence <= (previous.get(file) or 0):
+                continue
+            for copy in copies:
+                results.append((copy, text, status))
+                result_confidences[copy] = confidence
+                if file in hashes:
+                    result_hashes[copy] = hashes[file]
+                if words is not None:
+                    result_words[copy] = words
         
-        def flush(self):
-            sys.__stdout__.flush()
+        if results:
+            store.put_many(results, hashes=result_hashes, words=result_words, confidences=result_confidences)
+            publish_results((file, text) for file, text, _ in results)
+        store.count_retries(retried)
     
-    cc = Capture_Console()
-    sys.stdout = cc
-    sig_string = cc.sig_string
+    return retry_pipeline.run(paths, persist_atom, on_result=on_progress, stop=lambda: not index_queue.empty())
+
+
+index_queue = WatchQueue()
+
+
+def backfill_dimensions(batch_size=2**10):
+    """
+    One-time read of the image headers of results stored without pixel dimensions (from before
+    the metadata filters, or reused by hash before dimensions were copied along), so width: and
+    height: filters see them. Files PIL can't identify stay without until they get OCR'd again.
+    """
+    if store.get_meta('dimensions_backfilled'):
+        return 0
     
-    random.shuffle(task_files)
-    # creating tasks
-    tasks = []
-    for i, file in enumerate(task_files, start=1):
-        tasks.append((path_to_text_pipeline, [file, i, 0]))
-    
-    start_time = time.time()
-    
-    # grouping tasks for better fault tolerance
-    tolerance_group_size = 64
-    tolerance_groups = zhmiscellany.list.split_into_sublists(tasks, tolerance_group_size)
-    total_groups = len(tolerance_groups)
-    
-    # processing tasks
-    grouped_results = []
-    for i, group in enumerate(tolerance_groups):
-        # update group with group indexes
-        for j, _ in enumerate(group):
-            group[j][1][2] = i
+    filled = 0
+    paths = store.paths_without_dimensions()
+    for i in range(0, len(paths), batch_size):
+        sizes = [(path, read_image_size(path)) for path in paths[i:i + batch_size]]
+        sizes = [(path, *size) for path, size in sizes if size is not None]
+        store.set_dimensions(sizes)
+        search_index.set_metadata(store.metadata(path for path, _, _ in sizes))
+        filled += len(sizes)
+    
+    store.set_meta('dimensions_backfilled', 1)
+    return filled
+
+
+def indexing_loop(on_status=None):
+    """
+    Background scheduler consuming the startup rescan and FileWatcher events, OCRing new and
+    modified images while the GUI serves queries. on_status receives progress lines for the status bar.
+    """
+    def status(text):
+        if on_status is not None:
+            on_status(text)
+    
+    def progress(current, total, text):
+        status(f'Indexing... {text.splitlines()[-1]}')
+    
+    try:
+        filled = backfill_dimensions()
+        if filled:
+            print(f'Read the dimensions of {filled} files stored without them')
+    except Exception as e:
+        print(f'Dimension backfill failed: {e}')
+    
+    retry_pending = True
+    while True:
+        try:
+            # the queue staying quiet means the pool is idle, which is when low confidence results get another go
+            event = index_queue.get(timeout=reocr_idle_delay if retry_pending else None)
+        except queue.Empty:
+            try:
+                retried = retry_low_confidence(lambda index, file: status(f'Re-OCRing low confidence results... {index}'))
+            except Exception as e:
+                print(f'Low confidence retry failed: {e}')
+                retried = 0
+            retry_pending = retried > 0
+            if not retry_pending:
+                ranking_index.save(store.write_count())
+                corpus.save(store.write_count())
+                status(f'{len(corpus)} files indexed')
+            continue
         
-        # create result mask
-        group_files = [task[1][0] for task in group]
-        result_files_text = {}
-        for file in group_files:
-            result_files_text[file] = None
+        retry_pending = True
+        try:
+            if event.kind == 'deleted':
+                store.tombstone(event.paths)
+                publish_deletions(event.paths)
+                continue
+            
+            status('Checking for fresh files...')
+            paths = [file for file in event.paths if '\\temp\\' not in file.lower()]
+            changes = detect_changes(store, paths, roots=drives if event.kind == 'rescan' else [])
+            publish_deletions(changes.deleted)
+            plan = plan_tasks(store, changes)
+            publish_results(plan.reused)
+            if plan.task_files:
+                print(f'Background indexing {len(plan.task_files)} files')
+                status(f'Indexing {len(plan.task_files)} fresh files...')
+                run_tasks(plan, on_progress=progress)
+        except Exception as e:
+            print(f'Background indexing failed: {e}')
         
-        processed_chunk = zhmiscellany.processing.batch_multiprocess(group, expect_crashes=True)
+        if index_queue.empty():
+            ranking_index.save(store.write_count())
+            corpus.save(store.write_count())
+            status(f'{len(corpus)} files indexed')
+
+
+if blocking_startup:
+    if plan.task_files:
         
-        # update mask
-        for pair in processed_chunk:
-            if pair is not None:
-                file = pair[0]
-                text = pair[1]
-                if isinstance(text, str):
-                    result_files_text[file] = text
+        splash.set_progress(90, 100, 'Creating tasks...')
         
-        zhmiscellany.fileio.save_object_to_file(result_files_text, f'{file_name}_{zhmiscellany.string.get_universally_unique_string()}.pkl')
+        print('Creating tasks')
         
-        # update final dict
-        for file, text in list(result_files_text.items()):
-            if not file in files_text:
-                files_text[file] = text
-            elif files_text[file] is None and text is not None:
-                files_text[file] = text
-
-splash.set_progress(100, 100, 'Formatting data...')
-
-print('Formating data')
-all_files = []
-for file_path, text_content in files_text.items():
-    if text_content is not None:
-        if text_content != '':
-            all_files.append((file_path, text_content.lower()))
+        run_tasks(plan, on_progress=splash.set_progress)
+else:
+    # the indexing loop diffs the listing against the store once the gui is up
+    index_queue.put(WatchEvent('rescan', listed_files))
 
 splash.set_progress(100, 100, 'Creating gui...')
 
 print('Creating GUI')
 
 
-def search_results_TF_IDF(search, all_files, output_limit):
-    # Extract texts for TF-IDF calculation
-    texts = [doc[1] for doc in all_files]  # Extract only the text for TF-IDF
-    all_texts = [search] + texts
-    
-    # Compute TF-IDF
-    vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform(all_texts)
-    
-    # Calculate cosine similarity between search string and documents
-    search_vector = tfidf_matrix[0]  # TF-IDF vector for the search string
-    document_vectors = tfidf_matrix[1:]  # TF-IDF vectors for the documents
-    scores = cosine_similarity(search_vector, document_vectors).flatten()
-    
-    # Attach scores to the original tuples (metadata, text, score)
-    scored_docs = [(doc[0], doc[1], score) for doc, score in zip(all_files, scores)]
+class SearchCancelled(Exception):
+    pass
+
+
+def check_cancelled(cancelled):
+    """cancelled is a threading.Event set once a newer query supersedes this one"""
+    if cancelled is not None and cancelled.is_set():
+        raise SearchCancelled
+
+
+def score_chunked(search, chunks, cancelled=None, score_cutoff=80):
+    """
+    partial_ratio of search against (paths, texts) chunks on rapidfuzz's native threads,
+    checking for cancellation between chunks. Keeps files scoring above score_cutoff.
+    """
+    results = []
+    for paths, texts in chunks:
+        check_cancelled(cancelled)
+        scores = process.cdist([search], texts, scorer=fuzz.partial_ratio, score_cutoff=score_cutoff, workers=-1)[0]
+        results.extend((paths[j], texts[j], float(scores[j])) for j in np.flatnonzero(scores > score_cutoff))
+    return results
+
+
+def text_chunks(paths, chunk_size=2**16):
+    """(paths, texts) chunks for the given paths, dropping any the corpus has no text for"""
+    for i in range(0, len(paths), chunk_size):
+        chunk = [(path, corpus.get(path)) for path in paths[i:i + chunk_size]]
+        chunk = [(path, text) for path, text in chunk if text]
+        yield [path for path, _ in chunk], [text for _, text in chunk]
+
+
+def index_candidates(search, exact=False):
+    candidates = search_index.candidates(search, exact=exact)
+    if candidates is None:  # the postings narrow nothing down (common words, nothing searchable), fall back to a full scan
+        return corpus.chunks()
+    return text_chunks(candidates)
+
+
+def confidence_weighted(results):
+    """
+    Scale (path, text, score) results by OCR confidence, so garbage OCR of photos and textures sinks below clean text.
+    Files without a confidence (OCR'd without word boxes) are weighted like the median file rather than like perfect OCR.
+    """
+    confidences = search_index.confidences(path for path, _, _ in results)
+    median = search_index.median_confidence()
+    unknown = 100 if median is None else median
+    return [
+        (path, text, score * (confidence_floor + (1 - confidence_floor) * confidences.get(path, unknown) / 100))
+        for path, text, score in results
+    ]
+
+
+def search_results_fuzzy_search(search, cancelled=None):
+    search = search.lower()
     
-    # Rank documents by relevance
-    ranked_docs = sorted(scored_docs, key=lambda x: x[2], reverse=True)
+    # scored in this process on every core, the corpus never gets pickled out to workers
+    results = score_chunked(search, index_candidates(search), cancelled)
+    results = confidence_weighted(results)
     
-    ranked_docs = [each for each in ranked_docs if each[2] > 0]
-    ranked_docs = ranked_docs[:output_limit]
-    return ranked_docs
+    results = sorted(results, key=lambda x: x[2], reverse=True)
+    return results
 
 
-def search_results_fuzzy_search(search, all_files, output_limit):
+def search_results_exact_search(search, cancelled=None):
+    search = search.lower()
+    
     results = []
+    for paths, texts in index_candidates(search, exact=True):
+        check_cancelled(cancelled)
+        results.extend((path, text, 100) for path, text in zip(paths, texts) if search in text)
     
-    search = search.lower()
+    return results
+
+
+def search_results_ranked(search, method='bm25', cancelled=None):
+    """TF-IDF cosine or BM25 over the prebuilt ranking index, only the query gets vectorised"""
+    results = ranking_index.search(search, method)
+    check_cancelled(cancelled)
+    results = confidence_weighted([(path, corpus.get(path, ''), score) for path, score in results])
+    return sorted(results, key=lambda x: x[2], reverse=True)
+
+
+def search_results_query(search, cancelled=None):
+    """Boolean, phrase and field queries, narrowed down over the postings and metadata before any text gets scored"""
+    search, sort = extract_sort(search)
+    plan = parse_query(search)
+    if plan is None and sort is None:
+        return []
+    docs = search_index.all_docs() if plan is None else evaluate(plan, search_index)
+    check_cancelled(cancelled)
     
-    def engine_atom(files):
-        for file in files:
-            score = fuzz.partial_ratio(search, file[1])
-            if score > 80:
-                results.append((*file, score))
-        return results
+    # sort:date and friends order by the metadata side-index alone, no image or text is touched
+    if sort is not None:
+        paths = search_index.sorted_paths(docs, *sort)
+        return [(path, text, 100) for paths, texts in text_chunks(paths) for path, text in zip(paths, texts)]
     
-    num_groups = 32
+    paths = search_index.paths_for_docs(docs)
+    words = plan_words(plan)
+    if not words:  # only metadata filters, nothing to order by
+        return [(path, text, 100) for paths, texts in text_chunks(paths) for path, text in zip(paths, texts)]
     
-    file_groups = zhmiscellany.list.split_into_n_groups(all_files, num_groups)
+    # every hit already satisfies the query, the mean partial_ratio of its words only orders them
+    results = []
+    for paths, texts in text_chunks(paths):
+        check_cancelled(cancelled)
+        scores = process.cdist(words, texts, scorer=fuzz.partial_ratio, workers=-1).mean(axis=0)
+        results.extend(zip(paths, texts, scores.tolist()))
+    results = confidence_weighted(results)
     
-    tasks = [(engine_atom, (files,)) for files in file_groups]
+    results = sorted(results, key=lambda x: x[2], reverse=True)
+    return results
 
-    results = zhmiscellany.processing.batch_multiprocess(tasks, flatten=True)
+
+def search_results_instant(search, cancelled=None):
+    """Search-as-you-type, matching whole words plus the prefix of the word being typed"""
+    candidates = instant_search.candidates(search, corpus)
+    if candidates is None:
+        return []
+    check_cancelled(cancelled)
+    
+    # every candidate already holds the words as typed, partial_ratio only orders them, scored
+    # over the snippet around the match rather than the whole text
+    query = search.lower().strip()
+    results = []
+    for paths, texts in text_chunks(candidates):
+        check_cancelled(cancelled)
+        scores = process.cdist([query], instant_search.snippets(search, texts), scorer=fuzz.partial_ratio, workers=-1)[0]
+        results.extend((paths[j], texts[j], float(scores[j])) for j in np.flatnonzero(scores > 0))
     
     results = sorted(results, key=lambda x: x[2], reverse=True)
-    results = results[:output_limit]
     return results
 
 
-def search_engine(text_input):
-    global engine_time
+def collapse_duplicates(ranked_data, seen=None):
+    """Show byte-identical files once, listing the other paths sharing the content hash"""
+    hashes = store.hashes_for_paths([data[0] for data in ranked_data])
+    seen = set() if seen is None else seen
+    collapsed = []
+    for data in ranked_data:
+        digest = hashes.get(data[0])
+        if digest is None:
+            collapsed.append((*data, []))
+            continue
+        if digest in seen:
+            continue
+        seen.add(digest)
+        collapsed.append((*data, [path for path in store.paths_for_hash(digest) if path != data[0]]))
+    return collapsed
+
+
+def thumbnail_keys(paths):
+    """Thumbnail cache keys for result paths, the content hash where the store has one"""
+    keys = store.hashes_for_paths(paths)
+    for path in paths:
+        if path not in keys:
+            try:
+                keys[path] = fallback_key(path)
+            except OSError:
+                pass
+    return keys
+
+
+def highlight_text(query):
+    """The words of a query worth highlighting in the results, without its syntax and filters"""
+    if len(query) > 2 and query.startswith('"') and query.endswith('"'):
+        return query[1:-1]
+    if is_structured(query):
+        plan = parse_query(extract_sort(query)[0])
+        return ' '.join(plan_words(plan)) if plan is not None else ''
+    return query
+
+
+def crop_key(thumb_id, region, boxes):
+    """Id of a highlighted crop, like thumbnail ids it's derived from the content so a given url never changes"""
+    digest = hashlib.blake2b(f'{thumb_id}|{region}'.encode('utf-8'), digest_size=16)
+    digest.update(np.ascontiguousarray(boxes).tobytes())
+    return digest.hexdigest()
+
+
+def hit_image(path, thumb_id, highlight):
+    """Url of a hit's image, a highlighted crop around the words matching highlight where the file has word boxes"""
+    if result_crops and highlight:
+        blob = store.words(path)
+        if blob is not None:
+            words, boxes, _ = unpack_words(blob)
+            matched = matching_boxes(words, boxes, highlight)
+            region = focus_region(matched)
+            if region is not None:
+                crop_id = crop_key(thumb_id, region, matched)
+                crop_regions[crop_id] = (path, region, matched)
+                return f'/crop/{crop_id}'
+    return f'/thumb/{thumb_id}'
+
+
+class ResultSession:
+    """
+    Ranked (path, score) hits of one query. Hits are collapsed, labelled and given thumbnail ids
+    a page at a time as the results page asks for them, so nothing past what's on screen is prepared.
+    """
     
-    def ensure_max_size(img, max_width, max_height):
-        """Resize image if it exceeds max dimensions while maintaining aspect ratio."""
-        if img.width > max_width or img.height > max_height:
-            img.thumbnail((max_width, max_height), Image.LANCZOS)  # Resizes in-place
-        return img
+    def __init__(self, query, engine, ranked_data, engine_time, cached=False):
+        self.query = query
+        self.engine = engine
+        self.highlight = highlight_text(query)
+        self.ranked_data = ranked_data
+        self.engine_time = engine_time
+        self.cached = cached
+        self.position = 0
+        self.seen = set()
+        self.hits = []
+        self.lock = threading.Lock()
     
-    zhmiscellany.misc.time_it(None)
-    zhmiscellany.misc.time_it(None, 'all')
+    def page(self, number, page_size=64):
+        """Returns (hits, has_more) for page number, hits being {'id', 'src', 'label'} dicts"""
+        end = (number + 1) * page_size
+        with self.lock:
+            while len(self.hits) < end and self.position < len(self.ranked_data):
+                chunk = self.ranked_data[self.position:self.position + page_size]
+                self.position += len(chunk)
+                
+                chunk = collapse_duplicates(chunk, self.seen)
+                
+                # images are fetched by the page from /thumb/<id>, only register which file each id refers to
+                keys = thumbnail_keys([data[0] for data in chunk])
+                for data in chunk:
+                    if data[0] in keys:
+                        thumb_paths[keys[data[0]]] = data[0]
+                        label = f'{round(data[1], 2)} conf {data[0]}'
+                        if data[2]:
+                            label += f' (+{len(data[2])} copies: {", ".join(data[2])})'
+                        self.hits.append({'id': keys[data[0]], 'src': hit_image(data[0], keys[data[0]], self.highlight), 'label': label})
+            
+            has_more = len(self.hits) > end or self.position < len(self.ranked_data)
+            return self.hits[number * page_size:end], has_more
+
+
+search_engines = ('fuzzy', 'exact', 'query', 'bm25', 'tfidf')
+default_engine = 'fuzzy'
+
+
+def search_engine(text_input, cancelled=None, engine=None):
+    """
+    Rank text_input against every indexed file and register the session for the web view. Raises
+    SearchCancelled if the cancelled event gets set before the ranking is done.
     
-    output_limit = 2**7
+    engine is one of search_engines, or 'instant' for search-as-you-type which only goes
+    through the token postings. Left as None, quoted queries are exact, queries using the query
+    language (AND/OR/NOT, -exclusions, "phrases" among other words, ext:, path:, size:, date:,
+    width:, height: and confidence: filters, sort:) go to 'query' and the rest use default_engine.
+    Fuzzy, query and ranked scores are scaled by the OCR confidence of each file.
+    """
+    global engine_time
     
-    #ranked_data = search_results_TF_IDF(text_input, all_files, output_limit)
-    ranked_data = search_results_fuzzy_search(text_input, all_files, output_limit)
+    zhmiscellany.misc.time_it(None)
+    zhmiscellany.misc.time_it(None, 'all')
     
-    engine_time = zhmiscellany.misc.time_it('Search engine')
+    quoted = len(text_input) > 2 and text_input.startswith('"') and text_input.endswith('"')
+    if engine is None:
+        engine = 'exact' if quoted else 'query' if is_structured(text_input) else default_engine
     
-    def load_atom(data):
-        img = load_image(data[0])
-        if img is not None:
-            img = ensure_max_size(img, max_image_size, max_image_size)
-            img = pil_to_data(img)
-            return (img, f'{round(data[2], 2)} conf {data[0]}')
+    # repeated queries come straight from the cache until the background indexer changes the index
+    generation = search_index.generation
+    ranked_data = query_cache.get(text_input, engine)
+    cached = ranked_data is not None
+    if not cached:
+        if engine == 'instant':
+            ranked_data = search_results_instant(text_input, cancelled)
+        elif engine == 'exact':
+            ranked_data = search_results_exact_search(text_input[1:-1] if quoted else text_input, cancelled)
+        elif engine == 'query':
+            ranked_data = search_results_query(text_input, cancelled)
+        elif engine in ('bm25', 'tfidf'):
+            ranked_data = search_results_ranked(text_input, engine, cancelled)
         else:
-            return None
-    
-    tasks = [(load_atom, (data,)) for data in ranked_data]
-    
-    images_text = zhmiscellany.processing.batch_multiprocess(tasks, expect_crashes=True)
-    images_text = [each for each in images_text if each is not None]
+            ranked_data = search_results_fuzzy_search(text_input, cancelled)
+        # sessions and the cache only need the order, holding on to every text would pin the corpus in memory
+        ranked_data = [(path, score) for path, _, score in ranked_data]
     
-    image_read = zhmiscellany.misc.time_it('Reading images')
+    engine_time = zhmiscellany.misc.time_it('Search engine')
+    check_cancelled(cancelled)
+    if not cached:
+        query_cache.put(text_input, engine, ranked_data, generation)
     
-    return images_text
+    session = ResultSession(text_input, engine, ranked_data, engine_time, cached)
+    sessions[text_input, engine] = session
+    return session
+
+
+def get_session(query, engine):
+    """
+    Session of a search the app already ran, None if there's none (or it was evicted). The web
+    view only pages through finished searches, it never runs one itself, so a request can't
+    start a second full ranking next to the app's or change what the app is showing.
+    """
+    return sessions.get((query, engine))
 
 
-# Assume images_text is a list of (PIL_image, "some text") tuples
-images_text = []
+# (query, engine) -> ResultSession of the most recent searches
+sessions = LRUDict(2**4)
 
+# thumbnail id -> path of the file it was made from, for the most recently handed out ids.
+# older ids still load while their thumbnail is in thumbnail_cache
+thumb_paths = LRUDict(2**16)
 
-def pil_to_data(img):
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+# crop id -> (path, region, highlighted boxes) of the crops recently handed out by hit_image
+crop_regions = LRUDict(2**14)
 
 
 app = Flask(__name__)
 
 
+page_size = 2**6
+
+
 @app.route('/')
 def index():
+    query = request.args.get('q')
+    engine = request.args.get('engine', '')
+    session = get_session(query, engine) if query else None
+    if session is not None:
+        hits, has_more = session.page(0, page_size)
+    else:
+        hits, has_more = [], False
+    
     html = """
     <html>
     <head>
@@ -345,43 +767,164 @@ def index():
           height: auto;
           display: block;
         }
+        img:not(.loaded) {
+          /* placeholder size so lazy loading only fetches what's near the viewport */
+          width: 256px;
+          height: 256px;
+          background: #F5F5F5;
+        }
         .text-container {
           overflow: hidden;
           text-overflow: ellipsis;
           white-space: nowrap;
         }
+        #sentinel {
+          width: 100%;
+          height: 1px;
+        }
       </style>
       <script>
-        // Set text width to match image width after images load
-        window.onload = function() {
-          const items = document.querySelectorAll('.item');
-          items.forEach(item => {
-            const img = item.querySelector('img');
-            const textContainer = item.querySelector('.text-container');
-            // Set text container width to match the actual image width
-            textContainer.style.width = img.offsetWidth + 'px';
-          });
+        const query = {{ query|tojson }};
+        const engine = {{ engine|tojson }};
+        let next_page = 1;
+        let has_more = {{ has_more|tojson }};
+        let loading = false;
+        
+        // Set text width to match image width as each image loads
+        function on_image_load(img) {
+          img.classList.add('loaded');
+          const textContainer = img.parentElement.querySelector('.text-container');
+          // Set text container width to match the actual image width
+          textContainer.style.width = img.offsetWidth + 'px';
+        }
+        
+        function add_hits(hits) {
+          const sentinel = document.getElementById('sentinel');
+          for (const hit of hits) {
+            const item = document.createElement('div');
+            item.className = 'item';
+            const img = document.createElement('img');
+            img.alt = 'Image';
+            img.loading = 'lazy';
+            img.onload = () => on_image_load(img);
+            img.src = hit.src;
+            const text = document.createElement('div');
+            text.className = 'text-container';
+            text.title = hit.label;
+            text.textContent = hit.label;
+            item.appendChild(img);
+            item.appendChild(text);
+            sentinel.before(item);
+          }
         }
+        
+        // Fetch the next page of hits whenever the end of the results scrolls into view
+        async function load_more() {
+          if (loading || !has_more) return;
+          loading = true;
+          const response = await fetch('/api/search?q=' + encodeURIComponent(query) + '&engine=' + encodeURIComponent(engine) + '&page=' + next_page);
+          if (!response.ok) { loading = false; has_more = false; return; }
+          const data = await response.json();
+          add_hits(data.hits);
+          has_more = data.has_more;
+          next_page += 1;
+          loading = false;
+          if (has_more && document.getElementById('sentinel').getBoundingClientRect().top < window.innerHeight * 2) load_more();
+        }
+        
+        window.addEventListener('DOMContentLoaded', () => {
+          const container = document.querySelector('.container');
+          const observer = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) load_more();
+          }, {root: container, rootMargin: '1000px'});
+          observer.observe(document.getElementById('sentinel'));
+        });
       </script>
     </head>
     <body>
       <div class="container">
-        {% for img, text in items %}
+        {% for hit in hits %}
         <div class="item">
-          <img src="data:image/png;base64,{{ img }}" alt="Image">
-          <div class="text-container" title="{{ text }}">{{ text }}</div>
+          <img src="{{ hit.src }}" alt="Image" loading="lazy" onload="on_image_load(this)">
+          <div class="text-container" title="{{ hit.label }}">{{ hit.label }}</div>
         </div>
         {% endfor %}
+        <div id="sentinel"></div>
       </div>
     </body>
     </html>
     """
-    return render_template_string(html, items=images_text)
+    return render_template_string(html, hits=hits, has_more=has_more, query=query or '', engine=engine)
+
+
+@app.route('/api/search')
+def api_search():
+    """Paged JSON results of a search the app ran, ?q=<query>&engine=<engine>&page=<n>[&page_size=<n>]"""
+    query = request.args.get('q', '')
+    engine = request.args.get('engine', '')
+    page = request.args.get('page', 0, type=int)
+    size = min(request.args.get('page_size', page_size, type=int), 2**10)
+    
+    session = get_session(query, engine)
+    if session is None:
+        abort(404)
+    hits, has_more = session.page(page, size)
+    return jsonify({
+        'query': query,
+        'page': page,
+        'hits': hits,
+        'has_more': has_more,
+        'ranked': len(session.ranked_data),
+        'engine_time': session.engine_time,
+    })
+
+
+@app.route('/thumb/<thumb_id>')
+def thumb(thumb_id):
+    # ids are content hashes (or path/size/mtime digests), so a given url never changes content
+    etag = f'"{thumb_id}_{max_image_size}"'
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+    
+    data = thumbnail_cache.get(thumb_id, max_image_size)
+    if data is None:
+        path = thumb_paths.get(thumb_id)
+        if path is None:
+            abort(404)
+        data = thumbnail_renderer.render(thumb_id, path, (max_image_size, thumbnail_cache.format, thumbnail_cache.quality))
+        if data is None:
+            abort(404)
+        thumbnail_cache.put_bytes(thumb_id, max_image_size, data)
+    
+    return Response(data, mimetype='image/webp' if thumbnail_cache.format == 'WEBP' else 'image/jpeg', headers=headers)
+
+
+@app.route('/crop/<crop_id>')
+def crop(crop_id):
+    # a crop of max_image_size around the matched words sends far fewer bytes than the full image would
+    etag = f'"{crop_id}_{max_image_size}"'
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+    
+    data = thumbnail_cache.get(crop_id, max_image_size)
+    if data is None:
+        entry = crop_regions.get(crop_id)
+        if entry is None:
+            abort(404)
+        path, region, boxes = entry
+        data = thumbnail_renderer.render(crop_id, path, (max_image_size, thumbnail_cache.format, thumbnail_cache.quality), region, boxes)
+        if data is None:
+            abort(404)
+        thumbnail_cache.put_bytes(crop_id, max_image_size, data)
+    
+    return Response(data, mimetype='image/webp' if thumbnail_cache.format == 'WEBP' else 'image/jpeg', headers=headers)
 
 
 import sys
-from PyQt5.QtCore import QUrl
-from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QLabel, QSizePolicy
+from PyQt5.QtCore import QUrl, QUrlQuery, QThread, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QLabel, QSizePolicy, QCheckBox, QComboBox
 from PyQt5.QtWebEngineWidgets import QWebEngineView
 
 port = 50179
@@ -389,9 +932,40 @@ port = 50179
 renderer_url = f'http://127.0.0.1:{port}'
 
 
+class SearchWorker(QThread):
+    """Runs one query off the gui thread, results_ready or failed (with the error) only fire if it wasn't cancelled"""
+    results_ready = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    
+    def __init__(self, query, engine=None, parent=None):
+        super().__init__(parent)
+        self.query = query
+        self.engine = engine
+        self.cancelled = threading.Event()
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def run(self):
+        try:
+            session = search_engine(self.query, self.cancelled, self.engine)
+        except SearchCancelled:
+            return
+        except Exception as e:
+            print(f'Search failed: {e}')
+            if not self.cancelled.is_set():
+                self.failed.emit(str(e))
+            return
+        self.results_ready.emit(session)
+
+
 class page_renderer(QWidget):
+    index_status_changed = pyqtSignal(str)  # emitted from the indexing thread
+    
     def __init__(self):
         super().__init__()
+        self.session = None
+        self.search_worker = None
         self.initUI()
     
     def initUI(self):
@@ -413,12 +987,37 @@ class page_renderer(QWidget):
         self.status_bar.setMaximumHeight(self.search_bar.sizeHint().height())  # Match input field height
         self.status_bar.setAlignment(Qt.AlignVCenter)  # Keep text centered
         
+        # Background indexing progress
+        self.index_status = QLabel('', self)
+        self.index_status.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.index_status.setMaximumHeight(self.search_bar.sizeHint().height())
+        self.index_status.setAlignment(Qt.AlignVCenter)
+        self.index_status.setStyleSheet("color: #666666;")
+        self.index_status_changed.connect(self.update_index_status)
+        
         self.search_bar.returnPressed.connect(self.run_search)
         
+        # search as you type, debounced so a fast typist only triggers a query once they pause
+        self.instant_toggle = QCheckBox('As you type', self)
+        self.instant_toggle.setChecked(True)
+        self.typing_timer = QTimer(self)
+        self.typing_timer.setSingleShot(True)
+        self.typing_timer.setInterval(150)
+        self.typing_timer.timeout.connect(lambda: self.run_search(instant=True))
+        self.search_bar.textEdited.connect(self.on_text_edited)
+        
+        # ranking used when enter is pressed, quoted queries stay exact under fuzzy
+        self.engine_select = QComboBox(self)
+        self.engine_select.addItems(search_engines)
+        self.engine_select.setCurrentText(default_engine)
+        
         # Button layout
         nav_layout = QHBoxLayout()
         nav_layout.addWidget(self.search_bar)
+        nav_layout.addWidget(self.engine_select)
+        nav_layout.addWidget(self.instant_toggle)
         nav_layout.addWidget(self.status_bar)
+        nav_layout.addWidget(self.index_status)
         
         # Main layout
         layout = QVBoxLayout()
@@ -427,37 +1026,77 @@ class page_renderer(QWidget):
         
         self.setLayout(layout)
     
-    def run_search(self):
-        global images_text
+    def on_text_edited(self, text):
+        if self.instant_toggle.isChecked():
+            self.typing_timer.start()
+    
+    def run_search(self, instant=False):
+        self.typing_timer.stop()
         search_text = self.search_bar.text()
         
+        # a new query supersedes whatever is still running
+        if self.search_worker is not None:
+            self.search_worker.cancel()
+        
         self.update_status_bar('Searching...')
-        images_text = search_engine(search_text)
+        engine = self.engine_select.currentText()
+        if instant:
+            engine = 'instant'
+        elif engine == default_engine:
+            engine = None
+        worker = SearchWorker(search_text, engine, self)
+        worker.results_ready.connect(self.show_results)
+        worker.failed.connect(self.show_error)
+        worker.finished.connect(worker.deleteLater)
+        self.search_worker = worker
+        worker.start()
+    
+    def show_results(self, session):
+        # a superseded worker can still finish between its last cancellation check and emitting
+        if self.sender() is not self.search_worker:
+            return
+        self.session = session
         
+        # the page renders the first hits itself and pulls the rest from /api/search as it scrolls
         self.update_status_bar('Rendering...')
-        self.webview.load(QUrl(renderer_url))
+        url = QUrl(renderer_url)
+        url.setQuery(QUrlQuery([('q', session.query), ('engine', session.engine)]))
+        self.webview.load(url)
+    
+    def show_error(self, error):
+        if self.sender() is not self.search_worker:
+            return
+        self.update_status_bar(f'Search failed: {error}')
     
     def update_status_bar(self, q):
         self.status_bar.setText(q)
         QApplication.processEvents()
     
+    def update_index_status(self, q):
+        self.index_status.setText(q)
+        self.index_status.adjustSize()
+    
     def on_load_finished(self):
         zhmiscellany.misc.time_it('Rendering')
         total_time = zhmiscellany.misc.time_it('all', 'all')
-        if total_time > 0.0:
-            self.update_status_bar(f'{len(images_text)} results in {round(engine_time, 1)}s')
+        if total_time > 0.0 and self.session is not None:
+            cached = ' (cached)' if self.session.cached else ''
+            self.update_status_bar(f'{len(self.session.ranked_data)} results in {round(self.session.engine_time, 1)}s{cached}')
         else:
             self.update_status_bar(self.default_status)
 
 
 if __name__ == '__main__':
-    max_image_size = 2**11
-    
     zhmiscellany.processing.start_daemon(target=app.run, kwargs={"port": port})
+    
     app = QApplication(sys.argv)
     renderer = page_renderer()
     renderer.show()
     
+    # keep indexing in the background while the gui is up
+    zhmiscellany.processing.start_daemon(target=indexing_loop, kwargs={"on_status": renderer.index_status_changed.emit})
+    watcher = FileWatcher(drives, index_queue.put, list_files=zhmiscellany.fileio.list_files_recursive_cache_optimised_multiprocessed, extensions=dot_image_formats, rescan_pending=index_queue.has_rescan, paths_under=store.paths_under).start()
+    
     try:
         splash.destroy()
     except RuntimeError:
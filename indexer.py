@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+import queue
+import hashlib
+import threading
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+Changes = namedtuple('Changes', ['queued', 'unchanged', 'touched', 'deleted'])
+
+
+def content_hash(path, chunk_size=2**20):
+    """Fast hash of the file bytes, xxh3 when available and blake2b otherwise"""
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_files(paths, workers=16):
+    """Hash many files on a thread pool, the work is I/O bound. Unreadable files are left out."""
+    def hash_atom(path):
+        try:
+            return path, content_hash(path)
+        except OSError:
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return {path: digest for path, digest in executor.map(hash_atom, paths) if digest is not None}
+
+
+def under_roots(path, roots):
+    path = os.path.normcase(path)
+    return any(path.startswith(os.path.normcase(root)) for root in roots)
+
+
+def detect_changes(store, paths, roots=None, verify_hash=True):
+    """
+    Diff a fresh listing of paths against the signatures recorded in the store.
+
+    Returns Changes where queued holds (path, stat) pairs that are new or whose
+    (size, mtime, inode) moved, unchanged is a count, touched holds files that only had their
+    mtime or inode bumped but still hash the same (so don't need OCR again), and deleted holds
+    indexed paths that vanished from under the scanned roots.
+    """
+    signatures = store.signatures()
+
+    queued = []
+    touched = []
+    unchanged = 0
+    listed = set()
+    for path in paths:
+        listed.add(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        old = signatures.get(path)
+        if old is None:
+            queued.append((path, st))
+            continue
+
+        size, mtime, inode, digest = old
+        if size is None:  # rows imported from the pickle cluster never had a signature, adopt the current one
+            touched.append((path, st.st_size, st.st_mtime, st.st_ino))
+        elif (size, mtime, inode) == (st.st_size, st.st_mtime, st.st_ino):
+            unchanged += 1
+        elif verify_hash and digest is not None and size == st.st_size and content_hash(path) == digest:
+            touched.append((path, st.st_size, st.st_mtime, st.st_ino))
+        else:
+            queued.append((path, st))
+
+    # paths outside the scanned roots (an unplugged drive) are kept, not tombstoned
+    deleted = [path for path in signatures if path not in listed and (roots is None or under_roots(path, roots))]
+    return Changes(queued, unchanged, touched, deleted)
+
+
+TaskPlan = namedtuple('TaskPlan', ['queued_files', 'reused', 'task_files', 'file_hashes', 'duplicates'])
+
+
+def plan_tasks(store, changes, min_size=700):
+    """
+    Apply the bookkeeping side of a change set to the store and work out what still needs OCR.
+
+    Identical files are grouped by content hash so only one of them is OCR'd, and hashes that
+    already have a result in the store reuse it straight away. Returns a TaskPlan.
+    """
+    store.touch(changes.touched)
+    store.tombstone(changes.deleted)
+
+    # can filter out alot of files by assuming a file smaller than min_size bytes can't contain any OCRable text
+    queued_files = [file for file, st in changes.queued if st.st_size > min_size]
+
+    file_hashes = hash_files(queued_files)
+    known_texts = store.texts_for_hashes(set(file_hashes.values()))
+    duplicates = defaultdict(list)
+    reused = []
+    for file in queued_files:
+        digest = file_hashes.get(file)
+        if digest in known_texts:
+            reused.append((file, known_texts[digest]))
+        else:
+            duplicates[digest if digest is not None else file].append(file)
+
+    if reused:
+        store.put_many(reused, hashes=file_hashes)
+
+    task_files = [paths[0] for paths in duplicates.values()]
+    return TaskPlan(queued_files, reused, task_files, file_hashes, duplicates)
+
+
+WatchEvent = namedtuple('WatchEvent', ['kind', 'paths'])  # kind is 'changed', 'deleted' or 'rescan'
+
+
+class WatchQueue(queue.Queue):
+    """
+    queue.Queue of WatchEvents holding at most one rescan. A rescan put while another is still
+    waiting replaces it in place, the newer listing supersedes the older one.
+    """
+
+    def _put(self, event):
+        if event.kind == 'rescan':
+            for i, waiting in enumerate(self.queue):
+                if waiting.kind == 'rescan':
+                    self.queue[i] = event
+                    return
+        self.queue.append(event)
+
+    def has_rescan(self):
+        with self.mutex:
+            return any(event.kind == 'rescan' for event in self.queue)
+
+
+def walk_files(root):
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+class FileWatcher:
+    """
+    Background thread feeding filesystem changes under roots to on_event as WatchEvents.
+
+    Uses inotify on Linux when inotify_simple is installed, and watchdog (ReadDirectoryChangesW
+    on Windows, FSEvents on macOS) elsewhere, emitting 'changed' and 'deleted' batches once
+    events settle. Without either it polls, calling list_files on every root each interval
+    seconds and emitting the full listing as a 'rescan' for change detection to diff. A poll is
+    skipped while rescan_pending() says the previous listing hasn't been picked up yet.
+    paths_under(directory) lists the indexed paths inside a directory, so a directory that gets
+    deleted or moved away takes everything indexed under it along.
+    """
+
+    def __init__(self, roots, on_event, list_files=walk_files, extensions=None, interval=300, settle=2, max_batch=1024, rescan_pending=None, paths_under=None):
+        self.roots = roots
+        self.on_event = on_event
+        self.list_files = list_files
+        self.extensions = extensions
+        self.interval = interval
+        self.settle = settle
+        self.max_batch = max_batch
+        self.rescan_pending = rescan_pending
+        self.paths_under = paths_under
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def wanted(self, path):
+        return self.extensions is None or path.lower().endswith(self.extensions)
+
+    def remove_tree(self, directory, changed, deleted):
+        """Record everything indexed under a directory that went away as deleted"""
+        prefix = os.path.join(directory, '')
+        changed.difference_update([path for path in changed if path.startswith(prefix)])
+        if self.paths_under is not None:
+            deleted.update(path for path in self.paths_under(directory) if self.wanted(path))
+
+    def run(self):
+        if inotify_simple is not None and sys.platform.startswith('linux'):
+            try:
+                self.run_inotify()
+                return
+            except OSError:  # usually out of inotify watches, fall back to polling
+                pass
+        elif Observer is not None:
+            try:
+                self.run_watchdog()
+                return
+            except OSError:
+                pass
+        self.run_polling()
+
+    def run_polling(self):
+        while not self.stopped.wait(self.interval):
+            if self.rescan_pending is not None and self.rescan_pending():
+                continue  # still behind on the last listing, another one would only queue up behind it
+            paths = []
+            for root in self.roots:
+                paths.extend(path for path in self.list_files(root) if self.wanted(path))
+            self.on_event(WatchEvent('rescan', paths))
+
+    def run_inotify(self):
+        flags = inotify_simple.flags
+        watch_flags = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE
+        inotify = inotify_simple.INotify()
+        directories = {}
+
+        def add_tree(root):
+            found = []
+            for dirpath, _, filenames in os.walk(root):
+                try:
+                    directories[inotify.add_watch(dirpath, watch_flags)] = dirpath
+                except PermissionError:
+                    continue
+                found.extend(os.path.join(dirpath, filename) for filename in filenames)
+            return found
+
+        for root in self.roots:
+            add_tree(root)
+
+        changed, deleted = set(), set()
+        while not self.stopped.is_set():
+            events = inotify.read(timeout=int(self.settle * 1000))
+            for event in events:
+                if event.mask & flags.IGNORED:
+                    directories.pop(event.wd, None)
+                    continue
+                directory = directories.get(event.wd)
+                if directory is None:
+                    continue
+                path = os.path.join(directory, event.name)
+
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        changed.update(file for file in add_tree(path) if self.wanted(file))
+                    elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                        self.remove_tree(path, changed, deleted)
+                        if event.mask & flags.MOVED_FROM:
+                            # the watches travel with a moved directory, they'd report under the old path
+                            prefix = os.path.join(path, '')
+                            for wd, watched in list(directories.items()):
+                                if watched == path or watched.startswith(prefix):
+                                    try:
+                                        inotify.rm_watch(wd)
+                                    except OSError:
+                                        pass
+                                    directories.pop(wd, None)
+                    continue
+                if not self.wanted(path):
+                    continue
+
+                if event.mask & (flags.DELETE | flags.MOVED_FROM):
+                    deleted.add(path)
+                    changed.discard(path)
+                elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                    changed.add(path)
+                    deleted.discard(path)
+
+            # flush once the filesystem goes quiet, or early if a large copy keeps it busy
+            if (not events or len(changed) + len(deleted) >= self.max_batch) and (changed or deleted):
+                if deleted:
+                    self.on_event(WatchEvent('deleted', sorted(deleted)))
+                if changed:
+                    self.on_event(WatchEvent('changed', sorted(changed)))
+                changed, deleted = set(), set()
+
+        inotify.close()
+
+    def run_watchdog(self):
+        lock = threading.Lock()
+        changed, deleted = set(), set()
+        last_event = [0.0]
+        watcher = self
+
+        class Handler:
+            def dispatch(self, event):
+                with lock:
+                    last_event[0] = time.time()
+                    if event.is_directory:
+                        if event.event_type in ('deleted', 'moved'):
+                            watcher.remove_tree(event.src_path, changed, deleted)
+                        if event.event_type in ('created', 'moved'):
+                            path = event.dest_path if event.event_type == 'moved' else event.src_path
+                            changed.update(file for file in walk_files(path) if watcher.wanted(file))
+                        return
+
+                    if event.event_type in ('deleted', 'moved') and watcher.wanted(event.src_path):
+                        deleted.add(event.src_path)
+                        changed.discard(event.src_path)
+                    if event.event_type in ('created', 'modified', 'closed', 'moved'):
+                        path = event.dest_path if event.event_type == 'moved' else event.src_path
+                        if watcher.wanted(path):
+                            changed.add(path)
+                            deleted.discard(path)
+
+        observer = Observer()
+        for root in self.roots:
+            observer.schedule(Handler(), root, recursive=True)
+        observer.start()
+        try:
+            while not self.stopped.wait(self.settle / 4):
+                with lock:
+                    # same flushing as inotify, once things go quiet or early during a large copy
+                    quiet = time.time() - last_event[0] >= self.settle
+                    if not (changed or deleted) or not (quiet or len(changed) + len(deleted) >= self.max_batch):
+                        continue
+                    batch_changed, batch_deleted = sorted(changed), sorted(deleted)
+                    changed.clear()
+                    deleted.clear()
+                if batch_deleted:
+                    self.on_event(WatchEvent('deleted', batch_deleted))
+                if batch_changed:
+                    self.on_event(WatchEvent('changed', batch_changed))
+        finally:
+            observer.stop()
+            observer.join()
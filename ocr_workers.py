@@ -0,0 +1,584 @@
+import os
+import sys
+import time
+import queue
+import pickle
+import threading
+import subprocess
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+from utils import load_image, preprocess_for_ocr, preprocess_profiles, format_family, TextPrefilter
+from thumbnails import encode_thumbnail, highlight_crop
+from word_boxes import pack_words, document_confidence, source_boxes
+
+default_config = "--psm 11 --oem 3 -c preserve_interword_spaces=1"
+
+worker_script = os.path.abspath(__file__)
+
+
+def parse_tesseract_config(config):
+    """Split a tesseract command line config into (psm, oem, variables)"""
+    psm, oem, variables = None, None, {}
+    args = config.split()
+    for i, arg in enumerate(args[:-1]):
+        value = args[i + 1]
+        if arg == '--psm':
+            psm = int(value)
+        elif arg == '--oem':
+            oem = int(value)
+        elif arg == '-c' and '=' in value:
+            key, value = value.split('=', 1)
+            variables[key] = value
+    return psm, oem, variables
+
+
+class TesseractEngine:
+    """
+    OCR engine that loads the Tesseract model once and keeps the handle warm for every image
+    after it. Uses tesserocr when it's installed and falls back to zhmiscellanyocr otherwise.
+    With word_boxes set, ocr_words also returns the position and confidence of every word and
+    drops words below min_word_confidence from the text, which needs tesserocr or pytesseract
+    (zhmiscellanyocr only gives plain text).
+    """
+
+    def __init__(self, config=default_config, word_boxes=False, min_word_confidence=None):
+        self.config = config
+        self.word_boxes = word_boxes
+        self.min_word_confidence = min_word_confidence
+        self.api = None
+        try:
+            import tesserocr
+
+            psm, oem, variables = parse_tesseract_config(config)
+            kwargs = {}
+            if psm is not None:
+                kwargs['psm'] = psm
+            if oem is not None:
+                kwargs['oem'] = oem
+            self.api = tesserocr.PyTessBaseAPI(**kwargs)
+            for key, value in variables.items():
+                self.api.SetVariable(key, value)
+        except (ImportError, RuntimeError):
+            self.api = None
+
+    def ocr(self, img):
+        if self.api is not None:
+            self.api.SetImage(img)
+            return self.api.GetUTF8Text()
+
+        import zhmiscellanyocr
+        return zhmiscellanyocr.ocr(img, config=self.config)
+
+    def find_words(self, img):
+        """
+        (words, (left, top, width, height) pixel boxes, confidences, line numbers) of img, which
+        tesserocr must have OCR'd last while pytesseract runs its own pass over it. Confidences
+        are 0-100 or -1 when unknown. None if no backend gives words.
+        """
+        if self.api is not None:
+            from tesserocr import RIL, iterate_level
+
+            words, boxes, confidences, lines = [], [], [], []
+            line = 0
+            for word in iterate_level(self.api.GetIterator(), RIL.WORD):
+                if word.IsAtBeginningOf(RIL.TEXTLINE):
+                    line += 1
+                text = word.GetUTF8Text(RIL.WORD)
+                box = word.BoundingBox(RIL.WORD)
+                if text and text.strip() and box is not None:
+                    words.append(text.strip())
+                    boxes.append((box[0], box[1], box[2] - box[0], box[3] - box[1]))
+                    confidences.append(word.Confidence(RIL.WORD))
+                    lines.append(line)
+            return words, boxes, confidences, lines
+
+        try:
+            import pytesseract
+        except ImportError:
+            return None
+        data = pytesseract.image_to_data(img, config=self.config, output_type=pytesseract.Output.DICT)
+        keep = [i for i, text in enumerate(data['text']) if text.strip()]
+        line_keys = {}
+        return (
+            [data['text'][i].strip() for i in keep],
+            [(data['left'][i], data['top'][i], data['width'][i], data['height'][i]) for i in keep],
+            [float(data['conf'][i]) for i in keep],
+            [line_keys.setdefault((data['block_num'][i], data['par_num'][i], data['line_num'][i]), len(line_keys)) for i in keep],
+        )
+
+    def ocr_words(self, img):
+        """
+        (text, packed word boxes, document confidence) of an image. Boxes are given as fractions of
+        the image preprocessing started from (see info['ocr_frame']), boxes and confidence are None
+        when word boxes are off or unavailable, and the text is rebuilt line by line without the
+        words below min_word_confidence. Without tesserocr the words come from a single pytesseract
+        pass and the text is built from them too, rather than running tesseract a second time.
+        """
+        if not self.word_boxes:
+            return self.ocr(img), None, None
+        if self.api is None:
+            found = self.find_words(img)
+            if found is None:
+                return self.ocr(img), None, None
+            text = None  # built from the words below
+        else:
+            text = self.ocr(img)
+            if text is None:
+                return text, None, None
+            found = self.find_words(img)
+
+        words, boxes, confidences, lines = found
+        if text is None or self.min_word_confidence is not None:
+            text_lines = {}
+            for word, confidence, line in zip(words, confidences, lines):
+                if self.min_word_confidence is None or confidence < 0 or confidence >= self.min_word_confidence:
+                    text_lines.setdefault(line, []).append(word)
+            text = '\n'.join(' '.join(line) for line in text_lines.values())
+
+        boxes = source_boxes(boxes, img.info.get('ocr_frame', (0.0, 0.0, 1.0, 1.0)), img.size)
+        return text, pack_words(words, boxes, confidences), document_confidence(words, confidences)
+
+    def ocr_path(self, path):
+        img = load_image(path)
+        if img is None:
+            return None
+        return self.ocr_words(img) if self.word_boxes else self.ocr(img)
+
+
+prefilters = {}  # TextPrefilter per settings, built once in each worker
+
+
+def process_file(engine, path, options):
+    """
+    Decode, prefilter, preprocess and OCR one file, run inside a worker so a native decoder that
+    crashes or hangs only takes down a supervised process. options holds the preprocessing
+    profiles, the TextPrefilter keyword arguments (None to OCR everything) and the optional
+    (size, format, quality) of a thumbnail to encode while the image is decoded. Returns a dict
+    of the OCRResult fields other than path.
+    """
+    profiles = options.get('profiles', preprocess_profiles)
+    family = format_family(path)
+    profile = {**profiles['default'], **profiles.get(family, {})}
+
+    # the max_pixels cap applies after the border crop, the decode is only bounded loosely so the crop keeps its resolution
+    img = load_image(path, max_pixels=profile['decode_max_pixels'], data=options.get('data'))
+    if img is None:
+        return {'text': None, 'status': 'failed'}
+    result = {'size': img.info.get('source_size', img.size)}
+
+    if options.get('thumbnail') is not None:
+        result['thumbnail'] = encode_thumbnail(img, *options['thumbnail'])
+
+    if options.get('prefilter') is not None:
+        key = tuple(sorted(options['prefilter'].items()))
+        if key not in prefilters:
+            prefilters[key] = TextPrefilter(**options['prefilter'])
+        if not prefilters[key](img):
+            result.update(text='', status='no_text')
+            return result
+
+    img = preprocess_for_ocr(img, family, profiles)
+    if engine.word_boxes:
+        text, result['words'], result['confidence'] = engine.ocr_words(img)
+    else:
+        text = engine.ocr(img)
+    result.update(text=text, status='failed' if text is None else 'ok')
+    return result
+
+
+def render_image(options):
+    """
+    Encoded thumbnail of options['path'] for ThumbnailRenderer, shrunk to fit options['thumbnail'],
+    a (size, format, quality) tuple, or the highlighted crop of options['region'] marking
+    options['boxes'] when a region is given. None if the file couldn't be decoded.
+    """
+    size, format, quality = options['thumbnail']
+    region = options.get('region')
+    if region is None:
+        img = load_image(options['path'], target_size=(size, size))
+    else:
+        # decode just big enough for the cropped region to fill size
+        left, top, right, bottom = region
+        img = load_image(options['path'], target_size=(size / (right - left), size / (bottom - top)))
+    if img is None:
+        return None
+    if region is not None:
+        img = highlight_crop(img, region, options['boxes'])
+    return encode_thumbnail(img, size, format, quality)
+
+
+def worker_main():
+    """
+    Entry point of a worker process, reads pickled tasks from stdin and writes pickled results to
+    stdout: texts, or (text, word boxes, confidence) triples when word boxes are on, for paths and
+    decoded (path, image) pairs, process_file dicts for (path, options) pairs and encoded images
+    for render tasks
+    """
+    channel_in = sys.stdin.buffer
+    # keep stray prints, including ones from native libraries, off the result channel
+    channel_out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    engine = TesseractEngine(**pickle.load(channel_in))
+    while True:
+        try:
+            item = pickle.load(channel_in)
+        except EOFError:
+            break
+        if item is None:
+            break
+
+        try:
+            # items are a path to load here, a (path, image) pair decoded upstream, a (key, options) render task or a (path, options) task
+            if isinstance(item, tuple) and isinstance(item[1], dict) and item[1].get('render'):
+                text = render_image(item[1])
+            elif isinstance(item, tuple) and isinstance(item[1], dict):
+                text = process_file(engine, *item)
+            elif isinstance(item, tuple):
+                text = engine.ocr_words(item[1]) if engine.word_boxes else engine.ocr(item[1])
+            else:
+                text = engine.ocr_path(item)
+        except Exception:
+            text = None
+        pickle.dump(text, channel_out)
+        channel_out.flush()
+
+
+died = object()
+waiting = object()
+finished = object()
+
+
+def task_source(items):
+    """
+    Non-blocking reader over the tasks fed to the pool. A queue.Queue is read until a None
+    sentinel and reports waiting while it's empty, anything else is treated as a plain iterable.
+    """
+    if isinstance(items, queue.Queue):
+        def take():
+            try:
+                item = items.get_nowait()
+            except queue.Empty:
+                return waiting
+            return finished if item is None else item
+    else:
+        iterator = iter(items)
+
+        def take():
+            return next(iterator, finished)
+    return take
+
+
+class Worker:
+    def __init__(self, results, engine_options):
+        self.process = subprocess.Popen(
+            [sys.executable, worker_script],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
+        )
+        self.task = None
+        self.started = None
+        self.answered = False  # set by the reader as soon as the result is in, however long it waits in the queue
+        pickle.dump(engine_options, self.process.stdin)
+        self.process.stdin.flush()
+        threading.Thread(target=self.read_results, args=(results,), daemon=True).start()
+
+    def read_results(self, results):
+        while True:
+            try:
+                text = pickle.load(self.process.stdout)
+            except Exception:  # EOF or a torn message, either way the process is gone
+                self.answered = True
+                results.put((self, died))
+                return
+            self.answered = True
+            results.put((self, text))
+
+    def send(self, item):
+        self.task = item[0] if isinstance(item, tuple) else item
+        self.started = time.time()
+        self.answered = False
+        pickle.dump(item, self.process.stdin)
+        self.process.stdin.flush()
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        # reap it, a killed child left unwaited stays behind as a zombie
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+
+class OCRWorkerPool:
+    """
+    Long-lived pool of OCR processes, each keeping a warm TesseractEngine.
+
+    The supervisor (whichever thread iterates imap_unordered) hands out one path at a time per
+    worker, and kills and respawns any worker that crashes or runs past the timeout, reporting
+    None for the path it was working on. With word_boxes set, workers report (text, word boxes,
+    confidence) triples instead of plain texts, see TesseractEngine.ocr_words, and process_file
+    tasks report dicts.
+    """
+
+    def __init__(self, processes=None, timeout=30, config=default_config, word_boxes=False, min_word_confidence=None):
+        self.processes = processes or os.cpu_count() or 4
+        self.timeout = timeout
+        self.engine_options = {'config': config, 'word_boxes': word_boxes, 'min_word_confidence': min_word_confidence}
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.workers = [Worker(self.results, self.engine_options) for _ in range(self.processes)]
+
+    def replace(self, worker):
+        worker.kill()
+        self.workers[self.workers.index(worker)] = Worker(self.results, self.engine_options)
+
+    def imap_unordered(self, items):
+        """
+        Yield (path, result) pairs as they finish, result is None when the file couldn't be read or
+        OCR'd. items are paths, (path, image) pairs or (path, options) process_file tasks, given as
+        an iterable or a queue.Queue ended by None.
+        """
+        with self.lock:
+            take = task_source(items)
+            retry = deque()
+            exhausted = False
+            try:
+                while not exhausted or retry or any(worker.task is not None for worker in self.workers):
+                    for worker in list(self.workers):
+                        if worker.task is not None or exhausted and not retry:
+                            continue
+                        item = retry.popleft() if retry else take()
+                        if item is finished:
+                            exhausted = True
+                            continue
+                        if item is waiting:
+                            break
+                        try:
+                            worker.send(item)
+                        except OSError:
+                            worker.task = None
+                            retry.append(item)
+                            self.replace(worker)
+
+                    try:
+                        worker, text = self.results.get(timeout=0.1)
+                    except queue.Empty:
+                        worker = None
+
+                    # messages from workers that were already replaced are stale
+                    if worker is not None and worker in self.workers and worker.task is not None:
+                        path = worker.task
+                        worker.task = None
+                        if text is died:
+                            self.replace(worker)
+                            yield path, None
+                        else:
+                            yield path, text
+
+                    # only workers still computing can time out, a result waiting behind a slow consumer is not late
+                    now = time.time()
+                    for worker in list(self.workers):
+                        if worker.task is not None and not worker.answered and now - worker.started > self.timeout:
+                            path = worker.task
+                            self.replace(worker)
+                            yield path, None
+            finally:
+                # an abandoned iteration leaves workers mid-task, their late results would be misattributed
+                for worker in list(self.workers):
+                    if worker.task is not None:
+                        self.replace(worker)
+
+    def map(self, paths):
+        return dict(self.imap_unordered(paths))
+
+    def close(self, timeout=10):
+        for worker in self.workers:
+            try:
+                pickle.dump(None, worker.process.stdin)
+                worker.process.stdin.close()
+            except OSError:
+                worker.kill()
+        for worker in self.workers:
+            try:
+                worker.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+
+
+class ThumbnailRenderer:
+    """
+    Decodes and encodes result thumbnails and crops on a small OCRWorkerPool of its own, so the
+    web server never runs a decoder in its own process and isn't stuck behind indexing, which
+    holds the main pool. A supervisor thread keeps one imap_unordered running over a task queue
+    and hands each result to the threads waiting on its key, requests for a key already being
+    rendered wait on the same task.
+    """
+
+    def __init__(self, processes=2, timeout=15, wait_timeout=None):
+        self.processes = processes
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout or 4 * timeout  # leaves room for a few renders queued ahead
+        self.pool = None
+        self.supervisor = None
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> futures of the threads waiting on it
+
+    def start(self):
+        # workers are spawned on the first request rather than at startup, and again if the supervisor died. Called with lock held
+        self.pool = OCRWorkerPool(processes=self.processes, timeout=self.timeout)
+        self.supervisor = threading.Thread(target=self.supervise, args=(self.pool,), daemon=True)
+        self.supervisor.start()
+
+    def supervise(self, pool):
+        try:
+            for key, data in pool.imap_unordered(self.tasks):
+                with self.lock:
+                    futures = self.pending.pop(key, [])
+                for future in futures:
+                    future.set_result(data if isinstance(data, bytes) else None)
+        finally:
+            # whoever is still waiting gets None, the next render starts a fresh pool
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.supervisor = None
+            for futures in pending.values():
+                for future in futures:
+                    future.set_result(None)
+            pool.close(timeout=1)
+
+    def render(self, key, path, thumbnail, region=None, boxes=None):
+        """
+        Encoded bytes of the thumbnail of path, or of its highlighted crop when region is given,
+        see render_image. Blocks until a worker is done with it, None if it couldn't be decoded
+        or wasn't done within wait_timeout.
+        """
+        future = Future()
+        with self.lock:
+            if self.supervisor is None:
+                self.start()
+            first = key not in self.pending
+            self.pending.setdefault(key, []).append(future)
+        if first:
+            self.tasks.put((key, {'render': True, 'path': path, 'thumbnail': thumbnail, 'region': region, 'boxes': boxes}))
+        try:
+            return future.result(timeout=self.wait_timeout)
+        except TimeoutError:
+            # the task stays queued, later requests for the key wait on it rather than queueing another
+            with self.lock:
+                futures = self.pending.get(key, [])
+                if future in futures:
+                    futures.remove(future)
+            return None
+
+
+# one finished file as handed to the persist callback. words and confidence are None unless the
+# pool records word boxes, size is the original (width, height) and thumbnail the encoded bytes
+# when one was asked for, both None if the file couldn't be decoded
+OCRResult = namedtuple('OCRResult', ['path', 'text', 'status', 'words', 'confidence', 'size', 'thumbnail'])
+
+
+def read_file(path, max_bytes):
+    """The bytes of a file for read ahead, None when it's too large or unreadable (the worker opens it itself)"""
+    try:
+        if os.path.getsize(path) > max_bytes:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class OCRPipeline:
+    """
+    Streaming read/decode/prefilter/preprocess/OCR -> persist pipeline.
+
+    Every file goes through process_file inside an OCRWorkerPool worker, so decoders (including
+    the svg/raw/psd converters and their native libraries) run under the pool's crash isolation
+    and timeout rather than in this process. Images the optional prefilter (TextPrefilter keyword
+    arguments) rejects skip OCR and are persisted as 'no_text', and thumbnail, a (size, format,
+    quality) tuple, has a thumbnail encoded from the same decode. File bytes are read ahead on
+    io_threads threads and sent along with the paths, so workers don't sit idle on slow disks,
+    and results are handed to the persist callback in batches on a writer thread, so the
+    database writes overlap OCR. Both sides go through bounded queues, so nothing piles up.
+    """
+
+    def __init__(self, ocr_pool, queue_size=None, batch_size=64, profiles=preprocess_profiles, prefilter=None, thumbnail=None, io_threads=4, max_read_bytes=64 * 2**20):
+        self.ocr_pool = ocr_pool
+        self.queue_size = queue_size or 2 * ocr_pool.processes
+        self.batch_size = batch_size
+        self.io_threads = io_threads
+        self.max_read_bytes = max_read_bytes
+        self.options = {'profiles': profiles, 'prefilter': prefilter, 'thumbnail': thumbnail}
+
+    def run(self, paths, on_batch, on_result=None, stop=None):
+        """
+        Push paths through the workers, calling on_batch with lists of OCRResults and
+        on_result(index, path) after each file. Blocks until all paths are persisted, or once
+        stop() returns True, until the files already handed out are. Returns how many were.
+        An exception raised by on_batch is re-raised here once the workers are done.
+        """
+        tasks = queue.Queue(maxsize=self.queue_size)
+        batches = queue.Queue(maxsize=2)
+        errors = []
+
+        def feed():
+            with ThreadPoolExecutor(self.io_threads) as io_pool:
+                reads = deque()
+                for path in paths:
+                    if stop is not None and stop():
+                        break
+                    reads.append((path, io_pool.submit(read_file, path, self.max_read_bytes)))
+                    if len(reads) >= self.queue_size:
+                        path, data = reads.popleft()
+                        tasks.put((path, {**self.options, 'data': data.result()}))
+                for path, data in reads:
+                    tasks.put((path, {**self.options, 'data': data.result()}))
+            tasks.put(None)
+
+        def write():
+            while (batch := batches.get()) is not None:
+                if not errors:  # keep draining after a failure so the producer never blocks
+                    try:
+                        on_batch(batch)
+                    except Exception as e:
+                        errors.append(e)
+
+        threading.Thread(target=feed, daemon=True).start()
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+
+        batch = []
+        index = 0
+        for path, result in self.ocr_pool.imap_unordered(tasks):
+            if not isinstance(result, dict):  # crashed or timed out
+                result = {'text': None, 'status': 'failed'}
+            index += 1
+            batch.append(OCRResult(path, result['text'], result['status'], result.get('words'), result.get('confidence'), result.get('size'), result.get('thumbnail')))
+            if on_result is not None:
+                on_result(index, path)
+            if len(batch) >= self.batch_size:
+                batches.put(batch)
+                batch = []
+        if batch:
+            batches.put(batch)
+        batches.put(None)
+        writer.join()
+        if errors:
+            raise errors[0]
+        return index
+
+
+if __name__ == '__main__':
+    worker_main()
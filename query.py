@@ -0,0 +1,255 @@
+import re
+import time
+import datetime
+from collections import namedtuple
+
+from search_index import tokenize
+
+# query plan nodes
+Term = namedtuple('Term', ['word'])
+Prefix = namedtuple('Prefix', ['prefix'])
+Phrase = namedtuple('Phrase', ['words'])
+Field = namedtuple('Field', ['name', 'value'])
+Range = namedtuple('Range', ['column', 'low', 'high'])  # [low, high) over a metadata column, either bound may be None
+Not = namedtuple('Not', ['node'])
+And = namedtuple('And', ['nodes'])
+Or = namedtuple('Or', ['nodes'])
+
+# field name -> metadata column, ext and path are matched by value rather than by range
+range_fields = {'size': 'size', 'date': 'mtime', 'modified': 'mtime', 'width': 'width', 'height': 'height', 'confidence': 'confidence'}
+fields = ('ext', 'path', *range_fields)
+sort_fields = {'date': 'mtime', 'modified': 'mtime', 'size': 'size', 'width': 'width', 'height': 'height', 'confidence': 'confidence'}
+
+query_token_pattern = re.compile(r'[()]|-?\w+:"[^"]*"|-?"[^"]*"?|[^\s()]+')
+# field names match in any case, the operators only in capitals like the parser wants them, so "black or white" stays plain text
+syntax_pattern = re.compile(rf'(^|\s)(-\S|({"|".join((*fields, "sort"))}):\S)|(?-i:\bAND\b|\bOR\b|\bNOT\b)|\S\s*"[^"]*"|"[^"]*"\s*\S', re.IGNORECASE)
+sort_pattern = re.compile(r'(^|\s)sort:(\w+?)(-asc|-desc)?(?=\s|$)', re.IGNORECASE)
+
+size_units = {'': 1, 'b': 1, 'k': 2**10, 'kb': 2**10, 'm': 2**20, 'mb': 2**20, 'g': 2**30, 'gb': 2**30}
+age_units = {'d': 86400, 'w': 7 * 86400, 'm': 30 * 86400, 'y': 365 * 86400}
+
+
+def is_structured(query):
+    """Whether query uses any of the query language, plain text is left to the fuzzy engines"""
+    query = query.strip()
+    if len(query) > 2 and query.startswith('"') and query.endswith('"') and query.count('"') == 2:
+        return False  # one quoted string is the exact substring search
+    return bool(syntax_pattern.search(query))
+
+
+def parse_date(value):
+    """A YYYY, YYYY-MM or YYYY-MM-DD date as the [start, end) timestamps of the period it names"""
+    parts = [int(part) for part in value.split('-')]
+    if len(parts) == 1:
+        start, end = datetime.datetime(parts[0], 1, 1), datetime.datetime(parts[0] + 1, 1, 1)
+    elif len(parts) == 2:
+        start = datetime.datetime(parts[0], parts[1], 1)
+        end = datetime.datetime(parts[0] + parts[1] // 12, parts[1] % 12 + 1, 1)
+    else:
+        start = datetime.datetime(*parts[:3])
+        end = start + datetime.timedelta(days=1)
+    return start.timestamp(), end.timestamp()
+
+
+def parse_bounds(name, value):
+    """The [low, high) bounds a single value names, a whole period for dates and one value for numbers"""
+    if name in ('date', 'modified'):
+        return parse_date(value)
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([a-z]*)', value.lower())
+    if match is None or (name == 'size' and match[2] not in size_units) or (name != 'size' and match[2]):
+        raise ValueError(f'Bad {name} value {value}')
+    number = float(match[1]) * (size_units[match[2]] if name == 'size' else 1)
+    return number, number + 1
+
+
+def range_node(name, value):
+    """
+    Range filter for size:, date:, width:, height: and confidence: (0-100) fields. Values are >x, >=x, <x, <=x,
+    x..y or a bare x, sizes take b/kb/mb/gb units, dates are YYYY[-MM[-DD]] and date:7d
+    (or w/m/y) means modified within the last 7 days.
+    """
+    column = range_fields[name]
+    if column == 'mtime' and re.fullmatch(r'\d+[dwmy]', value.lower()):
+        return Range(column, time.time() - int(value[:-1]) * age_units[value[-1].lower()], None)
+    if '..' in value:
+        low, high = value.split('..', 1)
+        return Range(column, parse_bounds(name, low)[0] if low else None, parse_bounds(name, high)[1] if high else None)
+    for operator in ('>=', '<=', '>', '<'):
+        if value.startswith(operator):
+            low, high = parse_bounds(name, value[len(operator):])
+            return {
+                '>=': Range(column, low, None),
+                '>': Range(column, high, None),
+                '<=': Range(column, None, high),
+                '<': Range(column, None, low),
+            }[operator]
+    return Range(column, *parse_bounds(name, value))
+
+
+def extract_sort(query):
+    """Pull a sort:date / sort:size-asc option out of query, returns (query, (column, descending) or None)"""
+    sort = None
+    for match in sort_pattern.finditer(query):
+        if match[2].lower() in sort_fields:
+            sort = (sort_fields[match[2].lower()], (match[3] or '-desc').lower() == '-desc')
+    return sort_pattern.sub(' ', query).strip(), sort
+
+
+def word_node(word):
+    """A bare word, which the tokenizer may split further ('2023-01' is a phrase of two tokens)"""
+    if word.endswith('*'):
+        words = tokenize(word[:-1])
+        if not words:
+            return None
+        if len(words) == 1:
+            return Prefix(words[0])
+        return And([Phrase(words[:-1]), Prefix(words[-1])])
+    words = tokenize(word)
+    if not words:
+        return None
+    return Term(words[0]) if len(words) == 1 else Phrase(words)
+
+
+def parse_query(query):
+    """
+    Parse a query into a plan of nodes.
+
+    Words are ANDed together, OR between two terms makes them alternatives, a leading - or
+    NOT excludes, parentheses group, "quoted words" are phrases and a trailing * matches a
+    prefix. ext:png, path:<glob>, size:, date:, width:, height: and confidence: (see range_node)
+    restrict by file metadata. Returns None for a query with nothing searchable in it.
+    """
+    tokens = query_token_pattern.findall(query)
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        position[0] += 1
+        return tokens[position[0] - 1]
+
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() == 'OR':
+            take()
+            nodes.append(parse_and())
+        nodes = [node for node in nodes if node is not None]
+        if not nodes:
+            return None
+        return nodes[0] if len(nodes) == 1 else Or(nodes)
+
+    def parse_and():
+        nodes = []
+        while peek() not in (None, ')', 'OR'):
+            if peek() == 'AND':
+                take()
+                continue
+            node = parse_unary()
+            if node is not None:
+                nodes.append(node)
+        if not nodes:
+            return None
+        return nodes[0] if len(nodes) == 1 else And(nodes)
+
+    def parse_unary():
+        token = take()
+        if token == 'NOT':
+            node = parse_unary() if peek() not in (None, ')', 'OR') else None
+            return None if node is None else Not(node)
+        if token.startswith('-') and len(token) > 1:
+            node = parse_atom(token[1:])
+            return None if node is None else Not(node)
+        return parse_atom(token)
+
+    def parse_atom(token):
+        if token == '(':
+            node = parse_or()
+            if peek() == ')':
+                take()
+            return node
+        if token == ')':
+            return None
+
+        name, colon, value = token.partition(':')
+        name = name.lower()
+        if colon and name in fields and value:
+            value = value.strip('"')
+            if name == 'ext':
+                return Field('ext', value.lower().lstrip('.'))
+            if name == 'path':
+                return Field('path', value)
+            try:
+                return range_node(name, value)
+            except ValueError:
+                return None  # malformed filters are ignored rather than matching nothing
+
+        if token.startswith('"'):
+            words = tokenize(token.strip('"'))
+            if not words:
+                return None
+            return Term(words[0]) if len(words) == 1 else Phrase(words)
+        return word_node(token)
+
+    plan = parse_or()
+    while position[0] < len(tokens):  # unbalanced ')', carry on past it
+        take()
+        rest = parse_or()
+        if rest is not None:
+            plan = rest if plan is None else And([plan, rest])
+    return plan
+
+
+def plan_words(node):
+    """The words a document has to contain for node to match, used to order the hits"""
+    if isinstance(node, Term):
+        return [node.word]
+    if isinstance(node, Prefix):
+        return [node.prefix]
+    if isinstance(node, Phrase):
+        return [' '.join(node.words)]
+    if isinstance(node, (And, Or)):
+        return [word for child in node.nodes for word in plan_words(child)]
+    return []
+
+
+def evaluate(node, index, within=None):
+    """
+    Evaluate a plan against an InvertedIndex, returning the set of matching doc ids. within
+    optionally limits the work to a set of docs already known to be the only candidates.
+    """
+    if isinstance(node, Term):
+        docs = index.term_docs(node.word)
+    elif isinstance(node, Prefix):
+        docs = index.prefix_docs(node.prefix)
+    elif isinstance(node, Field):
+        docs = index.field_docs(node.name, node.value)
+    elif isinstance(node, Range):
+        docs = index.range_docs(node.column, node.low, node.high)
+    elif isinstance(node, Phrase):
+        docs = index.phrase_docs(node.words, within)
+    elif isinstance(node, Or):
+        docs = set()
+        for child in node.nodes:
+            docs |= evaluate(child, index, within)
+    elif isinstance(node, Not):
+        docs = (index.all_docs() if within is None else within) - evaluate(node.node, index, within)
+    elif isinstance(node, And):
+        # cheap postings first so phrases only verify positions in what's left, exclusions last
+        order = {Field: 0, Range: 0, Term: 0, Prefix: 1, Or: 2, And: 2, Phrase: 3}
+        positives = sorted((child for child in node.nodes if not isinstance(child, Not)), key=lambda child: order[type(child)])
+        negatives = [child.node for child in node.nodes if isinstance(child, Not)]
+
+        docs = within
+        for child in positives:
+            docs = evaluate(child, index, docs) if docs is None else docs & evaluate(child, index, docs)
+            if not docs:
+                return set()
+        if docs is None:
+            docs = index.all_docs()
+        for child in negatives:
+            docs = docs - evaluate(child, index, docs)
+    else:
+        raise ValueError(f'Unknown query node {node}')
+
+    return docs if within is None else docs & within
@@ -0,0 +1,277 @@
+import os
+import math
+import hashlib
+import threading
+from collections import Counter
+
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+from search_index import tokenize
+
+
+class RankingIndex:
+    """
+    Persisted document-term matrix for TF-IDF cosine and BM25 ranking.
+
+    Term counts are kept as one sparse row per document and saved to a single .npz, so IDF
+    and document lengths are kept up to date instead of refitting a vectorizer on every query.
+    New OCR text is appended as fresh rows (a replaced document leaves a dead row behind until
+    the next compaction) and a query only touches the columns of its own terms. Fresh rows stay
+    in a small delta matrix next to the column major copy of the base, which is only rebuilt
+    once the delta outgrows delta_fraction of it.
+
+    stamp records what the saved matrix reflects (the text store's write count), and each row
+    keeps a digest of its text so sync() can find the documents that changed behind its back.
+    """
+
+    def __init__(self, file, k1=1.2, b=0.75, delta_fraction=0.125):
+        self.file = file
+        self.k1 = k1
+        self.b = b
+        self.delta_fraction = delta_fraction
+        self.lock = threading.Lock()
+        self.terms = {}  # term -> column
+        self.paths = []  # row -> path, None for dead rows
+        self.rows = {}  # path -> row
+        self.counts = csr_matrix((0, 0), dtype=np.float32)
+        self.pending = []  # row blocks not merged into counts yet
+        self.df = np.zeros(0, dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.digests = np.zeros(0, dtype=np.uint64)  # text digest of each row
+        self.columns = None  # column major copy of counts, rebuilt lazily when counts is replaced
+        self.delta = None  # (csr, csc) of the pending blocks, rebuilt lazily when rows are added
+        self.stamp = ''
+        self.dirty = False
+        if os.path.exists(file):
+            self.load()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def load(self):
+        with np.load(self.file) as data:
+            self.counts = csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+            terms = bytes(data['terms']).decode('utf-8')
+            paths = bytes(data['paths']).decode('utf-8')
+            # matrices saved before stamps and digests get every row re-synced once
+            self.stamp = str(data['stamp']) if 'stamp' in data else ''
+            digests = data['digests'] if 'digests' in data else None
+        self.terms = {term: column for column, term in enumerate(terms.split('\n'))} if terms else {}
+        self.paths = paths.split('\n') if paths else []
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        self.df = np.bincount(self.counts.indices, minlength=len(self.terms)).astype(np.int64)
+        self.lengths = np.asarray(self.counts.sum(axis=1), dtype=np.float32).ravel()
+        self.alive = np.ones(len(self.paths), dtype=bool)
+        self.digests = digests if digests is not None else np.zeros(len(self.paths), dtype=np.uint64)
+
+    def save(self, stamp=''):
+        """Write the matrix out if it changed, compacting dead rows first"""
+        with self.lock:
+            if not self.dirty and stamp == self.stamp:
+                return
+            self.compact()
+            counts = self.counts
+            tmp_file = f'{self.file}.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.savez(
+                    f,
+                    data=counts.data,
+                    indices=counts.indices,
+                    indptr=counts.indptr,
+                    shape=np.array(counts.shape),
+                    # paths and terms never contain newlines, one joined utf-8 blob each is far smaller than a str array
+                    terms=np.frombuffer('\n'.join(self.terms).encode('utf-8'), dtype=np.uint8),
+                    paths=np.frombuffer('\n'.join(self.paths).encode('utf-8'), dtype=np.uint8),
+                    digests=self.digests,
+                    stamp=np.array(stamp),
+                )
+            os.replace(tmp_file, self.file)
+            self.stamp = stamp
+            self.dirty = False
+
+    def merge(self):
+        if not self.pending:
+            return
+        blocks = [self.counts, *self.pending]
+        for block in blocks:
+            block.resize(block.shape[0], len(self.terms))
+        self.counts = vstack(blocks, format='csr')
+        self.pending = []
+        self.columns = None
+        self.delta = None
+
+    def compact(self):
+        self.merge()
+        alive = self.alive
+        if alive.all():
+            return
+        self.counts = self.counts[alive]
+        self.paths = [path for path in self.paths if path is not None]
+        self.rows = {path: row for row, path in enumerate(self.paths)}
+        self.lengths = self.lengths[alive]
+        self.digests = self.digests[alive]
+        self.alive = np.ones(len(self.paths), dtype=bool)
+        self.columns = None
+
+    def row_terms(self, row):
+        """Columns of the terms in row, which is either in counts or in one of the pending blocks"""
+        block = self.counts
+        for pending in self.pending:
+            if row < block.shape[0]:
+                break
+            row -= block.shape[0]
+            block = pending
+        return block.indices[block.indptr[row]:block.indptr[row + 1]]
+
+    def _remove(self, path):
+        row = self.rows.pop(path, None)
+        if row is None:
+            return
+        self.df[self.row_terms(row)] -= 1
+        self.paths[row] = None
+        self.lengths[row] = 0
+        self.alive[row] = False
+
+    def add_documents(self, items):
+        """Add (path, text) pairs, replacing earlier rows of the same path. Empty texts just remove the path."""
+        with self.lock:
+            data, indices, indptr, lengths, digests, paths = [], [], [0], [], [], []
+            for path, text in items:
+                self._remove(path)
+                if not text:
+                    continue
+                term_counts = Counter(tokenize(text))
+                if not term_counts:
+                    continue
+                for term, count in term_counts.items():
+                    indices.append(self.terms.setdefault(term, len(self.terms)))
+                    data.append(count)
+                indptr.append(len(indices))
+                lengths.append(sum(term_counts.values()))
+                digests.append(text_digest(text))
+                paths.append(path)
+
+            if paths:
+                block = csr_matrix((np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr)), shape=(len(paths), len(self.terms)))
+                self.pending.append(block)
+                self.df = np.concatenate([self.df, np.zeros(len(self.terms) - len(self.df), dtype=np.int64)])
+                np.add.at(self.df, block.indices, 1)
+                self.lengths = np.concatenate([self.lengths, np.array(lengths, dtype=np.float32)])
+                self.alive = np.concatenate([self.alive, np.ones(len(paths), dtype=bool)])
+                self.digests = np.concatenate([self.digests, np.array(digests, dtype=np.uint64)])
+                for path in paths:
+                    self.rows[path] = len(self.paths)
+                    self.paths.append(path)
+                self.delta = None
+            self.dirty = True
+        return len(paths)
+
+    def remove_documents(self, paths):
+        with self.lock:
+            for path in paths:
+                self._remove(path)
+            self.dirty = True
+
+    def sync(self, files_text, batch_size=4096, check_texts=False):
+        """
+        Bring the matrix in line with files_text, only touching paths that were added or dropped,
+        plus, with check_texts, the paths whose text no longer matches the digest of their row
+        """
+        stale = [path for path in self.rows if not files_text.get(path)]
+        if stale:
+            self.remove_documents(stale)
+
+        fresh = []
+        for path, text in files_text.items():
+            if not text:
+                continue
+            row = self.rows.get(path)
+            if row is None or check_texts and self.digests[row] != text_digest(text):
+                fresh.append(path)
+        for i in range(0, len(fresh), batch_size):
+            self.add_documents((path, files_text[path]) for path in fresh[i:i + batch_size])
+        return len(fresh), len(stale)
+
+    def derived(self):
+        """
+        (column major base counts, delta csr, delta csc) at query time. The base copy is only
+        rebuilt when counts gets replaced, fresh rows just rebuild the delta until it outgrows
+        delta_fraction of the base and gets merged in.
+        """
+        pending_rows = sum(block.shape[0] for block in self.pending)
+        if pending_rows > max(self.counts.shape[0] * self.delta_fraction, 2**12):
+            self.merge()
+        if self.columns is None:
+            self.columns = self.counts.tocsc()
+        if self.delta is None:
+            for block in self.pending:
+                block.resize(block.shape[0], len(self.terms))
+            delta = vstack(self.pending, format='csr') if self.pending else csr_matrix((0, len(self.terms)), dtype=np.float32)
+            self.delta = (delta, delta.tocsc())
+        return self.columns, *self.delta
+
+    def tfidf_norms(self, rows, base, delta, idf):
+        """tf-idf norms of just the given rows, so no change has to renormalise the whole matrix"""
+        norms = np.zeros(len(rows), dtype=np.float64)
+        in_base = rows < base.shape[0]
+        for mask, matrix, offset in ((in_base, base, 0), (~in_base, delta, base.shape[0])):
+            if not mask.any():
+                continue
+            unique, inverse = np.unique(rows[mask] - offset, return_inverse=True)
+            weights = matrix[unique]
+            weights.data = (1 + np.log(weights.data)) * idf[weights.indices]
+            norms[mask] = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())[inverse]
+        norms[norms == 0] = 1
+        return norms
+
+    def search(self, query, method='bm25', limit=None):
+        """Rank documents against query, returns (path, score) pairs best first. method is 'bm25' or 'tfidf'."""
+        query_counts = Counter(tokenize(query))
+        with self.lock:
+            query_counts = {self.terms[term]: count for term, count in query_counts.items() if term in self.terms}
+            if not query_counts:
+                return []
+            base_columns, delta, delta_columns = self.derived()
+            alive = self.alive
+            documents = max(int(alive.sum()), 1)
+            query_columns = np.array(list(query_counts), dtype=np.int64)
+            rows, positions, tf = [], [], []
+            for matrix, offset in ((base_columns, 0), (delta_columns, self.counts.shape[0])):
+                # matrices built before a term was first seen are narrower than the vocabulary
+                present = np.flatnonzero(query_columns < matrix.shape[1])
+                hits = matrix[:, query_columns[present]].tocoo()
+                rows.append(hits.row + offset)
+                positions.append(present[hits.col])
+                tf.append(hits.data)
+            rows, positions, tf = np.concatenate(rows), np.concatenate(positions), np.concatenate(tf)
+
+            if method == 'bm25':
+                df = self.df[query_columns]
+                term_idf = np.log(1 + (documents - df + 0.5) / (df + 0.5))
+                average_length = self.lengths[alive].mean() if alive.any() else 1
+                lengths = self.lengths[rows]
+                weights = term_idf[positions] * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * lengths / average_length))
+            elif method == 'tfidf':
+                # same smoothed idf and sublinear tf as TfidfVectorizer(sublinear_tf=True)
+                idf = np.log((1 + documents) / (1 + self.df)) + 1
+                query_weights = np.array([(1 + math.log(count)) for count in query_counts.values()]) * idf[query_columns]
+                query_weights /= np.linalg.norm(query_weights)
+                norms = self.tfidf_norms(rows, self.counts, delta, idf)
+                weights = (1 + np.log(tf)) * idf[query_columns][positions] * query_weights[positions] / norms
+            else:
+                raise ValueError(f'Unknown ranking method {method}')
+
+            scores = np.bincount(rows, weights=weights, minlength=len(self.paths))
+            scores[~alive] = 0
+            ranked = np.flatnonzero(scores)
+            ranked = ranked[np.argsort(-scores[ranked], kind='stable')]
+            if limit is not None:
+                ranked = ranked[:limit]
+            return [(self.paths[row], float(scores[row])) for row in ranked]
+
+
+def text_digest(text):
+    """Stable 64 bit digest of a document's text, case folded like the tokens (the corpus keeps lowercased text)"""
+    return int.from_bytes(hashlib.blake2b(text.lower().encode('utf-8'), digest_size=8).digest(), 'little')
@@ -0,0 +1,523 @@
+import os
+import re
+import math
+import heapq
+import bisect
+import sqlite3
+from array import array
+import threading
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+token_pattern = re.compile(r'\w+')
+whitespace_pattern = re.compile(r'\s+')
+
+
+def normalise_text(text):
+    """Lowercase and collapse whitespace so n-grams line up with what fuzz.partial_ratio compares"""
+    return whitespace_pattern.sub(' ', text.lower()).strip()
+
+
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+
+def char_ngrams(text, n=3):
+    text = normalise_text(text)
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class InvertedIndex:
+    """
+    On-disk inverted index over the OCR text, holding positional token postings, character
+    n-gram postings and a metadata side-index of every document (extension, size, mtime, pixel
+    dimensions and OCR confidence, each with its own sorted index for range filters and ordering).
+
+    Queries only read the postings of the terms in the query, so the cost of fetching
+    candidates depends on how many documents match rather than on the size of the corpus.
+    The candidates are then re-scored with rapidfuzz by the caller. generation is bumped on
+    every change so anything derived from the postings can tell when it went stale.
+    """
+
+    metadata_columns = ('size', 'mtime', 'width', 'height', 'confidence')
+
+    def __init__(self, db_path, ngram_size=3):
+        self.ngram_size = ngram_size
+        self.generation = 0
+        self.median = None  # (generation, median confidence) cached by median_confidence
+        self.vocabulary_cache = None  # sorted distinct terms, dropped whenever a term comes or goes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        # indexes from before positional postings get rebuilt from scratch, sync() fills them back in
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(tokens)')}
+        if columns and 'positions' not in columns:
+            self.conn.executescript('DROP TABLE tokens; DROP TABLE grams; DROP TABLE docs;')
+
+        has_terms = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'terms'").fetchone() is not None
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, ext TEXT);
+            CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, docs INTEGER NOT NULL) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS tokens (term TEXT NOT NULL, doc INTEGER NOT NULL, positions BLOB, PRIMARY KEY (term, doc)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS grams (gram TEXT NOT NULL, doc INTEGER NOT NULL, PRIMARY KEY (gram, doc)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS docs_ext ON docs (ext);
+            CREATE INDEX IF NOT EXISTS tokens_doc ON tokens (doc);
+        """)
+        if not has_terms:  # indexes from before the term statistics
+            self.conn.execute('INSERT INTO terms SELECT term, COUNT(*) FROM tokens GROUP BY term')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(docs)')}
+        for column in self.metadata_columns:
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE docs ADD COLUMN {column} {"REAL" if column in ("mtime", "confidence") else "INTEGER"}')
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS docs_{column} ON docs ({column})')
+        self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def indexed_paths(self):
+        with self.lock:
+            return {row[0] for row in self.conn.execute('SELECT path FROM docs')}
+
+    def _remove(self, paths):
+        for path in paths:
+            row = self.conn.execute('SELECT id FROM docs WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                continue
+            self.conn.execute('UPDATE terms SET docs = docs - 1 WHERE term IN (SELECT term FROM tokens WHERE doc = ?)', row)
+            if self.conn.execute('DELETE FROM terms WHERE docs <= 0').rowcount:
+                self.vocabulary_cache = None
+            self.conn.execute('DELETE FROM tokens WHERE doc = ?', row)
+            self.conn.execute('DELETE FROM grams WHERE doc = ?', row)
+            self.conn.execute('DELETE FROM docs WHERE id = ?', row)
+
+    def add_documents(self, items):
+        """Index (path, text) pairs, replacing any previous postings for the same path"""
+        added = 0
+        with self.lock:
+            for path, text in items:
+                self._remove((path,))
+                if not text:
+                    continue
+                doc = self.conn.execute('INSERT INTO docs (path, ext) VALUES (?, ?)', (path, os.path.splitext(path)[1][1:].lower())).lastrowid
+                positions = defaultdict(lambda: array('I'))
+                for position, term in enumerate(tokenize(text)):
+                    positions[term].append(position)
+                self.conn.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?, ?)', ((term, doc, term_positions.tobytes()) for term, term_positions in positions.items()))
+                before = self.conn.total_changes
+                self.conn.executemany('INSERT OR IGNORE INTO terms VALUES (?, 0)', ((term,) for term in positions))
+                if self.conn.total_changes != before:
+                    self.vocabulary_cache = None
+                self.conn.executemany('UPDATE terms SET docs = docs + 1 WHERE term = ?', ((term,) for term in positions))
+                self.conn.executemany('INSERT OR IGNORE INTO grams VALUES (?, ?)', ((gram, doc) for gram in char_ngrams(text, self.ngram_size)))
+                added += 1
+            self.conn.commit()
+            self.generation += 1
+        return added
+
+    def remove_documents(self, paths):
+        with self.lock:
+            self._remove(paths)
+            self.conn.commit()
+            self.generation += 1
+
+    def touch(self):
+        """Bump generation for a change to something ranked alongside the index, e.g. the tf-idf matrix"""
+        with self.lock:
+            self.generation += 1
+
+    def sync(self, files_text, batch_size=4096):
+        """Bring the index in line with files_text, only touching paths that were added or dropped"""
+        indexed = self.indexed_paths()
+        stale = [path for path in indexed if not files_text.get(path)]
+        if stale:
+            self.remove_documents(stale)
+
+        fresh = [path for path, text in files_text.items() if text and path not in indexed]
+        for i in range(0, len(fresh), batch_size):
+            self.add_documents((path, files_text[path]) for path in fresh[i:i + batch_size])
+        return len(fresh), len(stale)
+
+    def candidates(self, query, score_cutoff=80, exact=False, max_fraction=0.5):
+        """
+        Return the paths that could score above score_cutoff for query, or None if the query
+        can't narrow anything down (a scan is cheaper than candidates covering more than
+        max_fraction of the index).
+
+        Fuzzy candidates use the q-gram lemma where it can rule documents out: a window within k
+        edits of the query still shares at least len(grams) - n*k of its n-grams with it.
+        partial_ratio is an Indel ratio, 100 * (1 - d / (len(query) + len(window))) with windows
+        no longer than the query, so scoring above score_cutoff allows d < 2 * len(query) *
+        (100 - score_cutoff) / 100 insertions and deletions. That bound is exact, but at the
+        default cutoff it allows too many edits for the grams to rule anything out, and the
+        candidates come from vocabulary_candidates instead.
+        """
+        grams = sorted(char_ngrams(query, self.ngram_size))
+        if not grams:
+            return None
+
+        if exact:
+            min_shared = len(grams)
+        else:
+            max_edits = math.ceil(2 * len(normalise_text(query)) * (100 - score_cutoff) / 100) - 1
+            min_shared = len(grams) - self.ngram_size * max(max_edits, 0)
+            if min_shared < 1:
+                return self.vocabulary_candidates(query, score_cutoff, max_fraction)
+
+        placeholders = ','.join('?' * len(grams))
+        with self.lock:
+            rows = self.conn.execute(f"""
+                SELECT docs.path FROM docs JOIN (
+                    SELECT doc FROM grams WHERE gram IN ({placeholders}) GROUP BY doc HAVING COUNT(*) >= ?
+                ) AS hits ON hits.doc = docs.id
+            """, (*grams, min_shared)).fetchall()
+        return [row[0] for row in rows]
+
+    def vocabulary(self):
+        """Every distinct term in the index, sorted. Cached until a term is added or drops out."""
+        with self.lock:
+            if self.vocabulary_cache is None:
+                self.vocabulary_cache = [row[0] for row in self.conn.execute('SELECT term FROM terms ORDER BY term')]
+            return self.vocabulary_cache
+
+    def fuzzy_terms(self, query, score_cutoff=80):
+        """
+        Terms of the vocabulary a word of query could be an OCR misreading of: within
+        score_cutoff fuzz.ratio of the word, or starting with it. Words shorter than the
+        n-gram size only match by prefix, by ratio they'd be within reach of most of the vocabulary.
+        """
+        vocabulary = self.vocabulary()
+        terms = set()
+        for word in set(tokenize(query)):
+            if len(word) >= self.ngram_size:
+                scores = process.cdist([word], vocabulary, scorer=fuzz.ratio, score_cutoff=score_cutoff, workers=-1)[0]
+                terms.update(vocabulary[i] for i in np.flatnonzero(scores))
+            start, end = bisect.bisect_left(vocabulary, word), bisect.bisect_left(vocabulary, word + '\U0010ffff')
+            terms.update(vocabulary[start:end])
+        return terms
+
+    def vocabulary_candidates(self, query, score_cutoff=80, max_fraction=0.5, batch_size=512):
+        """
+        Fuzzy candidates at cutoffs too loose for the n-gram bound: the documents holding any of
+        the fuzzy_terms of query's words, to be re-scored with partial_ratio by the caller. Unlike
+        the n-gram bound this is a heuristic, a match that only lines up across word boundaries
+        the OCR split differently can be missed. None when it narrows nothing down.
+        """
+        terms = sorted(self.fuzzy_terms(query, score_cutoff))
+        if not terms:
+            return [] if tokenize(query) else None
+        with self.lock:
+            total = self.conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+            # one term in most documents already makes the union too big, known before any postings are read
+            for i in range(0, len(terms), batch_size):
+                batch = terms[i:i + batch_size]
+                if self.conn.execute(f"SELECT coalesce(max(docs), 0) FROM terms WHERE term IN ({','.join('?' * len(batch))})", batch).fetchone()[0] > max_fraction * total:
+                    return None
+            docs = set()
+            for i in range(0, len(terms), batch_size):
+                batch = terms[i:i + batch_size]
+                docs.update(row[0] for row in self.conn.execute(f"SELECT doc FROM tokens WHERE term IN ({','.join('?' * len(batch))})", batch))
+            if len(docs) > max_fraction * total:
+                return None
+            docs = sorted(docs)
+            paths = []
+            for i in range(0, len(docs), batch_size):
+                batch = docs[i:i + batch_size]
+                paths.extend(row[0] for row in self.conn.execute(f"SELECT path FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch))
+        return paths
+
+    def token_candidates(self, words, prefix=None, limit=None):
+        """
+        Paths of the documents holding every one of words as a token, and if given a token
+        starting with prefix. Prefixes are range scans over the term ordered postings.
+
+        With a limit, the documents kept are the limit best by term statistics rather than
+        whichever the intersection happened to return first: each word (and the prefix, counting
+        all its completions) adds idf * tf / (tf + 1.2), so documents that use the rarer words a
+        lot come first.
+        """
+        conditions = [('term = ?', (word,)) for word in words]
+        if prefix is not None:
+            conditions.append(('term >= ? AND term < ?', (prefix, prefix + '\U0010ffff')))  # sorts after every term starting with prefix
+        if not conditions:
+            return None
+
+        if limit is None:
+            parts = [f'SELECT doc FROM tokens WHERE {condition}' for condition, _ in conditions]
+            sql = f"SELECT docs.path FROM docs JOIN ({' INTERSECT '.join(parts)}) AS hits ON hits.doc = docs.id"
+            with self.lock:
+                return [row[0] for row in self.conn.execute(sql, [arg for _, args in conditions for arg in args])]
+
+        with self.lock:
+            total = self.conn.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+            scores = None
+            for condition, args in conditions:
+                # positions are uint32 arrays, so the blob length gives the term frequency without unpacking it
+                frequencies = dict(self.conn.execute(f'SELECT doc, sum(length(positions)) / 4 FROM tokens WHERE {condition} GROUP BY doc', args))
+                idf = math.log(1 + total / max(len(frequencies), 1))
+                if scores is None:
+                    scores = dict.fromkeys(frequencies, 0.0)
+                scores = {doc: score + idf * frequencies[doc] / (frequencies[doc] + 1.2) for doc, score in scores.items() if doc in frequencies}
+                if not scores:
+                    return []
+
+            best = heapq.nlargest(limit, scores, key=scores.get)
+            paths = {}
+            for i in range(0, len(best), 512):
+                batch = best[i:i + 512]
+                paths.update(self.conn.execute(f"SELECT id, path FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch))
+        return [paths[doc] for doc in best if doc in paths]
+
+    def all_docs(self):
+        with self.lock:
+            return {row[0] for row in self.conn.execute('SELECT id FROM docs')}
+
+    def term_docs(self, term):
+        with self.lock:
+            return {row[0] for row in self.conn.execute('SELECT doc FROM tokens WHERE term = ?', (term,))}
+
+    def prefix_docs(self, prefix):
+        with self.lock:
+            return {row[0] for row in self.conn.execute('SELECT doc FROM tokens WHERE term >= ? AND term < ?', (prefix, prefix + '\U0010ffff'))}
+
+    def field_docs(self, field, value):
+        """Docs by metadata, field is 'ext' or 'path' (a case-insensitive glob over the full path)"""
+        with self.lock:
+            if field == 'ext':
+                rows = self.conn.execute('SELECT id FROM docs WHERE ext = ?', (value,))
+            elif field == 'path':
+                rows = self.conn.execute('SELECT id FROM docs WHERE lower(path) GLOB ?', (value.lower(),))
+            else:
+                raise ValueError(f'Unknown field {field}')
+            return {row[0] for row in rows}
+
+    def set_metadata(self, rows):
+        """Record (path, size, mtime, width, height, confidence) rows, as kept by the text store"""
+        with self.lock:
+            self.conn.executemany(
+                'UPDATE docs SET size = ?, mtime = ?, width = ?, height = ?, confidence = ? WHERE path = ?',
+                ((size, mtime, width, height, confidence, path) for path, size, mtime, width, height, confidence in rows),
+            )
+            self.conn.commit()
+            self.generation += 1
+
+    def confidences(self, paths, batch_size=512):
+        """Map paths to their OCR confidence, paths without one are left out"""
+        paths = list(paths)
+        confidences = {}
+        with self.lock:
+            for i in range(0, len(paths), batch_size):
+                batch = paths[i:i + batch_size]
+                confidences.update(self.conn.execute(f"SELECT path, confidence FROM docs WHERE confidence IS NOT NULL AND path IN ({','.join('?' * len(batch))})", batch))
+        return confidences
+
+    def median_confidence(self):
+        """Median OCR confidence of the documents that have one, None if none do. Cached until the next change."""
+        with self.lock:
+            if self.median is None or self.median[0] != self.generation:
+                # walks half of the confidence index, once per generation
+                row = self.conn.execute(
+                    'SELECT confidence FROM docs WHERE confidence IS NOT NULL ORDER BY confidence LIMIT 1 OFFSET (SELECT COUNT(confidence) / 2 FROM docs)'
+                ).fetchone()
+                self.median = (self.generation, None if row is None else row[0])
+            return self.median[1]
+
+    def paths_without_metadata(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT path FROM docs WHERE size IS NULL')]
+
+    def range_docs(self, column, low=None, high=None):
+        """Docs whose metadata column lies in [low, high), either bound may be None"""
+        if column not in self.metadata_columns:
+            raise ValueError(f'Unknown metadata column {column}')
+        conditions, args = [f'{column} IS NOT NULL'], []
+        if low is not None:
+            conditions.append(f'{column} >= ?')
+            args.append(low)
+        if high is not None:
+            conditions.append(f'{column} < ?')
+            args.append(high)
+        with self.lock:
+            return {row[0] for row in self.conn.execute(f"SELECT id FROM docs WHERE {' AND '.join(conditions)}", args)}
+
+    def sorted_paths(self, docs, column, descending=True, batch_size=512):
+        """Paths of docs ordered by a metadata column, docs missing it go last"""
+        if column not in self.metadata_columns:
+            raise ValueError(f'Unknown metadata column {column}')
+        docs = list(docs)
+        rows = []
+        with self.lock:
+            for i in range(0, len(docs), batch_size):
+                batch = docs[i:i + batch_size]
+                rows.extend(self.conn.execute(f"SELECT path, {column} FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch))
+        known = sorted((row for row in rows if row[1] is not None), key=lambda row: row[1], reverse=descending)
+        return [row[0] for row in known] + [row[0] for row in rows if row[1] is None]
+
+    def phrase_docs(self, words, within=None):
+        """Docs holding words as consecutive tokens, checked against the positional postings"""
+        docs = within
+        for word in set(words):
+            docs = self.term_docs(word) if docs is None else docs & self.term_docs(word)
+            if not docs:
+                return set()
+
+        matches = set()
+        with self.lock:
+            for doc in docs:
+                starts = None
+                for offset, word in enumerate(words):
+                    row = self.conn.execute('SELECT positions FROM tokens WHERE term = ? AND doc = ?', (word, doc)).fetchone()
+                    positions = array('I', row[0]) if row is not None and row[0] is not None else array('I')
+                    shifted = {position - offset for position in positions}
+                    starts = shifted if starts is None else starts & shifted
+                    if not starts:
+                        break
+                if starts:
+                    matches.add(doc)
+        return matches
+
+    def paths_for_docs(self, docs, batch_size=512):
+        docs = list(docs)
+        paths = []
+        with self.lock:
+            for i in range(0, len(docs), batch_size):
+                batch = docs[i:i + batch_size]
+                paths.extend(row[0] for row in self.conn.execute(f"SELECT path FROM docs WHERE id IN ({','.join('?' * len(batch))})", batch))
+        return paths
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class IncrementalSearch:
+    """
+    Candidate lookup for search-as-you-type over an InvertedIndex.
+
+    Every word of the query but the last has to appear as a token, the last one only as the
+    prefix of a token unless the query ends on a separator. A query that extends the previous
+    one can only match fewer documents, so its candidates are filtered out of the previous set
+    in memory instead of going back to the index. That includes sets cut off at max_candidates:
+    typing on only narrows down the best matches of the shorter query rather than summing the
+    postings of the commonest terms again on every keystroke.
+    """
+
+    def __init__(self, index, max_candidates=2**14, min_prefix=2):
+        self.index = index
+        self.max_candidates = max_candidates
+        self.min_prefix = min_prefix
+        self.lock = threading.Lock()
+        self.last = None  # (query, index generation, candidates) of the previous lookup
+
+    def parse(self, query):
+        """Split query into (words, prefix), prefix is None when the last word is finished"""
+        words = tokenize(query)
+        if words and token_pattern.fullmatch(query[-1:]):
+            return words[:-1], words[-1]
+        return words, None
+
+    def matcher(self, words, prefix):
+        patterns = [rf'(?<!\w){re.escape(word)}(?!\w)' for word in words]
+        if prefix is not None:
+            patterns.append(rf'(?<!\w){re.escape(prefix)}')
+        patterns = [re.compile(pattern) for pattern in patterns]
+        return lambda text: all(pattern.search(text) for pattern in patterns)
+
+    def snippets(self, query, texts, margin=None):
+        """
+        The part of each (lowercase) text around the first occurrence of the first word of query,
+        margin characters (twice the query length by default) either side. Scoring the snippet
+        instead of the whole text keeps long OCR dumps from costing more than short ones.
+        """
+        words, prefix = self.parse(query)
+        first = words[0] if words else prefix
+        if first is None:
+            return list(texts)
+        pattern = re.compile(rf'(?<!\w){re.escape(first)}')
+        margin = 2 * len(query) if margin is None else margin
+        snippets = []
+        for text in texts:
+            match = pattern.search(text)
+            snippets.append(text if match is None else text[max(0, match.start() - margin):match.end() + margin])
+        return snippets
+
+    def candidates(self, query, texts):
+        """
+        Paths that match query as typed so far, texts maps paths to their OCR text. Returns None
+        when the query is still too short to narrow anything down.
+        """
+        words, prefix = self.parse(query)
+        if not words and (prefix is None or len(prefix) < self.min_prefix):
+            return None
+        # a trailing separator is kept, it's what turns the last word from a prefix into a whole token
+        query = whitespace_pattern.sub(' ', query.lower()).lstrip()
+
+        generation = self.index.generation
+        with self.lock:
+            last = self.last
+        if last is not None and last[1] == generation and query.startswith(last[0]):
+            match = self.matcher(words, prefix)
+            candidates = [path for path in last[2] if match((texts.get(path) or '').lower())]
+        else:
+            candidates = self.index.token_candidates(words, prefix, limit=self.max_candidates)
+
+        with self.lock:
+            self.last = (query, generation, candidates)
+        return candidates
+
+
+class QueryCache:
+    """
+    LRU cache of ranked hit lists keyed by (normalised query, engine, index generation).
+    Everything cached is dropped as soon as the index generation moves on.
+    """
+
+    def __init__(self, index, max_entries=32):
+        self.index = index
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = index.generation
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, query, engine):
+        # trailing separators are kept, they change what search-as-you-type matches,
+        # the query engine's operators are case sensitive so its queries keep their case
+        if engine != 'query':
+            query = query.lower()
+        return whitespace_pattern.sub(' ', query).lstrip(), engine, self.generation
+
+    def expire(self):
+        if self.index.generation != self.generation:
+            self.entries.clear()
+            self.generation = self.index.generation
+
+    def get(self, query, engine):
+        with self.lock:
+            self.expire()
+            key = self.key(query, engine)
+            ranked = self.entries.get(key)
+            if ranked is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return ranked
+
+    def put(self, query, engine, ranked, generation):
+        """Cache ranked, generation being the index generation it was ranked against"""
+        with self.lock:
+            self.expire()
+            if generation != self.generation:
+                return
+            key = self.key(query, engine)
+            self.entries[key] = ranked
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
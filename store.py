@@ -0,0 +1,263 @@
+import os
+import sqlite3
+import threading
+
+from word_boxes import format_version
+
+
+class TextStore:
+    """
+    Single-file SQLite store for the OCR results, replacing the cluster of chunk pickles.
+
+    One row per path holding its mtime, size, inode, content hash, pixel dimensions, OCR text, packed
+    word boxes (see word_boxes.pack_words, NULL unless the OCR stage recorded them), OCR confidence,
+    the number of low confidence retries spent on the content, and status, where
+    status is 'ok' for a finished OCR (text may be empty), 'no_text' when the prefilter decided
+    the image holds no text, 'failed' when the pipeline crashed or timed out on the file (text is
+    None) and 'deleted' for tombstoned paths.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                inode INTEGER,
+                hash TEXT,
+                width INTEGER,
+                height INTEGER,
+                text TEXT,
+                words BLOB,
+                confidence REAL,
+                retries INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(files)')}
+        if 'inode' not in columns:  # stores created before change detection
+            self.conn.execute('ALTER TABLE files ADD COLUMN inode INTEGER')
+        if 'width' not in columns:  # stores created before the metadata filters
+            self.conn.execute('ALTER TABLE files ADD COLUMN width INTEGER')
+            self.conn.execute('ALTER TABLE files ADD COLUMN height INTEGER')
+        if 'words' not in columns:  # stores created before word boxes
+            self.conn.execute('ALTER TABLE files ADD COLUMN words BLOB')
+        if 'confidence' not in columns:  # stores created before confidence tracking
+            self.conn.execute('ALTER TABLE files ADD COLUMN confidence REAL')
+            self.conn.execute('ALTER TABLE files ADD COLUMN retries INTEGER NOT NULL DEFAULT 0')
+        # word boxes packed before the format carried a version byte can't be told apart from the current layout, drop them
+        # (the files keep their text and confidence, they just show whole thumbnails until they're OCR'd again)
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'words_format'").fetchone()
+        if row is None or row[0] != str(format_version):
+            self.conn.execute('UPDATE files SET words = NULL')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('words_format', ?)", (str(format_version),))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_confidence ON files (confidence)')
+        self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def get(self, path):
+        """Point lookup, returns a dict of the row or None"""
+        with self.lock:
+            cursor = self.conn.execute('SELECT * FROM files WHERE path = ?', (path,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    def put_many(self, items, stat=True, hashes=None, dimensions=None, words=None, confidences=None):
+        """
+        Persist (path, text) pairs, or (path, text, status) triples, in one transaction with content
+        hashes, (width, height) pixel dimensions, packed word boxes and OCR confidences looked up from
+        the optional hashes, dimensions, words and confidences dicts. Rows given no dimensions or
+        confidence, like texts reused by hash, take them from a result sharing their hash. A None
+        text is recorded as 'failed' but never overwrites an existing successful result. The retry
+        count survives as long as the content hash stays the same.
+        """
+        hashes = hashes or {}
+        dimensions = dimensions or {}
+        words = words or {}
+        confidences = confidences or {}
+        rows = []
+        for path, text, *status in items:
+            mtime = size = inode = None
+            if stat:
+                try:
+                    st = os.stat(path)
+                    mtime, size, inode = st.st_mtime, st.st_size, st.st_ino
+                except OSError:
+                    pass
+            status = status[0] if status else 'failed' if text is None else 'ok'
+            width, height = dimensions.get(path, (None, None))
+            rows.append((path, mtime, size, inode, hashes.get(path), width, height, text, words.get(path), confidences.get(path), status))
+
+        with self.lock:
+            for i, row in enumerate(rows):
+                if row[4] is not None and (row[5] is None or row[9] is None):
+                    twin = self.conn.execute("""
+                        SELECT width, height, confidence FROM files WHERE hash = ? AND path != ? AND status IN ('ok', 'no_text')
+                        ORDER BY width IS NULL, confidence IS NULL LIMIT 1
+                    """, (row[4], row[0])).fetchone()
+                    if twin is not None:
+                        width, height = row[5:7] if row[5] is not None else twin[:2]
+                        rows[i] = (*row[:5], width, height, *row[7:9], twin[2] if row[9] is None else row[9], row[10])
+            self.conn.executemany("""
+                INSERT INTO files (path, mtime, size, inode, hash, width, height, text, words, confidence, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    mtime = excluded.mtime, size = excluded.size, inode = excluded.inode, hash = excluded.hash,
+                    width = coalesce(excluded.width, files.width), height = coalesce(excluded.height, files.height),
+                    text = excluded.text, words = excluded.words, confidence = excluded.confidence, status = excluded.status,
+                    retries = CASE WHEN excluded.hash IS files.hash THEN files.retries ELSE 0 END
+                WHERE excluded.status != 'failed' OR files.status != 'ok'
+            """, rows)
+            self._count_write()
+            self.conn.commit()
+        return len(rows)
+
+    def signatures(self):
+        """Map every live path to its (size, mtime, inode, hash) as recorded at index time"""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, size, mtime, inode, hash FROM files WHERE status != 'deleted'").fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def texts_for_hashes(self, hashes, batch_size=512):
+        """Map each content hash that already has a successful OCR result (or a no_text verdict) to its text"""
+        hashes = [digest for digest in hashes if digest is not None]
+        texts = {}
+        with self.lock:
+            for i in range(0, len(hashes), batch_size):
+                batch = hashes[i:i + batch_size]
+                texts.update(self.conn.execute(f"SELECT hash, text FROM files WHERE status IN ('ok', 'no_text') AND hash IN ({','.join('?' * len(batch))})", batch).fetchall())
+        return texts
+
+    def paths_for_hash(self, digest):
+        """Every live path sharing the content hash"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT path FROM files WHERE hash = ? AND status != 'deleted' ORDER BY path", (digest,))]
+
+    def paths_under(self, directory):
+        """Every live path inside directory, at any depth"""
+        prefix = os.path.join(directory, '')
+        with self.lock:
+            # range scan over the primary key, the upper bound sorts after anything starting with prefix
+            return [row[0] for row in self.conn.execute("SELECT path FROM files WHERE path >= ? AND path < ? AND status != 'deleted'", (prefix, prefix + '\U0010ffff'))]
+
+    def hashes_for_paths(self, paths):
+        hashes = {}
+        with self.lock:
+            for path in paths:
+                row = self.conn.execute('SELECT hash FROM files WHERE path = ?', (path,)).fetchone()
+                if row is not None and row[0] is not None:
+                    hashes[path] = row[0]
+        return hashes
+
+    def metadata(self, paths, batch_size=512):
+        """(path, size, mtime, width, height, confidence) rows for the given paths"""
+        paths = list(paths)
+        rows = []
+        with self.lock:
+            for i in range(0, len(paths), batch_size):
+                batch = paths[i:i + batch_size]
+                rows.extend(self.conn.execute(f"SELECT path, size, mtime, width, height, confidence FROM files WHERE path IN ({','.join('?' * len(batch))})", batch))
+        return rows
+
+    def paths_without_dimensions(self):
+        """Live paths with a result but no pixel dimensions, rows from before the metadata filters mostly"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT path FROM files WHERE width IS NULL AND status IN ('ok', 'no_text')")]
+
+    def set_dimensions(self, items):
+        """Record the (path, width, height) of files whose dimensions were read after the fact"""
+        with self.lock:
+            self.conn.executemany('UPDATE files SET width = ?, height = ? WHERE path = ?', ((width, height, path) for path, width, height in items))
+            self.conn.commit()
+
+    def words(self, path):
+        """Packed word boxes of path, falling back to a duplicate's when the text was reused by hash. None if there are none."""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT words FROM files
+                WHERE words IS NOT NULL AND status != 'deleted' AND (path = ? OR hash = (SELECT hash FROM files WHERE path = ?))
+                ORDER BY path = ? DESC LIMIT 1
+            """, (path, path, path)).fetchone()
+        return None if row is None else row[0]
+
+    def low_confidence(self, threshold, max_retries, limit=None):
+        """
+        One path per content of the successful results whose OCR confidence is below threshold and
+        that were retried fewer than max_retries times, least confident first
+        """
+        with self.lock:
+            return [row[0] for row in self.conn.execute("""
+                SELECT min(path) FROM files
+                WHERE status = 'ok' AND confidence < ? AND retries < ?
+                GROUP BY coalesce(hash, path) ORDER BY min(confidence) LIMIT ?
+            """, (threshold, max_retries, -1 if limit is None else limit))]
+
+    def count_retries(self, paths):
+        with self.lock:
+            self.conn.executemany('UPDATE files SET retries = retries + 1 WHERE path = ?', ((path,) for path in paths))
+            self.conn.commit()
+
+    def touch(self, items):
+        """Refresh the recorded (path, size, mtime, inode) of files whose content didn't change"""
+        with self.lock:
+            self.conn.executemany('UPDATE files SET size = ?, mtime = ?, inode = ? WHERE path = ?', ((size, mtime, inode, path) for path, size, mtime, inode in items))
+            self.conn.commit()
+
+    def tombstone(self, paths):
+        with self.lock:
+            self.conn.executemany("UPDATE files SET status = 'deleted', text = NULL, words = NULL WHERE path = ?", ((path,) for path in paths))
+            self._count_write()
+            self.conn.commit()
+
+    def iter_texts(self, batch_size=4096):
+        """Stream (path, text) pairs of live paths without materialising the whole table"""
+        cursor = self.conn.cursor()
+        with self.lock:
+            cursor.execute("SELECT path, text FROM files WHERE status != 'deleted'")
+            rows = cursor.fetchmany(batch_size)
+        while rows:
+            yield from rows
+            with self.lock:
+                rows = cursor.fetchmany(batch_size)
+
+    def _count_write(self):
+        self.conn.execute("INSERT INTO meta VALUES ('writes', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1")
+
+    def write_count(self):
+        """Bumped by every write that changes texts, lets derived indexes tell whether they're behind the store"""
+        return self.get_meta('writes', '0')
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+            self.conn.commit()
+
+    def compact(self):
+        """Purge tombstones and reclaim the space left behind by updated rows"""
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE status = 'deleted'")
+            self.conn.commit()
+            self.conn.execute('VACUUM')
+            self.conn.execute('ANALYZE')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,89 @@
+import os
+
+from corpus import Corpus
+
+
+def test_save_and_reopen(tmp_path):
+    folder = str(tmp_path / 'corpus')
+    corpus = Corpus(folder)
+    corpus.update([('C:\\a\\1.png', 'one'), ('/b/2.png', 'two'), ('/b/3.png', 'three')])
+    corpus.save('4')
+    corpus.update([('/b/2.png', 'two again')])
+    corpus.remove(['/b/3.png'])
+    corpus.save('6')
+
+    reopened = Corpus(folder)
+    assert reopened.stamp == '6'
+    assert len(reopened) == 2
+    assert dict(reopened.items()) == {'C:\\a\\1.png': 'one', '/b/2.png': 'two again'}
+    assert reopened.get('/b/3.png') is None
+
+
+def test_saves_append_segments_until_compaction(tmp_path):
+    folder = str(tmp_path / 'corpus')
+    corpus = Corpus(folder, max_segments=3, compact_fraction=10)
+    corpus.rebuild([(f'/{i}.png', f'text {i}') for i in range(10)], '1')
+    corpus.update([('/0.png', 'changed')])
+    corpus.save('2')
+    assert len(corpus.snapshot().segments) == 2
+
+    corpus.remove(['/1.png'])
+    corpus.save('3')
+    corpus.update([('/new.png', 'new')])
+    corpus.save('4')
+    assert len(corpus.snapshot().segments) == 1
+    assert sorted(entry for entry in os.listdir(folder) if entry != 'current') == [str(corpus.snapshot().ids[0])]
+
+    expected = {f'/{i}.png': f'text {i}' for i in range(2, 10)}
+    expected.update({'/0.png': 'changed', '/new.png': 'new'})
+    assert dict(corpus.items()) == expected
+    assert dict(Corpus(folder).items()) == expected
+    assert sum(len(paths) for paths, _ in corpus.chunks(chunk_size=3)) == len(expected)
+
+
+def test_readers_keep_their_state(tmp_path):
+    corpus = Corpus(str(tmp_path / 'corpus'))
+    corpus.update([('/a.png', 'old')])
+    corpus.save()
+    state = corpus.snapshot()
+    corpus.update([('/a.png', 'new')])
+    corpus.save()
+
+    assert corpus.get('/a.png') == 'new'
+    assert Corpus.find(state.segments, state.alive, '/a.png') is not None
+    assert state.extra == {}
+
+
+def test_opens_single_generation_folders(tmp_path):
+    folder = str(tmp_path / 'corpus')
+    corpus = Corpus(folder)
+    corpus.rebuild([('/a.png', 'text')], '3')
+    # folders written before segments hold "<generation>\n<stamp>" and no dead.npy
+    os.remove(os.path.join(folder, str(corpus.snapshot().ids[0]), 'dead.npy'))
+
+    reopened = Corpus(folder)
+    assert reopened.stamp == '3'
+    assert reopened['/a.png'] == 'text'
+
+
+def test_updates_during_a_save_stay_in_the_overlay(tmp_path):
+    folder = str(tmp_path / 'corpus')
+    corpus = Corpus(folder, compact_fraction=10)
+    corpus.rebuild([('/a.png', 'a'), ('/b.png', 'b')], '1')
+    corpus.update([('/a.png', 'a2'), ('/c.png', 'c')])
+
+    new_segment = corpus.new_segment
+
+    def write_then_update(*args):
+        segment_id = new_segment(*args)
+        corpus.update([('/a.png', 'a3')])
+        corpus.remove(['/c.png', '/b.png'])
+        return segment_id
+
+    corpus.new_segment = write_then_update
+    corpus.save('2')
+    corpus.new_segment = new_segment
+    assert dict(corpus.items()) == {'/a.png': 'a3'}
+
+    corpus.save('3')
+    assert dict(Corpus(folder).items()) == {'/a.png': 'a3'}
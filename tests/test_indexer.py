@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+
+import pytest
+
+from indexer import FileWatcher, WatchEvent, WatchQueue, detect_changes, plan_tasks, content_hash
+from store import TextStore
+
+
+def write_image(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data * 1000)  # past plan_tasks' min_size
+    return str(path)
+
+
+def test_only_touched_files_skip_ocr(tmp_path):
+    store = TextStore(str(tmp_path / 'store.db'))
+    same, touched, edited = (write_image(tmp_path / f'{name}.png', name.encode()) for name in ('same', 'touched', 'edited'))
+    store.put_many([(path, 'text') for path in (same, touched, edited)], hashes={path: content_hash(path) for path in (same, touched, edited)})
+    os.utime(touched, (1, 1))
+    write_image(tmp_path / 'edited.png', b'EDITED')
+    fresh = write_image(tmp_path / 'fresh.png', b'fresh')
+
+    changes = detect_changes(store, [same, touched, edited, fresh], roots=[str(tmp_path)])
+    assert sorted(path for path, _ in changes.queued) == [edited, fresh]
+    assert [item[0] for item in changes.touched] == [touched]
+    assert changes.unchanged == 1 and changes.deleted == []
+
+    plan_tasks(store, changes)
+    assert detect_changes(store, [same, touched], roots=[str(tmp_path / 'elsewhere')]).unchanged == 2
+
+
+def test_tombstones_stay_under_the_scanned_roots(tmp_path):
+    store = TextStore(str(tmp_path / 'store.db'))
+    scanned, unplugged = str(tmp_path / 'scanned' / 'a.png'), str(tmp_path / 'unplugged' / 'b.png')
+    store.put_many([(scanned, 'a'), (unplugged, 'b')], stat=False)
+
+    changes = detect_changes(store, [], roots=[str(tmp_path / 'scanned')])
+    assert changes.deleted == [scanned]
+    plan_tasks(store, changes)
+    assert store.get(scanned)['status'] == 'deleted'
+    assert store.get(unplugged)['text'] == 'b'
+
+
+def test_duplicates_are_ocrd_once(tmp_path):
+    store = TextStore(str(tmp_path / 'store.db'))
+    copies = [write_image(tmp_path / folder / 'a.png', b'same') for folder in ('one', 'two', 'three')]
+    other = write_image(tmp_path / 'other.png', b'other')
+    tiny = str(tmp_path / 'tiny.png')
+    (tmp_path / 'tiny.png').write_bytes(b'x')
+
+    plan = plan_tasks(store, detect_changes(store, [*copies, other, tiny]))
+    assert tiny not in plan.queued_files
+    assert len(plan.task_files) == 2 and other in plan.task_files
+    digest = plan.file_hashes[copies[0]]
+    assert sorted(plan.duplicates[digest]) == sorted(copies)
+    assert plan.reused == []
+
+
+def test_known_content_reuses_its_text(tmp_path):
+    store = TextStore(str(tmp_path / 'store.db'))
+    original = write_image(tmp_path / 'original.png', b'content')
+    store.put_many([(original, 'hello')], hashes={original: content_hash(original)})
+    copy = write_image(tmp_path / 'copy.png', b'content')
+
+    plan = plan_tasks(store, detect_changes(store, [original, copy]))
+    assert plan.reused == [(copy, 'hello')]
+    assert plan.task_files == []
+    assert store.get(copy)['text'] == 'hello'
+    assert detect_changes(store, [original, copy]).unchanged == 2
+
+
+def test_watch_queue_keeps_one_rescan():
+    events = WatchQueue()
+    events.put(WatchEvent('rescan', ['a']))
+    events.put(WatchEvent('changed', ['b']))
+    events.put(WatchEvent('rescan', ['a', 'c']))
+    assert events.has_rescan()
+
+    assert events.get() == WatchEvent('rescan', ['a', 'c'])
+    assert events.get() == WatchEvent('changed', ['b'])
+    assert events.empty() and not events.has_rescan()
+
+
+def test_polling_waits_for_the_pending_rescan(tmp_path):
+    (tmp_path / 'a.png').write_bytes(b'x')
+    events = WatchQueue()
+    watcher = FileWatcher([str(tmp_path)], events.put, extensions=('.png',), interval=0.01, rescan_pending=events.has_rescan)
+    thread = threading.Thread(target=watcher.run_polling, daemon=True)
+    thread.start()
+    time.sleep(0.3)
+    watcher.stop()
+    thread.join()
+
+    assert events.qsize() == 1
+    assert events.get().paths == [str(tmp_path / 'a.png')]
+
+
+def test_moved_directory_deletes_what_was_indexed_under_it(tmp_path):
+    pytest.importorskip('inotify_simple')
+    watched, outside = tmp_path / 'watched', tmp_path / 'outside'
+    (watched / 'album').mkdir(parents=True)
+    outside.mkdir()
+    (watched / 'album' / 'a.png').write_bytes(b'x')
+    indexed = [str(watched / 'album' / 'a.png'), str(watched / 'album' / 'deeper' / 'b.png'), str(watched / 'other.png')]
+
+    events = WatchQueue()
+    watcher = FileWatcher(
+        [str(watched)], events.put, extensions=('.png',), settle=0.2,
+        paths_under=lambda directory: [path for path in indexed if path.startswith(directory + os.sep)],
+    )
+    thread = threading.Thread(target=watcher.run_inotify, daemon=True)
+    thread.start()
+    time.sleep(0.3)
+    os.rename(watched / 'album', outside / 'album')
+    event = events.get(timeout=5)
+    watcher.stop()
+    thread.join()
+
+    assert event == WatchEvent('deleted', sorted(indexed[:2]))
@@ -0,0 +1,69 @@
+import pytest
+
+from query import parse_query, evaluate, is_structured, plan_words, Term, Phrase, Prefix, Field, Not, And, Or
+from search_index import InvertedIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = InvertedIndex(str(tmp_path / 'index.db'))
+    index.add_documents([
+        ('/shots/a.png', 'black and white cat'),
+        ('/shots/b.jpg', 'white black dog'),
+        ('/docs/c.png', 'invoice total due'),
+    ])
+    return index
+
+
+def search(index, query):
+    return set(index.paths_for_docs(evaluate(parse_query(query), index)))
+
+
+@pytest.mark.parametrize('query', [
+    'meeting at 12:30',
+    'C:\\Users\\me\\Pictures',
+    'https://example.com/page',
+    'note: call back',
+    'black or white',
+    'error: file not found',
+    'this and that',
+    'ratio 16:9',
+    '"exact phrase"',
+    'plain words',
+])
+def test_plain_text_stays_with_the_fuzzy_engines(query):
+    assert not is_structured(query)
+
+
+@pytest.mark.parametrize('query', [
+    'cat OR dog',
+    'cat -dog',
+    'NOT dog',
+    'ext:png cat',
+    'path:*shots* cat',
+    'black "and white"',
+    'sort:date cat',
+    'Ext:PNG cat',
+])
+def test_query_language_is_routed_to_the_query_engine(query):
+    assert is_structured(query)
+
+
+def test_parse_plans():
+    assert parse_query('cat') == Term('cat')
+    assert parse_query('cat OR dog') == Or([Term('cat'), Term('dog')])
+    assert parse_query('cat -dog') == And([Term('cat'), Not(Term('dog'))])
+    assert parse_query('"black and" whi*') == And([Phrase(['black', 'and']), Prefix('whi')])
+    assert parse_query('ext:.PNG') == Field('ext', 'png')
+    assert parse_query('(') is None
+    assert plan_words(parse_query('cat OR "white dog" -bird')) == ['cat', 'white dog']
+
+
+def test_evaluate(index):
+    assert search(index, 'white') == {'/shots/a.png', '/shots/b.jpg'}
+    assert search(index, 'white -cat') == {'/shots/b.jpg'}
+    assert search(index, 'cat OR invoice') == {'/shots/a.png', '/docs/c.png'}
+    assert search(index, '"black and white"') == {'/shots/a.png'}
+    assert search(index, 'ext:png') == {'/shots/a.png', '/docs/c.png'}
+    assert search(index, 'path:/shots/* NOT dog') == {'/shots/a.png'}
+    assert search(index, 'inv*') == {'/docs/c.png'}
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+from ranking import RankingIndex
+
+words = ['alpha', 'beta', 'gamma', 'delta', 'invoice', 'total', 'receipt', 'screenshot', 'error', 'report']
+
+
+def random_texts(count, seed=0):
+    rng = random.Random(seed)
+    return {f'{i}.png': ' '.join(rng.choice(words) for _ in range(rng.randint(1, 30))) for i in range(count)}
+
+
+def assert_same_ranking(first, second):
+    assert [path for path, _ in first] == [path for path, _ in second]
+    assert [score for _, score in first] == pytest.approx([score for _, score in second])
+
+
+@pytest.mark.parametrize('method', ['bm25', 'tfidf'])
+def test_delta_rows_rank_like_a_saved_matrix(tmp_path, method):
+    texts = random_texts(300)
+    index = RankingIndex(str(tmp_path / 'ranking.npz'))
+    items = list(texts.items())
+    for i in range(0, len(items), 40):
+        index.add_documents(items[i:i + 40])
+        index.search('invoice total', method)  # builds the base and delta copies between publishes
+    index.add_documents([('3.png', 'invoice invoice zeta')])
+    index.remove_documents(['5.png', '250.png'])
+    live = index.search('invoice total zeta', method)
+
+    index.save()
+    reloaded = RankingIndex(str(tmp_path / 'ranking.npz'))
+    assert len(reloaded) == len(index) == 298
+    assert_same_ranking(live, reloaded.search('invoice total zeta', method))
+    assert live[0][0] == '3.png'
+
+
+def test_stamp_mismatch_resyncs_changed_texts(tmp_path):
+    texts = random_texts(50)
+    index = RankingIndex(str(tmp_path / 'ranking.npz'))
+    index.sync(texts)
+    index.save('7')
+
+    texts['1.png'] = 'completely different words'
+    reloaded = RankingIndex(str(tmp_path / 'ranking.npz'))
+    assert reloaded.stamp == '7'
+    assert reloaded.sync(texts) == (0, 0)
+    assert reloaded.sync(texts, check_texts=True) == (1, 0)
+    assert reloaded.search('completely')[0][0] == '1.png'
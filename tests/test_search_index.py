@@ -0,0 +1,172 @@
+import random
+
+import pytest
+from rapidfuzz import fuzz
+
+from search_index import InvertedIndex, IncrementalSearch, QueryCache
+
+
+def random_text(rng, words=40):
+    return ' '.join(''.join(rng.choice('abcdehinorstu') for _ in range(rng.randint(1, 8))) for _ in range(words))
+
+
+def mutate(rng, text, edits):
+    text = list(text)
+    for _ in range(edits):
+        i = rng.randrange(len(text))
+        operation = rng.choice('sid')
+        if operation == 's':
+            text[i] = rng.choice('abcdehinorstu ')
+        elif operation == 'i':
+            text.insert(i, rng.choice('abcdehinorstu '))
+        elif len(text) > 1:
+            del text[i]
+    return ' '.join(''.join(text).split())
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = InvertedIndex(str(tmp_path / 'index.db'))
+    yield index
+    index.close()
+
+
+@pytest.mark.parametrize('score_cutoff', [90, 95])
+def test_candidates_match_brute_force(index, score_cutoff):
+    # at these cutoffs the n-gram bound applies, which never misses a match
+    rng = random.Random(score_cutoff)
+    texts = {f'{i}.png': random_text(rng) for i in range(300)}
+    index.add_documents(texts.items())
+
+    for _ in range(60):
+        source = rng.choice(list(texts.values()))
+        start = rng.randrange(len(source) - 20)
+        query = mutate(rng, source[start:start + rng.randint(8, 20)], rng.randint(0, 3))
+        expected = {path for path, text in texts.items() if fuzz.partial_ratio(query, text) > score_cutoff}
+
+        candidates = index.candidates(query, score_cutoff=score_cutoff)
+        if candidates is None:  # full scan, nothing can be missed
+            continue
+        assert expected <= set(candidates), query
+
+
+def test_fuzzy_candidates_at_the_default_cutoff_come_from_the_vocabulary(index):
+    index.add_documents([
+        ('a.png', 'quarterly invoice total due'),
+        ('b.png', 'screenshots of the game'),
+        ('c.png', 'the holiday photos'),
+        ('d.png', 'the cat'),
+    ])
+    assert set(index.candidates('invoce totl')) == {'a.png'}
+    assert set(index.candidates('screen')) == {'b.png'}
+    assert index.candidates('zzzz qqqq') == []
+    assert set(index.candidates('qu ph')) == {'a.png', 'c.png'}
+    assert index.candidates('the') is None  # in half the documents, a scan is cheaper
+
+
+def test_term_statistics_follow_the_postings(index, tmp_path):
+    index.add_documents([('a.png', 'red red blue'), ('b.png', 'red green')])
+    index.add_documents([('b.png', 'green')])
+    index.remove_documents(['a.png'])
+    assert index.vocabulary() == ['green']
+    assert index.conn.execute('SELECT term, docs FROM terms').fetchall() == [('green', 1)]
+
+    # indexes from before the terms table get it filled in from the postings
+    index.conn.execute('DROP TABLE terms')
+    index.conn.commit()
+    reopened = InvertedIndex(str(tmp_path / 'index.db'))
+    assert reopened.vocabulary() == ['green']
+
+
+def test_exact_candidates(index):
+    index.add_documents([('a.png', 'invoice total 42'), ('b.png', 'total recall'), ('c.png', 'nothing here')])
+    assert set(index.candidates('invoice total', exact=True)) == {'a.png'}
+    assert set(index.candidates('total', exact=True)) == {'a.png', 'b.png'}
+
+
+def test_replacing_and_removing_documents(index):
+    index.add_documents([('a.png', 'old words')])
+    index.add_documents([('a.png', 'new words')])
+    assert index.term_docs('old') == set()
+    assert len(index.term_docs('new')) == 1
+
+    generation = index.generation
+    index.remove_documents(['a.png'])
+    assert len(index) == 0
+    assert index.generation > generation
+
+
+def test_phrase_docs(index):
+    index.add_documents([('a.png', 'black and white cat'), ('b.png', 'white black cat')])
+    docs = index.phrase_docs(['black', 'and', 'white'])
+    assert index.paths_for_docs(docs) == ['a.png']
+
+
+def test_incremental_search_reuses_and_narrows(index):
+    texts = {'a.png': 'foo bar', 'b.png': 'foobar baz', 'c.png': 'food'}
+    index.add_documents(texts.items())
+    search = IncrementalSearch(index)
+
+    assert search.candidates('f', texts) is None
+    assert set(search.candidates('fo', texts)) == {'a.png', 'b.png', 'c.png'}
+    assert set(search.candidates('foo ', texts)) == {'a.png'}
+    assert set(search.candidates('foo b', texts)) == {'a.png'}
+
+
+def test_capped_prefix_candidates_keep_the_best_matches(index):
+    texts = {f'{i}.png': 'filler ' * 20 + 'other' for i in range(50)}
+    texts['best.png'] = 'report report report'
+    texts['good.png'] = 'report filler'
+    index.add_documents(texts.items())
+
+    assert set(index.token_candidates([], 're')) == {'best.png', 'good.png'}
+    assert index.token_candidates([], 're', limit=1) == ['best.png']
+    assert index.token_candidates(['filler'], 'rep', limit=5) == ['good.png']
+
+
+def test_capped_candidates_narrow_as_the_query_grows(index, monkeypatch):
+    texts = {'best.png': 'report report report', 'good.png': 'report report filler', 'other.png': 'reply'}
+    index.add_documents(texts.items())
+    search = IncrementalSearch(index, max_candidates=2)
+
+    assert search.candidates('re', texts) == ['best.png', 'good.png']
+    monkeypatch.setattr(index, 'token_candidates', None)  # extending queries never go back to the postings
+    assert search.candidates('report f', texts) == ['good.png']
+
+
+def test_snippets_cut_around_the_match():
+    search = IncrementalSearch(None)
+    text = 'x' * 1000 + ' invoice total ' + 'y' * 1000
+    snippet, = search.snippets('invoice to', [text])
+    assert 'invoice total' in snippet
+    assert len(snippet) < 100
+    assert search.snippets('nothing', ['no match here']) == ['no match here']
+
+
+def test_query_cache_expires_with_the_index(index):
+    cache = QueryCache(index, max_entries=2)
+    cache.put('Hello', 'fuzzy', ['a'], index.generation)
+    assert cache.get('hello', 'fuzzy') == ['a']
+
+    index.add_documents([('a.png', 'hello')])
+    assert cache.get('hello', 'fuzzy') is None
+
+    cache.put('hello', 'fuzzy', ['a'], index.generation)
+    index.set_metadata([('a.png', 1, 1, 1, 1, 50.0)])
+    assert cache.get('hello', 'fuzzy') is None
+
+
+def test_query_cache_keeps_operator_case(index):
+    cache = QueryCache(index)
+    cache.put('cat  AND dog', 'query', ['a'], index.generation)
+    assert cache.get('cat AND dog', 'query') == ['a']
+    assert cache.get('cat and dog', 'query') is None
+
+
+def test_median_confidence(index):
+    assert index.median_confidence() is None
+    index.add_documents([(f'{i}.png', 'text') for i in range(4)])
+    index.set_metadata([('0.png', 1, 1, 1, 1, 20.0), ('1.png', 1, 1, 1, 1, 90.0), ('2.png', 1, 1, 1, 1, 60.0)])
+    assert index.median_confidence() == 60.0
+    index.set_metadata([('3.png', 1, 1, 1, 1, 95.0)])
+    assert index.median_confidence() == 90.0
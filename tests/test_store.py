@@ -0,0 +1,63 @@
+import sqlite3
+
+from PIL import Image
+
+from store import TextStore
+from word_boxes import pack_words, format_version
+
+
+def test_reused_rows_copy_dimensions_and_confidence_by_hash(tmp_path):
+    store = TextStore(str(tmp_path / 'store.db'))
+    store.put_many([('/a.png', 'text')], stat=False, hashes={'/a.png': 'h'}, dimensions={'/a.png': (640, 480)}, confidences={'/a.png': 91.0})
+    store.put_many([('/b.png', 'text')], stat=False, hashes={'/b.png': 'h'})
+
+    assert store.get('/b.png')['width'] == 640
+    assert store.metadata(['/b.png']) == [('/b.png', None, None, 640, 480, 91.0)]
+
+
+def test_dimensions_backfill(tmp_path):
+    image = str(tmp_path / 'old.png')
+    Image.new('RGB', (300, 200)).save(image)
+    store = TextStore(str(tmp_path / 'store.db'))
+    store.put_many([(image, 'old text'), ('/gone.png', None)])
+
+    assert store.paths_without_dimensions() == [image]
+    store.set_dimensions([(image, 300, 200)])
+    assert store.paths_without_dimensions() == []
+    assert store.get(image)['height'] == 200
+
+
+def test_migrates_old_stores(tmp_path):
+    db = str(tmp_path / 'store.db')
+    conn = sqlite3.connect(db)
+    conn.executescript("""
+        CREATE TABLE files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT, text TEXT, status TEXT NOT NULL);
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        INSERT INTO files VALUES ('/a.png', 1.0, 10, 'h', 'hello', 'ok');
+    """)
+    conn.commit()
+    conn.close()
+
+    store = TextStore(db)
+    row = store.get('/a.png')
+    assert row['text'] == 'hello' and row['retries'] == 0
+    assert {'inode', 'width', 'height', 'words', 'confidence'} <= set(row)
+    assert store.get_meta('words_format') == str(format_version)
+    store.close()
+
+
+def test_drops_word_boxes_of_an_older_format(tmp_path):
+    db = str(tmp_path / 'store.db')
+    store = TextStore(db)
+    store.put_many([('/a.png', 'word')], stat=False, words={'/a.png': b'\x01\x00\x00\x00old layout'})
+    store.set_meta('words_format', 1)
+    store.close()
+
+    store = TextStore(db)
+    assert store.words('/a.png') is None
+    assert store.get('/a.png')['text'] == 'word'
+
+    blob = pack_words(['word'], [(0, 0, 1, 1)])
+    store.put_many([('/a.png', 'word')], stat=False, words={'/a.png': blob})
+    store.close()
+    assert TextStore(db).words('/a.png') == blob
@@ -0,0 +1,59 @@
+import struct
+
+import numpy as np
+import pytest
+
+from word_boxes import pack_words, unpack_words, unknown_confidence, document_confidence, matching_boxes, focus_region, source_boxes
+
+
+def test_pack_round_trip():
+    words = ['Größe', 'total:', '日本語']
+    boxes = [(0.1, 0.2, 0.3, 0.05), (0.5, 0.5, 0.25, 0.1), (0.0, 0.9, 1.0, 0.1)]
+    blob = pack_words(words, boxes, [87.4, None, -1])
+
+    unpacked_words, unpacked_boxes, confidences = unpack_words(blob)
+    assert unpacked_words == words
+    assert unpacked_boxes == pytest.approx(np.array(boxes), abs=1 / 65535)
+    assert confidences.tolist() == [87, unknown_confidence, unknown_confidence]
+
+
+def test_pack_empty():
+    words, boxes, confidences = unpack_words(pack_words([], []))
+    assert words == [] and boxes.shape == (0, 4) and len(confidences) == 0
+
+
+def test_blobs_without_the_format_byte_are_rejected():
+    # the layout from before the format byte: count, boxes, words
+    old = struct.pack('<I', 1) + np.array([0, 0, 100, 100], dtype='<u2').tobytes() + 'word'.encode('utf-8')
+    with pytest.raises(ValueError):
+        unpack_words(old)
+
+
+def test_matching_boxes_and_focus_region():
+    words, boxes, confidences = unpack_words(pack_words(['invoice', 'total', 'cat'], [(0.1, 0.1, 0.1, 0.05), (0.8, 0.8, 0.1, 0.05), (0.5, 0.5, 0.1, 0.1)], [90, 50, 10]))
+    matched = matching_boxes(words, boxes, 'invoce')
+    assert len(matched) == 1
+    left, top, right, bottom = focus_region(matched)
+    assert left <= 0.1 and right >= 0.2 and right - left == pytest.approx(0.25) and bottom - top == pytest.approx(0.25)
+    assert focus_region(boxes[:0]) is None
+    assert document_confidence(words, confidences) == pytest.approx((90 * 7 + 50 * 5 + 10 * 3) / 15)
+
+
+def test_boxes_found_after_preprocessing_map_back_onto_the_source():
+    utils = pytest.importorskip('utils')
+    from PIL import Image, ImageDraw
+
+    # a grey border for the crop to take off and a page big enough for max_pixels to shrink
+    img = Image.new('RGB', (1200, 600), (128, 128, 128))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((100, 100, 1099, 499), fill='white')
+    draw.rectangle((400, 250, 599, 299), fill='black')
+    profiles = {'default': {**utils.preprocess_profiles['default'], 'max_pixels': 100_000}}
+    result = utils.preprocess_for_ocr(img, profiles=profiles)
+    assert result.width < 1000 and result.info['ocr_frame'] != (0.0, 0.0, 1.0, 1.0)
+
+    ys, xs = np.nonzero(np.asarray(result.convert('L')) < 64)
+    found = [(xs.min(), ys.min(), xs.max() + 1 - xs.min(), ys.max() + 1 - ys.min())]
+    (left, top, width, height), = source_boxes(found, result.info['ocr_frame'], result.size)
+    assert left == pytest.approx(400 / 1200, abs=0.005) and top == pytest.approx(250 / 600, abs=0.005)
+    assert width == pytest.approx(200 / 1200, abs=0.005) and height == pytest.approx(50 / 600, abs=0.005)
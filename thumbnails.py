@@ -0,0 +1,168 @@
+import os
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+
+def encode_thumbnail(img, size, format='WEBP', quality=80):
+    """Shrink img to fit a size x size box and encode it, returns the encoded bytes"""
+    if img.width > size or img.height > size:
+        img = img.copy()
+        img.thumbnail((size, size), Image.LANCZOS)
+    if img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    if format == 'JPEG' and img.mode == 'RGBA':
+        img = img.convert('RGB')
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=format, quality=quality)
+    return buffer.getvalue()
+
+
+def highlight_crop(img, region, boxes, outline=(255, 200, 0), fill=(255, 200, 0, 64)):
+    """
+    Crop img to region and mark boxes on it, both given as fractions of the image
+    ((left, top, right, bottom) and (left, top, width, height) respectively)
+    """
+    left, top, right, bottom = region
+    crop = [round(value * scale) for value, scale in zip(region, img.size * 2)]
+    crop[2], crop[3] = max(crop[2], crop[0] + 1), max(crop[3], crop[1] + 1)
+    img = img.crop(crop).convert('RGBA')
+
+    overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    line_width = max(1, round(min(img.size) / 200))
+    for x, y, w, h in boxes:
+        box = (
+            (x - left) / (right - left) * img.width,
+            (y - top) / (bottom - top) * img.height,
+            (x + w - left) / (right - left) * img.width,
+            (y + h - top) / (bottom - top) * img.height,
+        )
+        draw.rectangle(box, fill=fill, outline=outline, width=line_width)
+    return Image.alpha_composite(img, overlay).convert('RGB')
+
+
+class LRUDict:
+    """Thread-safe mapping holding at most max_entries items, the least recently used ones are dropped first"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+
+def fallback_key(path):
+    """Cache key for files without a content hash in the store, changes whenever the file does"""
+    st = os.stat(path)
+    return hashlib.blake2b(f'{path}|{st.st_size}|{st.st_mtime}'.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ThumbnailCache:
+    """
+    Persistent, size bounded cache of result thumbnails on disk, keyed by (content hash, size).
+
+    Thumbnails are stored as WebP (or JPEG) files under folder, and the least recently used ones
+    are evicted once the cache grows past max_bytes. Recency survives restarts through the file
+    mtimes, which get bumped on every hit.
+    """
+
+    def __init__(self, folder, max_bytes=2**30, format='WEBP', quality=80):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.format = format
+        self.quality = quality
+        self.extension = '.webp' if format == 'WEBP' else '.jpg'
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # file path -> size in bytes, least recently used first
+        self.total_bytes = 0
+
+        os.makedirs(folder, exist_ok=True)
+        found = []
+        for dirpath, _, filenames in os.walk(folder):
+            for filename in filenames:
+                if filename.endswith(self.extension):
+                    file = os.path.join(dirpath, filename)
+                    st = os.stat(file)
+                    found.append((st.st_mtime, file, st.st_size))
+        for _, file, size in sorted(found):
+            self.entries[file] = size
+            self.total_bytes += size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def file_for(self, digest, size):
+        return os.path.join(self.folder, digest[:2], f'{digest}_{size}{self.extension}')
+
+    def get(self, digest, size):
+        """Encoded thumbnail bytes, or None on a miss"""
+        file = self.file_for(digest, size)
+        with self.lock:
+            if file not in self.entries:
+                return None
+            self.entries.move_to_end(file)
+        try:
+            with open(file, 'rb') as f:
+                data = f.read()
+            os.utime(file)
+        except OSError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(file, 0)
+            return None
+        return data
+
+    def put_bytes(self, digest, size, data):
+        file = self.file_for(digest, size)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+
+        # write then rename so a reader never sees half a file
+        tmp_file = f'{file}.{threading.get_ident()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, file)
+
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(file, 0)
+            self.entries[file] = len(data)
+            self.evict()
+        return data
+
+    def put(self, digest, size, img):
+        return self.put_bytes(digest, size, encode_thumbnail(img, size, self.format, self.quality))
+
+    def evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        # drop to 90% so eviction doesn't run on every put once the cache is full
+        while self.entries and self.total_bytes > self.max_bytes * 0.9:
+            file, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(file)
+            except OSError:
+                pass
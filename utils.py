@@ -1,42 +1,66 @@
 import numpy as np
 import io
+import math
 import warnings
 import os
-from PIL import Image
+from PIL import Image, ImageChops
 import tempfile
 
-def load_image(file_path):
+def load_image(file_path, target_size=None, max_pixels=None, data=None):
     """
     Attempt to load an image through multiple methods, returning a PIL Image object.
 
     Args:
         file_path: Path to the image file
+        target_size: Optional (width, height) box the caller will fit the image into
+        max_pixels: Optional pixel count the caller will scale the image down to
+        data: Optional bytes of the file, already read by the caller, for the loaders that decode from memory
 
     Returns:
-        PIL.Image object or None if the image couldn't be loaded
+        PIL.Image object or None if the image couldn't be loaded. When target_size or max_pixels
+        is given, decoders use their cheap reduced resolution paths (JPEG DCT scaling, JPEG 2000
+        reduce levels, half size RAW demosaicing or the embedded RAW preview) where possible, so
+        the result may be smaller than the original but never smaller than what was asked for.
+        img.info['source_size'] always holds the (width, height) of the original.
     """
     
+    def reduction(size):
+        """Scale factor the caller is going to apply to an image of this size anyway"""
+        ratio = 1.0
+        if target_size is not None:
+            ratio = min(ratio, target_size[0] / size[0], target_size[1] / size[1])
+        if max_pixels is not None:
+            ratio = min(ratio, (max_pixels / (size[0] * size[1])) ** 0.5)
+        return ratio
+    
     # Specialized loaders
     
     def load_svg(file_path):
-        """Convert SVG to PIL Image"""
+        """Rasterise SVG to PIL Image in memory"""
         try:
             from cairosvg import svg2png
-            import tempfile
-            
-            # Create a temporary PNG file
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                tmp_filename = tmp.name
             
-            # Convert SVG to PNG
-            svg2png(url=file_path, write_to=tmp_filename)
+            buffer = io.BytesIO()
+            svg2png(url=file_path, write_to=buffer)
+            buffer.seek(0)
             
-            # Load the PNG with PIL
-            img = Image.open(tmp_filename)
+            img = Image.open(buffer)
             img.load()
             
-            # Clean up
-            os.unlink(tmp_filename)
+            return img
+        except Exception as e:
+            return None
+    
+    def load_wand(file_path):
+        """Decode through ImageMagick, exporting raw pixels rather than an encoded blob"""
+        try:
+            import wand.image
+            
+            with wand.image.Image(filename=file_path) as wand_img:
+                size = wand_img.size
+                pixels = wand_img.export_pixels(channel_map='RGB', storage='char')
+            
+            img = Image.frombytes('RGB', size, bytes(pixels))
             
             return img
         except Exception as e:
@@ -44,10 +68,14 @@ def load_image(file_path):
     
     def load_wmf(file_path):
         """Convert WMF/EMF to PIL Image"""
+        img = load_wand(file_path)
+        if img is not None:
+            return img
+        
         try:
             import pymagewell
             
-            # Convert to PNG via pymagewell
+            # pymagewell can only write to a file
             with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
                 tmp_filename = tmp.name
             
@@ -113,28 +141,23 @@ def load_image(file_path):
             return None
     
     def load_ai_eps(file_path):
-        """Load AI/EPS files using Ghostscript"""
+        """Load AI/EPS files using Ghostscript, reading the rendered page from a pipe"""
         try:
-            import ghostscript
-            import tempfile
+            import shutil
+            import subprocess
             
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-                tmp_filename = tmp.name
+            gs = shutil.which('gswin64c') or shutil.which('gswin32c') or shutil.which('gs')
             
-            # Use Ghostscript to convert to PNG
+            # raw ppm on stdout skips both the temp file and a png encode inside ghostscript
             args = [
-                "gs", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=png16m",
-                f"-sOutputFile={tmp_filename}", "-r300", file_path
+                gs, "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=ppmraw",
+                "-dFirstPage=1", "-dLastPage=1", "-sOutputFile=-", "-r300", file_path
             ]
-            ghostscript.Ghostscript(*args)
+            output = subprocess.run(args, capture_output=True, check=True, timeout=60).stdout
             
-            # Load with PIL
-            img = Image.open(tmp_filename)
+            img = Image.open(io.BytesIO(output))
             img.load()
             
-            # Clean up
-            os.unlink(tmp_filename)
-            
             return img
         except Exception as e:
             return None
@@ -172,20 +195,7 @@ def load_image(file_path):
     
     def load_dds(file_path):
         """Load DirectDraw Surface files"""
-        try:
-            import wand.image
-            
-            with wand.image.Image(filename=file_path) as wand_img:
-                # Convert to PNG in memory
-                wand_img.format = 'png'
-                png_blob = wand_img.make_blob()
-            
-            # Load the PNG blob with PIL
-            img = Image.open(io.BytesIO(png_blob))
-            
-            return img
-        except Exception as e:
-            return None
+        return load_wand(file_path)
     
     def load_tga(file_path):
         """Load TGA files explicitly"""
@@ -205,10 +215,29 @@ def load_image(file_path):
             import rawpy
             
             with rawpy.imread(file_path) as raw:
-                rgb = raw.postprocess()
+                full_size = (raw.sizes.width, raw.sizes.height)
+                ratio = reduction(full_size)
+                
+                # the embedded jpeg preview is often all a reduced size load needs
+                if ratio < 1.0:
+                    try:
+                        thumb = raw.extract_thumb()
+                    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+                        thumb = None
+                    if thumb is not None and thumb.format == rawpy.ThumbFormat.JPEG:
+                        img = Image.open(io.BytesIO(thumb.data))
+                        if img.width >= full_size[0] * ratio and img.height >= full_size[1] * ratio:
+                            img.draft('RGB', (round(full_size[0] * ratio), round(full_size[1] * ratio)))
+                            img.load()
+                            img.info['source_size'] = full_size
+                            return img
+                
+                # half size skips demosaicing, which is most of the decode time
+                rgb = raw.postprocess(half_size=ratio <= 0.5)
             
             # Convert numpy array to PIL Image
             img = Image.fromarray(rgb)
+            img.info['source_size'] = full_size
             
             return img
         except Exception as e:
@@ -244,70 +273,108 @@ def load_image(file_path):
             if not ret:
                 raise Exception("Could not read frame")
             
+            # shrink before any further conversion
+            source_size = (frame.shape[1], frame.shape[0])
+            ratio = reduction(source_size)
+            if ratio < 1.0:
+                frame = cv2.resize(frame, (max(1, round(frame.shape[1] * ratio)), max(1, round(frame.shape[0] * ratio))), interpolation=cv2.INTER_AREA)
+            
             # Convert from BGR to RGB
             rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             
             # Convert to PIL Image
             img = Image.fromarray(rgb_frame)
+            img.info['source_size'] = source_size
             
             return img
         except Exception as e:
             return None
     
-    if not os.path.exists(file_path):
+    def load_pil(file_path, reduced=True):
+        """Load anything PIL decodes natively, keeping the decoded pixels as they are"""
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")  # Suppress PIL warnings
+                img = Image.open(io.BytesIO(data) if data is not None else file_path)
+                source_size = img.size
+                
+                # reduced resolution decoding, the decoder picks a scale no smaller than requested
+                ratio = reduction(img.size) if reduced else 1.0
+                if ratio < 1.0:
+                    if img.format == 'JPEG':
+                        img.draft(img.mode, (round(img.width * ratio), round(img.height * ratio)))
+                    elif img.format == 'JPEG2000':
+                        img.reduce = max(0, int(math.log2(1 / ratio)))
+                
+                img.load()  # This will verify the image can actually be read
+                img.info['source_size'] = source_size
+            
+            # multi-frame images keep their file handle open, detach the loaded frame from it
+            if getattr(img, 'is_animated', False):
+                frame = img.copy()
+                img.close()
+                img = frame
+            
+            # keep to the modes downstream code (and png encoding) can handle, e.g. CMYK jpegs
+            if img.mode not in ('1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+            
+            return img
+        except Exception as e:
+            if reduced and (target_size is not None or max_pixels is not None):
+                return load_pil(file_path, reduced=False)  # e.g. more jpeg 2000 reduce levels than the codestream has
+            return None
+    
+    raw_formats = ['cr2', 'cr3', 'nef', 'arw', 'raw', 'orf', 'rw2', 'dng', 'x3f']
+    
+    # format dispatch table, loaders are tried in order and anything not listed goes to PIL
+    loaders = {
+        'svg': (load_svg,),
+        'wmf': (load_wmf, load_pil),
+        'emf': (load_wmf, load_pil),
+        'psd': (load_pil, load_psd),
+        'xcf': (load_xcf,),
+        'heic': (load_heic, load_pil),
+        'heif': (load_heic, load_pil),
+        'ai': (load_ai_eps,),
+        'eps': (load_ai_eps, load_pil),
+        'exr': (load_exr_hdr,),
+        'hdr': (load_exr_hdr, load_pil),
+        'dds': (load_pil, load_dds),
+        'tga': (load_tga,),
+        'jxl': (load_jxl, load_pil),
+        'jpxl': (load_jxl, load_pil),
+        'mp4': (load_video_first_frame,),
+        'gif': (load_pil, load_video_first_frame),  # For video, we'll extract the first frame
+        **{ext: (load_raw, load_pil) for ext in raw_formats},
+    }
+    
+    if data is None and not os.path.exists(file_path):
         return None
     
     # Get file extension (lowercase)
     _, ext = os.path.splitext(file_path)
     ext = ext.lower().lstrip('.')
     
-    def reencode_as_png(image):
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)  # Reset buffer position
-        return Image.open(buffer)
-    
-    # Step 1: Try direct PIL loading (covers most common formats)
-    try:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")  # Suppress PIL warnings
-            img = Image.open(file_path)
-            img.load()  # This will verify the image can actually be read
-            img = reencode_as_png(img)
+    for loader in loaders.get(ext, (load_pil,)):
+        img = loader(file_path)
+        if img is not None:
+            img.info.setdefault('source_size', img.size)  # loaders without a reduced path return the original size
             return img
-    except Exception as e:
-        pass
-    
-    # Step 2: Try specialized libraries based on file extension
-    if ext in ['svg']:
-        return load_svg(file_path)
-    elif ext in ['wmf', 'emf']:
-        return load_wmf(file_path)
-    elif ext in ['psd']:
-        return load_psd(file_path)
-    elif ext in ['xcf']:
-        return load_xcf(file_path)
-    elif ext in ['heic', 'heif']:
-        return load_heic(file_path)
-    elif ext in ['ai', 'eps']:
-        return load_ai_eps(file_path)
-    elif ext in ['exr', 'hdr']:
-        return load_exr_hdr(file_path)
-    elif ext in ['dds']:
-        return load_dds(file_path)
-    elif ext in ['tga']:
-        return load_tga(file_path)
-    elif ext in ['cr2', 'cr3', 'nef', 'arw', 'raw', 'orf', 'rw2', 'dng', 'x3f']:
-        return load_raw(file_path)
-    elif ext in ['jxl', 'jpxl']:
-        return load_jxl(file_path)
-    elif ext in ['mp4', 'gif']:
-        return load_video_first_frame(file_path)  # For video, we'll extract the first frame
     
     # If we get here, we couldn't load the image
     return None
 
 
+def read_image_size(file_path):
+    """(width, height) of an image read from its header alone, None for files PIL can't identify"""
+    try:
+        with Image.open(file_path) as img:
+            return img.size
+    except Exception:
+        return None
+
+
 image_formats = (
     'png',  # Common raster format, lossless compression
     'jpg',  # Common raster format, lossy compression
@@ -524,73 +591,237 @@ def truncate_path(path, max_length):
 
 
 import cv2
-import pytesseract
-
-
-def analyze_text_probability(image_path):
-    try:
+import threading
 
-        pil_img = image_path
-        img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
 
-        if img is None:
-            return False
-
-        # 2. MSER (Maximally Stable Extremal Regions) text region detection
-        # Effective for detecting text regions in natural images
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        # Create MSER detector
-        mser = cv2.MSER_create()
+def text_like_region_heights(gray):
+    """Heights of the MSER regions with text-like sizes and aspect ratios in a grayscale uint8 array"""
+    mser = cv2.MSER_create()
+    regions, _ = mser.detectRegions(gray)
+    
+    heights = []
+    for region in regions:
+        x, y, w, h = cv2.boundingRect(region)
+        aspect_ratio = w / float(h) if h > 0 else 0
+        
+        # Text typically has certain aspect ratio ranges
+        if 0.1 < aspect_ratio < 10 and 3 < w < 200 and 3 < h < 60:
+            heights.append(h)
+    return heights
 
-        # Detect regions
-        regions, _ = mser.detectRegions(gray)
 
-        # 3. Simple heuristic - check if image has enough variation
+class TextPrefilter:
+    """
+    Cheap check for whether an image is worth sending to Tesseract at all.
+    
+    Works on a grayscale copy downscaled to max_side. Near-uniform images score 0, otherwise the
+    score comes from the EAST text detector when east_model (path to frozen_east_text_detection.pb)
+    is given, or from a count of text-like MSER regions. Images scoring below threshold are skipped.
+    The MSER region heights, scaled to the image's pixels, are left in img.info['text_heights'] so
+    preprocess_for_ocr can estimate the text height without detecting the regions again.
+    """
+    
+    def __init__(self, threshold=0.5, max_side=640, min_std=10, mser_regions=10, east_model=None):
+        self.threshold = threshold
+        self.max_side = max_side
+        self.min_std = min_std
+        self.mser_regions = mser_regions
+        self.east_model = east_model
+        self.local = threading.local()  # cv2.dnn nets aren't safe to share between threads
+    
+    def east_score(self, img):
+        if not hasattr(self.local, 'net'):
+            self.local.net = cv2.dnn.readNet(self.east_model)
+        
+        # EAST wants dimensions that are multiples of 32
+        rgb = np.array(img.convert('RGB'))
+        width = max(32, rgb.shape[1] // 32 * 32)
+        height = max(32, rgb.shape[0] // 32 * 32)
+        blob = cv2.dnn.blobFromImage(rgb, 1.0, (width, height), (123.68, 116.78, 103.94), swapRB=False, crop=False)
+        self.local.net.setInput(blob)
+        scores = self.local.net.forward('feature_fusion/Conv_7/Sigmoid')
+        return float(scores.max())
+    
+    def score(self, img):
+        # shrink before anything else, converting or copying the full decode costs more than the scoring
+        scale = min(1.0, self.max_side / max(img.size))
+        # palette and 1 bit images only resize nearest neighbour, which loses thin text, and pillow can't reduce 16 bit ones
+        small = img.convert('L') if img.mode in ('1', 'P') or img.mode.startswith('I;16') else img
+        if scale < 1.0:
+            small = small.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BICUBIC, reducing_gap=2.0)
+        gray = np.array(small.convert('L') if small.mode != 'L' else small)
+        
         # Very uniform images (like blank pages) rarely contain text
-        std_dev = np.std(gray)
-        if std_dev < 10:  # Very uniform image
-            return False
-
-
-        # Count regions and check if they form text-like patterns
-        if len(regions) > 10:
-            # Filter for regions with text-like aspect ratios and sizes
-            text_like_regions = 0
-            for region in regions:
-                x, y, w, h = cv2.boundingRect(region)
-                aspect_ratio = w / float(h) if h > 0 else 0
-
-                # Text typically has certain aspect ratio ranges
-                if 0.1 < aspect_ratio < 10 and 5 < w < 300 and 5 < h < 100:
-                    text_like_regions += 1
+        if np.std(gray) < self.min_std:
+            return 0.0
+        
+        if self.east_model is not None:
+            return self.east_score(small)
+        
+        heights = text_like_region_heights(gray)
+        img.info['text_heights'] = [height * img.height / small.height for height in heights]
+        return min(1.0, len(heights) / self.mser_regions)
+    
+    def __call__(self, img):
+        try:
+            return self.score(img) >= self.threshold
+        except Exception:
+            return True  # when in doubt, let OCR decide
+
+
+# format families that get their own preprocessing profile, anything else uses 'default'
+format_families = {
+    'raw': ('cr2', 'cr3', 'nef', 'arw', 'orf', 'rw2', 'dng', 'x3f', 'mef', 'mos', 'pef', 'srw', 'bay', 'r3d', 'raw', 'raw16'),
+    'vector': ('svg', 'eps', 'ai', 'wmf', 'emf', 'cgm', 'sk1'),
+    'photo': ('jpg', 'jpeg', 'heic', 'heif', 'hif', 'avif', 'jxl', 'jpxl', 'jp2', 'j2k', 'jpf', 'exr', 'hdr'),
+    'video': ('mp4', 'gifv'),
+}
+
+# max_pixels caps the image size handed to tesseract once uniform borders are cropped away, target_text_height
+# is the text height in pixels images get scaled down to when their text is estimated to be bigger than it needs
+# to be. decode_max_pixels bounds the decode itself, loose enough that cropping still has the resolution to keep,
+# families that rarely have borders to crop decode straight at max_pixels
+preprocess_profiles = {
+    'default': {'max_pixels': 12_000_000, 'decode_max_pixels': 48_000_000, 'target_text_height': 32, 'grayscale': True, 'binarize': False, 'crop_borders': True, 'border_tolerance': 8},
+    'raw': {'max_pixels': 4_000_000, 'decode_max_pixels': 4_000_000},
+    'photo': {'max_pixels': 6_000_000, 'decode_max_pixels': 6_000_000},
+    'vector': {'max_pixels': 8_000_000, 'binarize': True},
+    'video': {'max_pixels': 4_000_000, 'decode_max_pixels': 4_000_000},
+}
+
+# second attempt at results tesseract wasn't confident about, binarised and kept bigger so small text keeps more pixels
+retry_preprocess_profiles = {
+    'default': {**preprocess_profiles['default'], 'max_pixels': 24_000_000, 'target_text_height': 48, 'binarize': True},
+    'raw': {'max_pixels': 8_000_000, 'decode_max_pixels': 8_000_000},
+    'photo': {'max_pixels': 12_000_000, 'decode_max_pixels': 12_000_000},
+    'vector': {'max_pixels': 16_000_000},
+    'video': {'max_pixels': 8_000_000, 'decode_max_pixels': 8_000_000},
+}
+
+
+def format_family(file_path):
+    ext = os.path.splitext(file_path)[1].lower().lstrip('.')
+    for family, extensions in format_families.items():
+        if ext in extensions:
+            return family
+    return 'default'
+
+
+def estimate_text_height(gray, max_side=1024, heights=None):
+    """
+    Median height in pixels of the text-like MSER regions of a grayscale image, or None when there
+    are too few. heights are region heights already measured in the image's pixels, if any.
+    """
+    if heights is None:
+        small = gray.copy()
+        small.thumbnail((max_side, max_side))
+        scale = gray.height / small.height
+        heights = [height * scale for height in text_like_region_heights(np.array(small))]
+    
+    if len(heights) < 5:
+        return None
+    return float(np.median(heights))
 
-            # If we have enough text-like regions, it's likely text
-            if text_like_regions > 5:
-                return True
 
+def uniform_border_bbox(img, tolerance=8):
+    """Box inside the borders that match the top left pixel's colour, None when there's nothing to crop"""
+    background = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+    diff = ImageChops.difference(img, background)
+    if diff.mode != 'L':
+        diff = diff.convert('L')
+    bbox = diff.point(lambda p: 255 if p > tolerance else 0).getbbox()
+    if bbox is None:
+        return None
+    
+    # keep a little margin, tesseract does worse on text touching the edge
+    margin = 10
+    return max(0, bbox[0] - margin), max(0, bbox[1] - margin), min(img.width, bbox[2] + margin), min(img.height, bbox[3] + margin)
 
-        # 1. Fast approach - Use Tesseract's built-in text detection without full OCR
-        # This is much faster than full OCR and gives a confidence score
-        config = "--psm 11 --oem 3"  # Page segmentation mode 11: Sparse text, OEM 3: Default
-        data = pytesseract.image_to_data(pil_img, config=config, output_type=pytesseract.Output.DICT)
 
-        # Calculate confidence from Tesseract's detection phase
-        conf_values = [float(conf) for conf in data['conf'] if conf != '-1']
-        if conf_values:
-            avg_conf = sum(conf_values) / len(conf_values)
-            max_conf = max(conf_values) if conf_values else 0
+def crop_uniform_borders(img, tolerance=8):
+    """Crop away borders that match the top left pixel's colour"""
+    bbox = uniform_border_bbox(img, tolerance)
+    return img if bbox is None else img.crop(bbox)
 
-            # If we have high confidence values, return True immediately
-            if max_conf > 70:
-                return True
 
-            # If we have moderate confidence, it's likely text
-            if avg_conf > 50:
-                return True
+def preprocess_for_ocr(img, family='default', profiles=preprocess_profiles):
+    """
+    Shrink an image to what tesseract actually needs before OCR, since OCR time scales with the pixel
+    count. Converts to grayscale (optionally binarised), crops uniform borders and downscales so
+    the estimated text height lands near the profile's target_text_height, never exceeding max_pixels.
+    The part of the input the result covers is recorded in info['ocr_frame'] as (left, top, width,
+    height) fractions, so word boxes found on the result can be mapped back onto the original.
+    """
+    profile = {**profiles['default'], **profiles.get(family, {})}
+    source_width, source_height = img.size
+    text_heights = img.info.get('text_heights')  # left behind by TextPrefilter
+    
+    if profile['grayscale'] and img.mode != 'L':
+        img = img.convert('L')
+    elif img.mode not in ('L', 'RGB'):
+        img = img.convert('RGB')
+    
+    frame = (0.0, 0.0, 1.0, 1.0)
+    if profile['crop_borders']:
+        bbox = uniform_border_bbox(img, profile['border_tolerance'])
+        if bbox is not None:
+            img = img.crop(bbox)
+            frame = (bbox[0] / source_width, bbox[1] / source_height, (bbox[2] - bbox[0]) / source_width, (bbox[3] - bbox[1]) / source_height)
+    
+    scale = 1.0
+    gray = img if img.mode == 'L' else img.convert('L')
+    text_height = estimate_text_height(gray, heights=text_heights)
+    if text_height is not None and text_height > profile['target_text_height']:
+        scale = profile['target_text_height'] / text_height
+    scale = min(scale, (profile['max_pixels'] / (img.width * img.height)) ** 0.5)
+    
+    if scale < 1.0:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS)
+    
+    if profile['binarize'] and img.mode == 'L':
+        _, binary = cv2.threshold(np.array(img), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        img = Image.fromarray(binary)
+    
+    img.info['ocr_frame'] = frame
+    return img
 
-        return False
 
-    except Exception as e:
-        #print(f"Error processing {image_path}: {e}")
-        return False
\ No newline at end of file
+def evaluate_prefilter(prefilter, samples):
+    """
+    Precision and recall of the prefilter on a labelled sample of (path, has_text) pairs,
+    along with the fraction of images it would skip.
+    """
+    true_positive = false_positive = false_negative = kept = total = 0
+    for path, has_text in samples:
+        img = load_image(path)
+        if img is None:
+            continue
+        keep = prefilter(img)
+        total += 1
+        kept += keep
+        true_positive += keep and has_text
+        false_positive += keep and not has_text
+        false_negative += not keep and has_text
+    
+    return {
+        'precision': true_positive / (true_positive + false_positive) if true_positive + false_positive else 0.0,
+        'recall': true_positive / (true_positive + false_negative) if true_positive + false_negative else 0.0,
+        'skipped': 1 - kept / total if total else 0.0,
+        'samples': total,
+    }
+
+
+if __name__ == '__main__':
+    # python utils.py labels.csv [threshold] [east_model], where each line of labels.csv is path,0 or path,1
+    import sys
+    import csv
+    
+    with open(sys.argv[1], newline='', encoding='utf-8') as f:
+        samples = [(row[0], row[1].strip() == '1') for row in csv.reader(f) if row]
+    
+    prefilter = TextPrefilter(
+        threshold=float(sys.argv[2]) if len(sys.argv) > 2 else 0.5,
+        east_model=sys.argv[3] if len(sys.argv) > 3 else None,
+    )
+    print(evaluate_prefilter(prefilter, samples))
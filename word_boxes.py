@@ -0,0 +1,107 @@
+import struct
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+from search_index import tokenize
+
+box_scale = 65535  # boxes are stored as uint16 fractions of the source image
+unknown_confidence = 255  # stored for words the OCR backend gave no confidence for
+format_version = 2  # first byte of every blob, bump it whenever the layout changes
+
+
+def pack_words(words, boxes, confidences=None):
+    """
+    Pack OCR words, their (left, top, width, height) boxes given as fractions of the source image
+    and their 0-100 confidences into one compact blob: the format_version byte, a word count, the
+    boxes as uint16 fixed point, one confidence byte per word and the words as newline separated utf-8.
+    """
+    boxes = np.clip(np.round(np.asarray(boxes, dtype=np.float64).reshape(-1, 4) * box_scale), 0, box_scale).astype('<u2')
+    if confidences is None:
+        confidences = np.full(len(words), unknown_confidence, dtype=np.uint8)
+    else:
+        confidences = np.array([unknown_confidence if confidence is None or confidence < 0 else min(round(confidence), 100) for confidence in confidences], dtype=np.uint8)
+    text = '\n'.join(word.replace('\n', ' ') for word in words).encode('utf-8')
+    return struct.pack('<BI', format_version, len(words)) + boxes.tobytes() + confidences.tobytes() + text
+
+
+def source_boxes(boxes, frame, size):
+    """
+    Map (left, top, width, height) pixel boxes found on a preprocessed image of the given (width,
+    height) size to fractions of the image preprocessing started from, frame being the
+    info['ocr_frame'] preprocess_for_ocr left on it.
+    """
+    left, top, width, height = frame
+    x_scale, y_scale = width / size[0], height / size[1]
+    return [(left + x * x_scale, top + y * y_scale, w * x_scale, h * y_scale) for x, y, w, h in boxes]
+
+
+def unpack_words(blob):
+    """
+    The (words, boxes, confidences) of a packed blob, boxes being a float32 (n, 4) array of
+    fractions and confidences a uint8 array holding unknown_confidence where there was none.
+    Raises ValueError for blobs of another format version.
+    """
+    version, count = struct.unpack_from('<BI', blob)
+    if version != format_version:
+        raise ValueError(f'Unsupported word box format {version}')
+    start = struct.calcsize('<BI')
+    end = start + count * 9
+    boxes = np.frombuffer(blob, dtype='<u2', count=count * 4, offset=start).reshape(-1, 4).astype(np.float32) / box_scale
+    confidences = np.frombuffer(blob, dtype=np.uint8, count=count, offset=start + count * 8)
+    text = blob[end:].decode('utf-8')
+    return (text.split('\n') if count else []), boxes, confidences
+
+
+def document_confidence(words, confidences):
+    """Mean confidence of the words weighted by their length, None when none of them has one"""
+    weights = np.array([len(word) for word in words], dtype=np.float64)
+    confidences = np.asarray(confidences, dtype=np.float64)
+    known = (confidences >= 0) & (confidences <= 100)
+    if not weights[known].sum():
+        return None
+    return float(np.average(confidences[known], weights=weights[known]))
+
+
+def matching_boxes(words, boxes, query, score_cutoff=80):
+    """Boxes of the OCR words that fuzzily match, or start with, a word of query"""
+    query_words = list(dict.fromkeys(tokenize(query)))
+    tokens, owners = [], []
+    for i, word in enumerate(words):
+        for token in tokenize(word):
+            tokens.append(token)
+            owners.append(i)
+    if not query_words or not tokens:
+        return boxes[:0]
+
+    scores = process.cdist(tokens, query_words, scorer=fuzz.ratio, workers=-1)
+    matched = (scores >= score_cutoff).any(axis=1)
+    matched |= np.array([any(token.startswith(word) for word in query_words) for token in tokens])
+    keep = np.zeros(len(words), dtype=bool)
+    keep[np.array(owners)[matched]] = True
+    return boxes[keep]
+
+
+def focus_region(boxes, padding=0.05, min_size=0.25):
+    """
+    (left, top, right, bottom) fractions of the source image around boxes, padded and grown to
+    at least min_size of each dimension so the crop keeps some context. None without boxes.
+    """
+    if not len(boxes):
+        return None
+    left, top = boxes[:, 0].min(), boxes[:, 1].min()
+    right, bottom = (boxes[:, 0] + boxes[:, 2]).max(), (boxes[:, 1] + boxes[:, 3]).max()
+
+    region = []
+    for start, end in ((left, right), (top, bottom)):
+        start, end = start - padding, end + padding
+        if end - start < min_size:
+            grow = (min_size - (end - start)) / 2
+            start, end = start - grow, end + grow
+        # slide back inside the image rather than just clipping, so the crop keeps its size
+        if start < 0:
+            start, end = 0.0, min(1.0, end - start)
+        if end > 1:
+            start, end = max(0.0, start - (end - 1)), 1.0
+        region.append((float(start), float(end)))
+    return region[0][0], region[1][0], region[0][1], region[1][1]